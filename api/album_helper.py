@@ -0,0 +1,62 @@
+"""
+Album listings come from one annotated query, and an album's resources are loaded a page at a time
+by keyset on (created, id), newest first, instead of all of them with every album.
+"""
+import calendar
+import datetime
+
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from api.models import Album, EventMember
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def annotate(albums):
+    """
+    Albums with their cover, event, resource count and when a resource was last updated, in one query
+    """
+    return albums.select_related('cover__blob', 'event').annotate(resource_count=Count('resources'),
+                                                                  resources_updated=Max('resources__updated'))
+
+
+def get_uploadable(user):
+    """
+    Albums the user can upload to, their own and those of events they're an accepted member of
+    """
+    events = EventMember.objects.filter(user=user, status=EventMember.ACCEPTED).values('event')
+    return Album.objects.filter(Q(owner=user) | Q(event__in=events))
+
+
+def issue_cursor(resource):
+    """
+    Position after the resource, its created time in microseconds since the epoch and its id
+    """
+    created = resource.created
+    return '%d_%d' % (calendar.timegm(created.utctimetuple()) * 1000000 + created.microsecond, resource.id)
+
+
+def parse_cursor(cursor):
+    """
+    Returns the (created, id) position, raises ValueError if it isn't a cursor
+    """
+    created, sep, id = cursor.partition('_')
+    if not created.isdigit() or not id.isdigit():
+        raise ValueError('Invalid cursor: ' + cursor)
+    return EPOCH + datetime.timedelta(microseconds=int(created)), int(id)
+
+
+def get_resources(album, cursor, page_size):
+    """
+    A page of the album's resources, newest first, and the cursor for the next page, None after the last
+    """
+    resources = album.resources.select_related('blob').order_by('-created', '-id')
+    if cursor is not None:
+        created, id = cursor
+        resources = resources.filter(Q(created__lt=created) | Q(created=created, id__lt=id))
+    page = list(resources[:page_size + 1])
+    if len(page) > page_size:
+        return page[:page_size], issue_cursor(page[page_size - 1])
+    return page, None
@@ -0,0 +1,89 @@
+"""
+Django cache backend on redis, so every web worker, dyno and celery worker shares one cache
+and a key deleted in one process is gone for all of them
+"""
+import cPickle as pickle
+
+import redis
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def is_shared(cache):
+    """
+    Whether other processes see this cache, without redis each process has its own
+    """
+    return not isinstance(cache, LocMemCache)
+
+
+class RedisCache(BaseCache):
+    def __init__(self, server, params):
+        super(RedisCache, self).__init__(params)
+        self._client = redis.StrictRedis.from_url(server)
+
+    def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Seconds until a key expires, None to keep it until it's deleted
+        """
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else max(int(timeout), 0)
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout == 0:
+            return False
+        return bool(self._client.set(self._key(key, version), self._dumps(value), ex=timeout, nx=True))
+
+    def get(self, key, default=None, version=None):
+        value = self._client.get(self._key(key, version))
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout == 0:
+            self.delete(key, version=version)
+        else:
+            self._client.set(self._key(key, version), self._dumps(value), ex=timeout)
+
+    def delete(self, key, version=None):
+        self._client.delete(self._key(key, version))
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self._client.mget([self._key(key, version) for key in keys])
+        return dict((key, pickle.loads(value)) for key, value in zip(keys, values) if value is not None)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout == 0:
+            self.delete_many(data.keys(), version=version)
+            return
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in data.iteritems():
+            pipeline.set(self._key(key, version), self._dumps(value), ex=timeout)
+        pipeline.execute()
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+        if keys:
+            self._client.delete(*keys)
+
+    def clear(self):
+        # Only this cache's keys, the same redis also buffers event views
+        keys = list(self._client.scan_iter(self.make_key('*')))
+        if keys:
+            self._client.delete(*keys)
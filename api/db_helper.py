@@ -0,0 +1,79 @@
+from django.db import connection, connections
+from django.db.models import sql
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+def update_from_values(model, key_fields, value_fields, rows, where=None, chunk_size=500):
+    """
+    Updates many rows of a model with one UPDATE ... FROM (VALUES ...) statement per chunk,
+    instead of saving each object separately.
+
+    Each row is a tuple of the key_fields values followed by the value_fields values.
+    where is optional extra sql comparing the table, aliased t, with the new values, aliased v.
+    Returns the number of rows updated.
+    """
+    opts = model._meta
+    key_columns = [opts.get_field(name).column for name in key_fields]
+    value_columns = [opts.get_field(name).column for name in value_fields]
+    columns = key_columns + value_columns
+
+    assignments = ', '.join('%s = v.%s' % (column, column) for column in value_columns)
+    conditions = ' AND '.join('t.%s = v.%s' % (column, column) for column in key_columns)
+    if where:
+        conditions += ' AND ' + where
+    placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+
+    count = 0
+    cursor = connection.cursor()
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        sql = 'UPDATE %s AS t SET %s FROM (VALUES %s) AS v (%s) WHERE %s' % (
+            opts.db_table, assignments, ', '.join([placeholder] * len(chunk)), ', '.join(columns), conditions)
+        params = [value for row in chunk for value in row]
+        cursor.execute(sql, params)
+        count += cursor.rowcount
+    return count
+
+
+def update_returning(queryset, **values):
+    """
+    Updates the queryset's rows like queryset.update(), with one UPDATE ... RETURNING statement,
+    and returns the primary keys of the rows it changed.
+
+    Filtering on a value the update changes makes it a claim: a concurrent caller blocked on the same rows
+    rechecks the filter once they're committed, so each row is only returned to one of them.
+    Only filters on the model's own columns are supported.
+    """
+    query = queryset.query.clone(sql.UpdateQuery)
+    query.add_update_values(values)
+    try:
+        statement, params = query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return []
+    if not statement:
+        return []
+    cursor = connections[queryset.db].cursor()
+    cursor.execute('%s RETURNING %s' % (statement, queryset.model._meta.pk.column), params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def check_deferred_constraints():
+    """
+    Checks the foreign keys postgres defers until commit now, so a violation raises inside the current savepoint,
+    where it can be handled, instead of failing the commit of the outermost transaction
+    """
+    cursor = connection.cursor()
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+def lock_keys(namespace, keys):
+    """
+    Takes a postgres advisory lock on each key, held until the current transaction ends, so callers working on
+    the same keys take turns. Locks are taken in a fixed order, so callers locking overlapping keys don't deadlock.
+    Call it inside transaction.atomic, in autocommit the locks are released as soon as they're taken.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_xact_lock(%s, id) FROM '
+                   '(SELECT DISTINCT hashtext(key) AS id FROM unnest(%s::text[]) AS key ORDER BY id) AS ids',
+                   [namespace, list(keys)])
@@ -0,0 +1,122 @@
+"""
+Write-behind buffer for EventMember.viewed_event.
+
+Viewing an event only records a timestamp in redis, and the flush_event_views task
+periodically writes the buffered timestamps to the database in batches.
+Without redis, views are written straight to the database.
+"""
+import calendar
+import datetime
+import logging
+
+import redis
+
+from django.conf import settings
+from django.utils import timezone
+
+from api.models import EventMember
+from api import db_helper
+from api.redis_helper import get_connection
+
+
+logger = logging.getLogger(__name__)
+
+VIEWS_KEY = 'event_views'
+# Views being written to the database are moved here, so new views can keep being buffered
+FLUSHING_KEY = 'event_views:flushing'
+# Each user's latest buffered view, so responses depending on it can tell it changed
+LAST_VIEW_KEY = 'event_views:last:%s'
+
+
+def to_timestamp(value):
+    return '%.6f' % (calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000.0)
+
+
+def from_timestamp(value):
+    return datetime.datetime.fromtimestamp(float(value), timezone.utc)
+
+
+def record_view(event_id, user_id, viewed=None):
+    """
+    Records that a user viewed an event. Has no effect when the user is not a member of the event.
+    """
+    if viewed is None:
+        viewed = timezone.now()
+    conn = get_connection()
+    if conn is not None:
+        try:
+            timestamp = to_timestamp(viewed)
+            conn.pipeline().hset(VIEWS_KEY, '%s:%s' % (event_id, user_id), timestamp) \
+                .set(LAST_VIEW_KEY % user_id, timestamp, ex=settings.LAST_VIEW_TIMEOUT).execute()
+            return
+        except redis.RedisError as e:
+            logger.error(e)
+    EventMember.objects.filter(event=event_id, user=user_id).update(viewed_event=viewed)
+
+
+def get_buffered_view(event_id, user_id):
+    """
+    Returns when the user last viewed the event if it has not been written to the database yet, otherwise None
+    """
+    conn = get_connection()
+    if conn is None:
+        return None
+    field = '%s:%s' % (event_id, user_id)
+    try:
+        values = conn.pipeline().hget(VIEWS_KEY, field).hget(FLUSHING_KEY, field).execute()
+    except redis.RedisError as e:
+        logger.error(e)
+        return None
+    values = [from_timestamp(value) for value in values if value is not None]
+    if values:
+        return max(values)
+    return None
+
+
+def get_last_view(user_id):
+    """
+    Returns the timestamp of the user's latest buffered view of any event, or None
+    """
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        return conn.get(LAST_VIEW_KEY % user_id)
+    except redis.RedisError as e:
+        logger.error(e)
+        return None
+
+
+def get_viewed_event(member):
+    """
+    Returns when the member last viewed their event, including buffered views
+    """
+    buffered = get_buffered_view(member.event_id, member.user_id)
+    if buffered is not None and buffered > member.viewed_event:
+        return buffered
+    return member.viewed_event
+
+
+def flush_views():
+    """
+    Writes buffered views to the database, returns the number of EventMembers updated
+    """
+    conn = get_connection()
+    if conn is None:
+        return 0
+    # If a previous flush failed its views are still waiting, write those first
+    if not conn.exists(FLUSHING_KEY):
+        try:
+            conn.rename(VIEWS_KEY, FLUSHING_KEY)
+        except redis.ResponseError:
+            # Nothing buffered
+            return 0
+
+    rows = []
+    for field, value in conn.hgetall(FLUSHING_KEY).iteritems():
+        event_id, user_id = field.split(':')
+        rows.append((int(event_id), int(user_id), from_timestamp(value)))
+    count = db_helper.update_from_values(EventMember, ['event', 'user'], ['viewed_event'], rows,
+                                         where='t.viewed_event < v.viewed_event')
+    conn.delete(FLUSHING_KEY)
+    return count
@@ -0,0 +1,108 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+import numpy
+
+from api.models import FitHistory, FitRanking, Friend
+from api import db_helper
+
+
+def get_key(history):
+    return (history.period, history.activity, history.field)
+
+
+def sync_history(owner, histories):
+    """
+    Make owner's fit history match histories, matched on (period, activity, field)
+    Only new, changed and removed rows are written, returns whether anything was
+    """
+    now = timezone.now()
+    incoming = {}
+    for history in histories:
+        history.owner = owner
+        incoming[get_key(history)] = history
+
+    with transaction.atomic():
+        existing = dict((get_key(history), history) for history in
+                        FitHistory.objects.select_for_update().filter(owner=owner))
+
+        removed = [history.id for key, history in existing.iteritems() if key not in incoming]
+        if removed:
+            FitHistory.objects.filter(id__in=removed).delete()
+
+        changed = []
+        for key, history in incoming.iteritems():
+            current = existing.get(key)
+            if current is not None and (current.value != history.value or current.activity_id != history.activity_id):
+                changed.append((current.id, history.activity_id, history.value, now))
+        if changed:
+            db_helper.update_from_values(FitHistory, ['id'], ['activity_id', 'value', 'updated'], changed)
+
+        created = [history for key, history in incoming.iteritems() if key not in existing]
+        if created:
+            FitHistory.objects.bulk_create(created)
+    return bool(removed or changed or created)
+
+
+def get_viewers(user_id):
+    """
+    Ids of the users whose leaderboards include this user: the user and everyone who has them as a friend
+    """
+    return [user_id] + list(Friend.objects.filter(user=user_id).values_list('owner', flat=True))
+
+
+def rank(values):
+    """
+    Competition ranking, highest value first and ties sharing a rank: [5, 9, 5, 1] ranks as [2, 1, 2, 4]
+    """
+    values = numpy.asarray(values, dtype=float)
+    ascending = numpy.sort(values)
+    # Rank is one more than the number of strictly greater values
+    return len(values) - numpy.searchsorted(ascending, values, side='right') + 1
+
+
+def compute_rankings(viewer_id):
+    """
+    Returns {(user, period, activity, field): (value, rank)} ranking the viewer and their friends
+    """
+    circle = [viewer_id] + list(Friend.objects.filter(owner=viewer_id).values_list('user', flat=True))
+    boards = defaultdict(lambda: ([], []))
+    for user, period, activity, field, value in FitHistory.objects.filter(owner__in=circle) \
+            .values_list('owner', 'period', 'activity', 'field', 'value'):
+        users, values = boards[(period, activity, field)]
+        users.append(user)
+        values.append(value)
+
+    rankings = {}
+    for (period, activity, field), (users, values) in boards.iteritems():
+        for user, value, position in zip(users, values, rank(values)):
+            rankings[(user, period, activity, field)] = (value, int(position))
+    return rankings
+
+
+def refresh_rankings(viewer_id):
+    """
+    Recompute the viewer's leaderboards, writing only rankings that changed
+    """
+    rankings = compute_rankings(viewer_id)
+    with transaction.atomic():
+        existing = dict(((ranking.user_id, ranking.period, ranking.activity, ranking.field), ranking) for ranking in
+                        FitRanking.objects.select_for_update().filter(viewer=viewer_id))
+
+        removed = [ranking.id for key, ranking in existing.iteritems() if key not in rankings]
+        if removed:
+            FitRanking.objects.filter(id__in=removed).delete()
+
+        changed = [(existing[key].id, value, position) for key, (value, position) in rankings.iteritems()
+                   if key in existing and (existing[key].value, existing[key].rank) != (value, position)]
+        if changed:
+            db_helper.update_from_values(FitRanking, ['id'], ['value', 'rank'], changed)
+
+        created = [FitRanking(viewer_id=viewer_id, user_id=user, period=period, activity=activity, field=field,
+                              value=value, rank=position)
+                   for (user, period, activity, field), (value, position) in rankings.iteritems()
+                   if (user, period, activity, field) not in existing]
+        if created:
+            FitRanking.objects.bulk_create(created)
@@ -11,7 +11,7 @@ from elasticutils import F, Q
 from elasticutils.contrib.django import get_es, Indexable, MappingType, S
 from elasticutils.contrib.django import tasks
 
-from api.models import Event, Location, Plan, Profile, Tag
+from api.models import Event, Location, Plan, Profile, Resource, Tag
 
 
 logger = logging.getLogger(__name__)
@@ -150,7 +150,11 @@ class ProfileMapping(MappingType, Indexable):
                 'gender': {'type': 'string', 'index': 'not_analyzed'},
                 'display_name': {'type': 'string'},
                 'about': {'type': 'string', 'analyzer': 'snowball'},
-                'interests': {'type': 'string', 'analyzer': 'snowball'}
+                'interests': {'type': 'string', 'analyzer': 'snowball'},
+                # Prefixes of the display name and interests, so typing ahead is a plain term lookup
+                'autocomplete': {'type': 'string', 'index_analyzer': 'autocomplete', 'search_analyzer': 'standard'},
+                # Its thumbnail's url is signed and expires, so it's built when suggestions are returned
+                'portrait': {'type': 'long', 'index': 'no'}
             }
         }
     
@@ -160,12 +164,15 @@ class ProfileMapping(MappingType, Indexable):
         if obj is None:
             obj = cls.get_model().objects.get(pk=obj_id)
         
+        interests = list(obj.hash_tags.all().values_list('name', flat=True))
         return {
             'id': obj.pk,
             'gender': obj.gender,
             'display_name': obj.display_name,
             'about': obj.about,
-            'interests': list(obj.hash_tags.all().values_list('name', flat=True))
+            'interests': interests,
+            'autocomplete': [obj.display_name] + interests,
+            'portrait': obj.portrait_id
         }
 
 
@@ -189,6 +196,11 @@ def get_settings():
                     'type': 'pattern_replace',
                     'pattern': '^[^#@]\S+',
                     'replacement': '' 
+                },
+                'autocomplete_filter': {
+                    'type': 'edge_ngram',
+                    'min_gram': 1,
+                    'max_gram': 20
                 }
             },
             'analyzer' : {
@@ -196,6 +208,11 @@ def get_settings():
                     'type' : 'custom',
                     'tokenizer' : 'whitespace',
                     'filter' : ['tag_filter', 'lowercase', 'tweet_filter']
+                },
+                'autocomplete': {
+                    'type': 'custom',
+                    'tokenizer': 'standard',
+                    'filter': ['lowercase', 'autocomplete_filter']
                 }
             }
         }
@@ -369,6 +386,26 @@ def get_search(mappingType):
     return CustomS(mappingType).es(connection_class=RequestsHttpConnection)
 
 
+def suggest_profiles(search, boost_ids, size=settings.SUGGEST_SIZE):
+    """
+    Returns id, display name and thumbnail of profiles matching the typed prefix, ranking boost_ids first
+    """
+    query = {
+        'bool': {
+            'must': {'match': {'autocomplete': {'query': search, 'operator': 'and'}}},
+            'should': {'ids': {'values': [str(id) for id in boost_ids], 'boost': settings.SUGGEST_FRIEND_BOOST}}
+        }
+    }
+    items = list(get_search(ProfileMapping).query_raw(query).values_dict()[:size])
+    portraits = Resource.objects.select_related('blob').in_bulk([item['portrait'] for item in items if item.get('portrait')])
+    suggestions = []
+    for item in items:
+        portrait = portraits.get(item.get('portrait'))
+        suggestions.append({'id': item['id'], 'display_name': item['display_name'],
+                            'thumbnail': portrait.get_thumbnail() if portrait is not None else None})
+    return suggestions
+
+
 class PlanSearchFilter(object):
     def __init__(self, search=None, page=1, page_size=settings.REST_FRAMEWORK['PAGINATE_BY'],
                  distance=25, distance_units='mi', latitude=0.0, longitude=0.0):
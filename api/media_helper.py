@@ -0,0 +1,374 @@
+"""
+Ingestion of uploaded resources, run by the celery pipeline in tasks.process_resource
+The upload request only stores the raw bytes under a temporary name, everything here happens afterwards.
+Clients can also upload straight to s3 with a presigned POST from create_upload, and record it with finalize_upload.
+Released blobs' files are deleted in bulk by tasks.delete_blobs, and find_orphans catches any that were missed.
+"""
+import datetime
+import hashlib
+import itertools
+import re
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F, Q
+
+import magic
+from PIL import Image
+from boto.utils import parse_ts
+from easy_thumbnails.files import get_thumbnailer
+from easy_thumbnails.models import Source, Thumbnail
+from easy_thumbnails.utils import get_storage_hash
+
+from api import album_helper, db_helper, thumbnail_helper
+from api.models import Blob, Profile, Resource, protected_storage
+
+
+# Salt for signing the upload tokens handed out with presigned POSTs
+UPLOAD_SALT = 'api.media_helper.upload'
+# Keys per s3 multi-object delete request
+S3_DELETE_MAX = 1000
+BLOB_HASH = re.compile(r'^[0-9a-f]{40}$')
+UPLOAD_DIR = 'uploads/'
+# Blobs whose files are deleted per transaction, their hash locks are held through the s3 deletes
+BLOB_DELETE_CHUNK = 100
+# Advisory lock namespace for blob hashes, see lock_hashes
+HASH_LOCK = 1
+
+
+class MediaError(Exception):
+    pass
+
+
+def get_upload_name():
+    """
+    Temporary name for an upload, until analyze moves it to its hash
+    """
+    return UPLOAD_DIR + uuid.uuid4().hex
+
+
+def create_upload(user, album, content_type, size, file_name):
+    """
+    Presigned POST for uploading a file of at most size bytes straight to s3, with a token for finalize_upload
+    """
+    key = settings.MEDIA_ROOT + get_upload_name()
+    storage = protected_storage
+    form = storage.connection.build_post_form_args(
+        storage.bucket_name, key, expires_in=settings.UPLOAD_EXPIRES, acl='private', max_content_length=size,
+        http_method='https' if settings.AWS_S3_SECURE else 'http',
+        fields=[{'name': 'Content-Type', 'value': content_type}],
+        conditions=['{"Content-Type": "%s"}' % content_type])
+    url = form['action']
+    if settings.AWS_S3_HOST:
+        # Path style, boto only builds the url for bucket subdomains
+        url += storage.bucket_name + '/'
+    token = signing.dumps({'key': key, 'user': user.id, 'album': album.id, 'file_name': file_name}, salt=UPLOAD_SALT)
+    return {'url': url, 'fields': dict((field['name'], field['value']) for field in form['fields']),
+            'upload': token, 'expires': settings.UPLOAD_EXPIRES}
+
+
+def finalize_upload(user, token, caption=''):
+    """
+    Record the resource for a finished direct upload, finalizing twice returns the same resource
+    Returns the resource and whether it was created, raises MediaError if the token or upload isn't valid
+    """
+    try:
+        upload = signing.loads(token, salt=UPLOAD_SALT, max_age=settings.UPLOAD_FINALIZE_TIMEOUT)
+    except signing.BadSignature:
+        raise MediaError('Invalid or expired upload')
+    if upload['user'] != user.id:
+        raise MediaError('Invalid or expired upload')
+
+    if not album_helper.get_uploadable(user).filter(id=upload['album']).exists():
+        raise MediaError('Invalid or expired upload')
+    existing = list(Resource.objects.filter(upload=upload['key'])[:1])
+    if existing:
+        return existing[0], False
+    if protected_storage.bucket.get_key(upload['key']) is None:
+        raise MediaError('Upload not found')
+    # The unique upload key makes concurrent finalizes of the same upload agree on one resource,
+    # get_or_create gets the other's resource when its insert fails
+    return Resource.objects.get_or_create(upload=upload['key'], defaults={
+        'data': upload['key'], 'file_name': upload['file_name'], 'album_id': upload['album'], 'caption': caption,
+        'status': Resource.PENDING})
+
+
+def get_blob_name(hash):
+    return settings.MEDIA_ROOT + hash
+
+
+def lock_hashes(hashes):
+    """
+    Lock blob hashes until the transaction ends. Claiming, releasing and storing or deleting a blob's files
+    happen under its hash lock, so checking whether the blob exists and acting on its files can't interleave.
+    """
+    db_helper.lock_keys(HASH_LOCK, hashes)
+
+
+def claim_blob(hash):
+    """
+    Count a reference to the blob with this hash, returns None if there isn't one
+    The caller holds the hash lock
+    """
+    if Blob.objects.filter(hash=hash).update(reference_count=F('reference_count') + 1):
+        return Blob.objects.get(hash=hash)
+    return None
+
+
+def release_blob(blob_id):
+    """
+    Drop a reference to the blob, deleting it when nothing else uses it
+    Returns the hash of a deleted blob, whose files the caller should delete, otherwise None
+    """
+    hashes = list(Blob.objects.filter(id=blob_id).values_list('hash', flat=True))
+    if not hashes:
+        return None
+    with transaction.atomic():
+        lock_hashes(hashes)
+        Blob.objects.filter(id=blob_id, reference_count__gt=0).update(reference_count=F('reference_count') - 1)
+        unused = list(Blob.objects.select_for_update().filter(id=blob_id, reference_count=0))
+        if not unused:
+            return None
+        unused[0].delete()
+    return unused[0].hash
+
+
+def get_thumbnail_storage():
+    return get_thumbnailer(protected_storage, relative_name='').thumbnail_storage
+
+
+def get_blob_files(hashes):
+    """
+    Names of released blobs' bytes and thumbnails, skipping any whose bytes have been uploaded again since,
+    and drops their thumbnails from easy_thumbnails' cache. The caller holds the hash locks.
+    Returns a dict of hash to (name, thumbnail names), thumbnails are every alias whether or not it was rendered
+    """
+    hashes = set(hashes) - set(Blob.objects.filter(hash__in=hashes).values_list('hash', flat=True))
+    if not hashes:
+        return {}
+    files = dict((hash, (get_blob_name(hash), set())) for hash in hashes)
+    owners = dict((name, hash) for hash, (name, thumbnail_names) in files.iteritems())
+    sources = Source.objects.filter(storage_hash=get_storage_hash(protected_storage), name__in=owners.keys())
+    for name, thumbnail_name in Thumbnail.objects.filter(source__in=sources).values_list('source__name', 'name'):
+        files[owners[name]][1].add(thumbnail_name)
+    for name, thumbnail_names in files.itervalues():
+        for options, opaque_name, transparent_name in thumbnail_helper.get_jobs(get_thumbnailer(protected_storage, relative_name=name)):
+            thumbnail_names.update((opaque_name, transparent_name))
+    sources.delete()
+    return files
+
+
+def delete_blobs(hashes):
+    """
+    Delete released blobs' files and thumbnails, BLOB_DELETE_CHUNK blobs at a time while holding their hash locks,
+    so an upload of the same bytes waits for the delete and stores its file afterwards. Blobs that exist again are kept.
+    Returns the hashes whose files couldn't all be deleted
+    """
+    thumbnail_storage = get_thumbnail_storage()
+    failed = set()
+    for chunk in iter_chunks(sorted(set(hashes)), BLOB_DELETE_CHUNK):
+        with transaction.atomic():
+            lock_hashes(chunk)
+            files = get_blob_files(chunk)
+            names, thumbnail_names, owners = [], [], {}
+            for hash, (name, thumbnails) in files.iteritems():
+                names.append(name)
+                thumbnail_names.extend(thumbnails)
+                owners[name] = hash
+                owners.update((thumbnail_name, hash) for thumbnail_name in thumbnails)
+            failed.update(owners[name] for name in delete_files(protected_storage, names) +
+                          delete_files(thumbnail_storage, thumbnail_names))
+    return list(failed)
+
+
+def delete_files(storage, names):
+    """
+    Delete stored files, from s3 with a multi-object delete per S3_DELETE_MAX names
+    Returns the names that couldn't be deleted
+    """
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        for name in names:
+            storage.delete(name)
+        return []
+    failed = []
+    for i in range(0, len(names), S3_DELETE_MAX):
+        result = bucket.delete_keys(names[i:i + S3_DELETE_MAX], quiet=True)
+        failed.extend(error.key for error in result.errors)
+    return failed
+
+
+def list_names(bucket, prefix, cutoff, delimiter=''):
+    """
+    Names of the files under prefix last modified before cutoff, a delimiter leaves out subdirectories
+    """
+    return (key.name for key in bucket.list(prefix=prefix, delimiter=delimiter)
+            if hasattr(key, 'last_modified') and parse_ts(key.last_modified) < cutoff)
+
+
+def get_unused_uploads(names):
+    return set(names) - set(Resource.objects.filter(data__in=names).values_list('data', flat=True))
+
+
+def find_orphans(age):
+    """
+    Compare the bucket listing with the database for files no resource uses, left by failed cleanups, deletes
+    that raced an upload of the same bytes, and uploads that were never finalized or processed
+    Only files last modified longer than age ago are returned, so uploads still being processed are left alone
+    Returns (blob hashes, upload names)
+    """
+    cutoff = datetime.datetime.utcnow() - age
+    bucket = protected_storage.bucket
+    root = len(settings.MEDIA_ROOT)
+
+    hashes = []
+    orphan_uploads = []
+    # Blobs are directly under MEDIA_ROOT, the delimiter leaves out uploads and thumbnails
+    for names in iter_chunks(list_names(bucket, settings.MEDIA_ROOT, cutoff, delimiter='/'), S3_DELETE_MAX):
+        blob_names = [name for name in names if BLOB_HASH.match(name[root:])]
+        chunk = set(name[root:] for name in blob_names)
+        for hash, name in Resource.objects.filter(Q(hash__in=chunk) | Q(data__in=blob_names)).values_list('hash', 'data'):
+            chunk.discard(hash)
+            chunk.discard(name[root:])
+        chunk -= set(Blob.objects.filter(hash__in=chunk).values_list('hash', flat=True))
+        hashes.extend(chunk)
+    for names in iter_chunks(list_names(bucket, settings.MEDIA_ROOT + UPLOAD_DIR, cutoff), S3_DELETE_MAX):
+        orphan_uploads.extend(get_unused_uploads(names))
+    return hashes, orphan_uploads
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def find_blob(hash, content):
+    """
+    Whether a blob holds the bytes of an upload the client says has this hash, so the upload isn't stored again.
+    The upload is hashed to check, so knowing a hash doesn't grant access to a blob.
+    """
+    if not hash or not Blob.objects.filter(hash=hash).exists():
+        return False
+    hasher = hashlib.sha1()
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    content.seek(0)
+    return hasher.hexdigest() == hash
+
+
+def share_blob(hash):
+    """
+    Count a reference to the blob find_blob found, returns None if it has been deleted since
+    Call it in the transaction that saves the resource, so the reference is dropped if the save fails
+    """
+    lock_hashes([hash])
+    return claim_blob(hash)
+
+
+def copy_file(storage, old_name, name):
+    """
+    Copy a stored file, keeping the existing copy if another upload already has this name
+    """
+    if storage.exists(name):
+        return
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        # Copy within s3 rather than uploading the bytes again
+        bucket.copy_key(name, bucket.name, old_name)
+    else:
+        with storage.open(old_name) as content:
+            storage.save(name, File(content))
+
+
+def analyze(resource):
+    """
+    Read the upload once to sniff its content type, hash it and measure images, then move it to its hash name
+    Uploads of bytes that are already stored are dropped and share the existing blob
+    """
+    if resource.blob_id is not None:
+        # Matched an existing blob when it was uploaded
+        blob = resource.blob
+        resource.content_type, resource.width, resource.height = blob.content_type, blob.width, blob.height
+        resource.save(update_fields=['content_type', 'width', 'height', 'updated'])
+        return
+
+    hasher = hashlib.sha1()
+    head = ''
+    with tempfile.SpooledTemporaryFile(max_size=settings.RESOURCE_SPOOL_SIZE) as copy:
+        resource.data.open('rb')
+        try:
+            for chunk in resource.data.chunks():
+                if len(head) < 1024:
+                    head += chunk[:1024 - len(head)]
+                hasher.update(chunk)
+                copy.write(chunk)
+        finally:
+            resource.data.close()
+
+        resource.content_type = magic.from_buffer(head, mime=True)
+        if resource.content_type.split('/')[0] not in settings.CONTENT_TYPES:
+            raise MediaError('File type not supported: ' + resource.content_type)
+        if resource.content_type.startswith('image'):
+            copy.seek(0)
+            # Image.open only reads the header, the pixels aren't decoded
+            resource.width, resource.height = Image.open(copy).size
+
+    resource.hash = hasher.hexdigest()
+    name = get_blob_name(resource.hash)
+    storage = resource.data.storage
+    upload_name = resource.data.name
+    with transaction.atomic():
+        # Held until commit, so the blob can't be released and its files deleted between the claim and the save
+        lock_hashes([resource.hash])
+        resource.blob = claim_blob(resource.hash)
+        if resource.blob is None:
+            # The bytes are stored under the hash name before the blob exists, so a blob's file is always there
+            copy_file(storage, upload_name, name)
+            resource.blob = Blob.objects.create(hash=resource.hash, reference_count=1, content_type=resource.content_type,
+                                                width=resource.width, height=resource.height)
+        resource.data.name = name
+        resource.save(update_fields=['data', 'hash', 'content_type', 'width', 'height', 'blob', 'updated'])
+    if upload_name != name:
+        # Only once the resource points at the blob, a retry after a failure still finds the upload
+        storage.delete(upload_name)
+
+
+def thumbnail(resource):
+    """
+    Render the resource's thumbnail, once per blob
+    """
+    if not resource.content_type.startswith('image') or resource.blob.thumbnailed:
+        return
+    resource.create_thumbnail()
+    Blob.objects.filter(id=resource.blob_id).update(thumbnailed=True)
+
+
+def attach(resource):
+    """
+    Add the resource to its album, and make a first image the album's cover and the owner's portrait
+    """
+    album = resource.album
+    if album is None:
+        return
+    album.resources.add(resource)
+    if resource.content_type.startswith('image'):
+        if album.cover_id is None:
+            album.cover = resource
+            album.save()
+        if album.owner_id is not None:
+            profile = Profile.objects.get(owner=album.owner_id)
+            if profile.portrait_id is None:
+                profile.portrait = resource
+                profile.save()
+
+
+def set_status(resource_id, status):
+    return Resource.objects.filter(id=resource_id).update(status=status) > 0
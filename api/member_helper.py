@@ -0,0 +1,170 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from api.models import Event, EventMember, Friend, UserAttributeSet
+
+
+# Members of the event who checked in, paired with every other member who did, a row per direction
+MET_PAIRS_SQL = '''
+    FROM {member} owner_member
+    JOIN {member} user_member ON user_member.event_id = owner_member.event_id
+        AND user_member.user_id <> owner_member.user_id AND user_member.checked_in IS NOT NULL
+    WHERE owner_member.event_id = %(event)s AND owner_member.checked_in IS NOT NULL
+'''
+
+# Set last_met on friendships that already exist, unless they've since met at a later event
+UPDATE_MET_SQL = '''
+    UPDATE {friend} friend SET last_met_id = %(event)s, updated = %(now)s
+''' + MET_PAIRS_SQL + '''
+        AND friend.owner_id = owner_member.user_id AND friend.user_id = user_member.user_id
+        AND (friend.last_met_id IS NULL OR friend.last_met_id IN (
+            SELECT id FROM {event} WHERE start_date < %(start_date)s))
+    RETURNING friend.owner_id
+'''
+
+# Friend the rest, for members who automatically friend people they meet
+INSERT_MET_SQL = '''
+    INSERT INTO {friend} (owner_id, user_id, close, imported, last_met_id, created, updated)
+    SELECT owner_member.user_id, user_member.user_id, false, false, %(event)s, %(now)s, %(now)s
+''' + MET_PAIRS_SQL + '''
+        AND EXISTS (SELECT 1 FROM {attributes} attributes
+                    WHERE attributes.owner_id = owner_member.user_id AND attributes.friend_members)
+        AND NOT EXISTS (SELECT 1 FROM {friend} friend
+                        WHERE friend.owner_id = owner_member.user_id AND friend.user_id = user_member.user_id)
+    RETURNING owner_id
+'''
+
+
+def claim_seat(event_id):
+    """
+    Take one of the event's seats if any are left, with a single conditional UPDATE of the
+    accepted member counter, so concurrent joins can't overshoot max_members
+    """
+    return Event.objects.filter(id=event_id, accepted_count__lt=F('max_members')) \
+        .update(accepted_count=F('accepted_count') + 1) > 0
+
+
+def release_seat(event_id):
+    Event.objects.filter(id=event_id, accepted_count__gt=0).update(accepted_count=F('accepted_count') - 1)
+
+
+def add_member(event, user, status=EventMember.ACCEPTED):
+    """
+    Create a member, waitlisting them when the event is full
+    Raises IntegrityError if the user is already a member
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        if status == EventMember.ACCEPTED and not claim_seat(event.id):
+            return EventMember.objects.create(event=event, user=user, viewed_event=now,
+                                              status=EventMember.WAITLISTED, waitlisted=now)
+        return EventMember.objects.create(event=event, user=user, viewed_event=now, status=status)
+
+
+def accept_member(member):
+    """
+    Move a requested, invited or waitlisted member into a seat, or onto the waitlist when the event is full
+    Returns the member's new status
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Locks the member row, so accepting twice at once only claims one seat
+        accepted = EventMember.objects.filter(id=member.id).exclude(status=EventMember.ACCEPTED) \
+            .update(status=EventMember.ACCEPTED, updated=now)
+        if accepted and not claim_seat(member.event_id):
+            waitlisted = member.waitlisted if member.status == EventMember.WAITLISTED else now
+            EventMember.objects.filter(id=member.id).update(status=EventMember.WAITLISTED, waitlisted=waitlisted, updated=now)
+            member.status, member.waitlisted = EventMember.WAITLISTED, waitlisted
+        else:
+            member.status = EventMember.ACCEPTED
+    return member.status
+
+
+def remove_member(member):
+    """
+    Delete a member, giving their seat to the longest waiting member
+    Returns the promoted member, or None
+    """
+    with transaction.atomic():
+        statuses = list(EventMember.objects.select_for_update().filter(id=member.id).values_list('status', flat=True))
+        if not statuses:
+            return None
+        EventMember.objects.filter(id=member.id).delete()
+        if statuses[0] != EventMember.ACCEPTED:
+            return None
+        release_seat(member.event_id)
+    return promote(member.event_id)
+
+
+def decline_member(member):
+    """
+    Mark a member as declined, giving their seat to the longest waiting member in the same transaction
+    Returns the promoted member, or None
+    """
+    with transaction.atomic():
+        statuses = list(EventMember.objects.select_for_update().filter(id=member.id).values_list('status', flat=True))
+        if not statuses:
+            return None
+        EventMember.objects.filter(id=member.id).update(status=EventMember.DECLINED, updated=timezone.now())
+        member.status = EventMember.DECLINED
+        if statuses[0] != EventMember.ACCEPTED:
+            return None
+        release_seat(member.event_id)
+        return promote(member.event_id)
+
+
+def promote(event_id):
+    """
+    Give a free seat to the longest waiting member, returning them, or None if there is no seat or nobody waiting
+    """
+    for attempt in range(settings.PROMOTE_ATTEMPTS):
+        waiting = list(EventMember.objects.filter(event=event_id, status=EventMember.WAITLISTED)
+                       .order_by('waitlisted', 'id').values_list('id', flat=True)[:1])
+        if not waiting:
+            return None
+        with transaction.atomic():
+            if not claim_seat(event_id):
+                return None
+            if EventMember.objects.filter(id=waiting[0], status=EventMember.WAITLISTED) \
+                    .update(status=EventMember.ACCEPTED, updated=timezone.now()):
+                return EventMember.objects.select_related('event', 'user').get(id=waiting[0])
+            # They were promoted or left concurrently, give the seat back and look again
+            release_seat(event_id)
+    return None
+
+
+def promote_all(event_id):
+    """
+    Fill every free seat from the waitlist, returning the promoted members
+    """
+    promoted = []
+    member = promote(event_id)
+    while member is not None:
+        promoted.append(member)
+        member = promote(event_id)
+    return promoted
+
+
+def add_met_friends(event):
+    """
+    Add the members who checked in to an ended event to each other's friends, with one UPDATE of last_met
+    for existing friendships and one INSERT ... SELECT for new ones, however many members it had.
+    The event's added_friends flag is claimed in the same transaction, so a retried or overlapping run
+    doesn't add them again, and a failed one leaves the event for the next run.
+    Returns the ids of users whose friends changed, or None if the event's friends were already added
+    """
+    now = timezone.now()
+    tables = {'event': Event._meta.db_table, 'member': EventMember._meta.db_table, 'friend': Friend._meta.db_table,
+              'attributes': UserAttributeSet._meta.db_table}
+    params = {'event': event.id, 'start_date': event.start_date, 'now': now}
+    with transaction.atomic():
+        if not Event.objects.filter(id=event.id, added_friends=False).update(added_friends=True, updated=now):
+            return None
+        cursor = connection.cursor()
+        cursor.execute(UPDATE_MET_SQL.format(**tables), params)
+        owner_ids = set(row[0] for row in cursor.fetchall())
+        cursor.execute(INSERT_MET_SQL.format(**tables), params)
+        owner_ids.update(row[0] for row in cursor.fetchall())
+    return owner_ids
@@ -1,4 +1,5 @@
 from datetime import date
+from itertools import chain
 import json
 import logging
 import requests
@@ -14,33 +15,71 @@ from api.models import Device, UserAttributeSet
 
 logger = logging.getLogger('testlogger')
 
+GCM_URL = 'https://android.googleapis.com/gcm/send'
+# GCM accepts at most 1000 registration ids per multicast request
+GCM_MAX_RECIPIENTS = 1000
+
+
 # Push notifications
+def get_registration_ids(users):
+    """
+    Returns a dict mapping user ids to the GCM registration ids of their devices,
+    skipping users and devices with notifications turned off
+    """
+    devices = Device.objects.filter(owner__in=users, notifications=True, owner__userattributeset__notifications=True) \
+        .values_list('owner', 'gcm_reg_id')
+    registration_ids = {}
+    for owner_id, gcm_reg_id in devices:
+        registration_ids.setdefault(owner_id, []).append(gcm_reg_id)
+    return registration_ids
+
+
+def encode_gcm_data(data):
+    """
+    Converts GCM data to plain json types, so it can be passed to a celery task
+    """
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def send_gcm_multicast(registration_ids, data, session=None):
+    """
+    Sends GCM message, containing the specified data to each of the registration ids,
+    in as few requests as GCM allows
+    """
+    if session is None:
+        session = requests
+    request_headers = {'content-Type': 'application/json', 'Authorization': 'key=' + settings.GOOGLE_API_KEY}
+    for start in range(0, len(registration_ids), GCM_MAX_RECIPIENTS):
+        request_data = {'registration_ids': registration_ids[start:start + GCM_MAX_RECIPIENTS], 'data': data}
+        try:
+            r = session.post(GCM_URL, headers=request_headers, data=json.dumps(request_data, cls=DjangoJSONEncoder))
+            logger.info(r.text)
+        except requests.exceptions.RequestException as e:
+            logger.error(e)
+
+
 def send_gcm(users, data):
     """
     Sends GCM message, containing the specified data to each of the chosen user
     """
+    registration_ids = list(chain.from_iterable(get_registration_ids(users).values()))
+    send_gcm_multicast(registration_ids, data)
+
 
-    for user in users:
-        # Check global notification setting
-        user_attributes = UserAttributeSet.objects.get(owner=user)
-        if not user_attributes.notifications:
-            return
-    
-        devices = Device.objects.filter(owner=user)
-        print str(devices)
-        for device in devices:
-            
-            # Check device notification setting
-            if not device.notifications:
-                continue
-            gcm_reg_id = device.gcm_reg_id
-            request_headers = {'content-Type': 'application/json', 'Authorization': 'key=' + settings.GOOGLE_API_KEY}
-            request_data = {'registration_ids': [gcm_reg_id], 'data': data}
-            try:
-                r = requests.post('https://android.googleapis.com/gcm/send', headers=request_headers, data=json.dumps(request_data, cls=DjangoJSONEncoder))
-                logger.info(r.text)
-            except requests.exceptions.RequestException as e:
-                logger.error(e)
+def send_gcm_batch(messages):
+    """
+    Sends a batch of GCM messages, each a dict with a list of user ids in 'users' and the data to send in 'data'.
+    Devices for every recipient are looked up at once, and a single connection is reused for all requests.
+    """
+    users = set(chain.from_iterable(message['users'] for message in messages))
+    if not users:
+        return
+    registration_ids = get_registration_ids(users)
+    session = requests.Session()
+    for message in messages:
+        message_ids = list(chain.from_iterable(registration_ids.get(user, []) for user in message['users']))
+        if message_ids:
+            send_gcm_multicast(message_ids, message['data'], session=session)
 
 
 # Email
@@ -18,16 +18,18 @@ from django.utils import timezone
 from django.utils.http import urlquote, int_to_base36
 from django.utils.translation import ugettext_lazy as _
 
-import storages.backends.s3boto
+from api.storage import UniqueNameS3BotoStorage
 
 from PIL import Image
 from easy_thumbnails.fields import ThumbnailerField
 from easy_thumbnails.files import get_thumbnailer
 
 import social_helper
+import thumbnail_helper
 import utils
 
-protected_storage = storages.backends.s3boto.S3BotoStorage(
+# Resources are named by hash, so an upload of bytes that are already stored isn't sent again
+protected_storage = UniqueNameS3BotoStorage(
   acl='private',
   querystring_auth=True,
   querystring_expire=3600,
@@ -45,12 +47,32 @@ class Tag(models.Model):
         return self.name    
 
 
+class TagSourceMixin(object):
+    """
+    Mixin for models whose mentions and hash tags are pulled from one of their text fields.
+    Remembers the text as it was loaded, so saves that leave it unchanged can skip rebuilding them.
+    """
+    tag_source_field = None
+
+    def __init__(self, *args, **kwargs):
+        super(TagSourceMixin, self).__init__(*args, **kwargs)
+        self._tag_source = self.get_tag_source()
+
+    def get_tag_source(self):
+        # Read from __dict__ so a deferred field is not loaded
+        return self.__dict__.get(self.tag_source_field) or ''
+
+
 class HashTag(models.Model):
-    name = models.CharField(max_length=128)
+    name = models.CharField(max_length=128, unique=True) # Always lowercase
 
     def clean(self):
         self.name = self.name.lower()
 
+    def save(self, *args, **kwargs):
+        self.name = self.name.lower()
+        super(HashTag, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return '#' + self.name + ' (' + str(self.pk) + ')'  
     
@@ -59,9 +81,16 @@ class Mention(models.Model):
     name = models.CharField(max_length=64) # Name mentioned when this was last created or updated
     user = models.ForeignKey('User') # User that name referred to when created
 
+    class Meta:
+        unique_together = (('name', 'user'),)
+
     def clean(self):
         self.name = self.name.lower()
 
+    def save(self, *args, **kwargs):
+        self.name = self.name.lower()
+        super(Mention, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return '@' + self.name + ' (' + str(self.pk) + ')'  
 
@@ -142,8 +171,41 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.email + ' (' + str(self.pk) + ')'  
 
 
-class Resource(models.Model):
-    data = models.FileField(max_length=255, upload_to=settings.MEDIA_ROOT, storage=protected_storage, blank=True, null=True)
+class Blob(models.Model):
+    """
+    Stored bytes shared by every resource with the same hash, deleted when the last of them is
+    """
+    hash = models.CharField(max_length=40, unique=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    width = models.IntegerField(default=0, blank=True)
+    height = models.IntegerField(default=0, blank=True)
+    reference_count = models.IntegerField(default=0) # Resources using this blob, maintained by media_helper
+    thumbnailed = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.hash + ' (' + str(self.pk) + ')'
+
+
+def get_resource_path(instance, filename):
+    """
+    Keeps the directory of a resource's file name, FileField keeps only the base name of a plain upload_to
+    """
+    return settings.MEDIA_ROOT + filename
+
+
+class Resource(TagSourceMixin, models.Model):
+    PENDING = 'PENDING' # Upload stored, waiting for the ingestion pipeline
+    PROCESSING = 'PROCESSING'
+    READY = 'READY' # Hashed, measured, thumbnailed and added to its album
+    FAILED = 'FAILED'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+    data = models.FileField(max_length=255, upload_to=get_resource_path, storage=protected_storage, blank=True, null=True)
     content_type = models.CharField(max_length=255, blank=True)
     hash = models.CharField(max_length=40, blank=True)
     file_name = models.CharField(max_length=255, blank=True)
@@ -152,18 +214,35 @@ class Resource(models.Model):
     height = models.IntegerField(default=0, blank=True)
     duration = models.IntegerField(default=0, blank=True, help_text='duration in millisecs')
     caption = models.CharField(max_length=100, blank=True)
+    status = models.CharField(choices=STATUS_CHOICES, default=READY, max_length=20)
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.SET_NULL) # Set once the resource holds a reference
+    upload = models.CharField(max_length=255, unique=True, null=True, blank=True) # s3 key of a direct upload, see media_helper.finalize_upload
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
     # mentions and hashtags pulled from caption
     mentions = models.ManyToManyField(Mention, blank=True)
     hash_tags = models.ManyToManyField(HashTag, blank=True)
+    tag_source_field = 'caption'
 
 
     def create_thumbnail(self):
-        get_thumbnailer(self.data.storage, relative_name=self.data.name)['avatar']
+        # Every alias from one decode
+        thumbnail_helper.create_thumbnails(self.data.storage, self.data.name)
     
-    def get_thumbnail(self):
-        return get_thumbnailer(self.data.storage, relative_name=self.data.name)['avatar'].url
+    def get_thumbnail(self, alias='avatar'):
+        if self.status != self.READY:
+            # Not thumbnailed yet, and generating it here would block the request
+            return None
+        thumbnailer = get_thumbnailer(self.data.storage, relative_name=self.data.name)
+        if self.content_type == 'image/jpeg' and self.blob_id is not None and self.blob.thumbnailed:
+            # Every alias was rendered with the blob, and a JPEG's thumbnails are never transparent PNGs
+            return thumbnail_helper.get_url(thumbnailer, alias)
+        return thumbnailer[alias].url
+
+    def get_thumbnails(self):
+        if self.status != self.READY:
+            return None
+        return dict((alias, self.get_thumbnail(alias)) for alias in ('list', 'detail'))
         
     def build_hash(self, content, chunk_size=None):
         hasher = hashlib.sha1()
@@ -185,7 +264,7 @@ class Resource(models.Model):
         return self.hash + ' (' + str(self.pk) + ')'  
     
 
-class Profile(models.Model):
+class Profile(TagSourceMixin, models.Model):
     FEMALE = 'F'
     MALE = 'M'
     OTHER = 'O'
@@ -202,6 +281,7 @@ class Profile(models.Model):
     display_name = models.CharField(max_length=64, unique=True)
     default_language = models.CharField(max_length=2, default='en')
     languages = models.TextField() # Comma separated list of two-letter language codes
+    updated = models.DateTimeField(auto_now=True)
 
     # Optional fields
     about = models.TextField(blank=True, max_length=1024)
@@ -210,6 +290,7 @@ class Profile(models.Model):
     # mentions and hashtags pulled from about
     mentions = models.ManyToManyField(Mention, blank=True)
     hash_tags = models.ManyToManyField(HashTag, blank=True)
+    tag_source_field = 'about'
         
     def __unicode__(self):
         return self.display_name + ' (' + str(self.pk) + ')'
@@ -261,13 +342,14 @@ class UserAttributeSet(models.Model):
         return self.owner.email + ' (' + str(self.pk) + ')'
 
 
-class Comment(models.Model):
+class Comment(TagSourceMixin, models.Model):
     owner = models.ForeignKey(User, blank=True)
     message = models.CharField(max_length=160)
-    updated = models.DateTimeField(auto_now=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True)
     mentions = models.ManyToManyField(Mention, blank=True)
     hash_tags = models.ManyToManyField(HashTag, blank=True)
+    tag_source_field = 'message'
 
     def __unicode__(self):
         return self.message + ' (' + str(self.pk) + ')'
@@ -321,7 +403,7 @@ class Price(models.Model):
         return str(self.amount) + ' ' + self.currency_code + ' (' + str(self.pk) + ')'
     
     
-class Event(models.Model):
+class Event(TagSourceMixin, models.Model):
     OPEN = 'OPEN'
     OWNER_APPROVAL = 'OWNER_APPROVAL'
     INVITE_ONLY = 'INVITE_ONLY'
@@ -338,7 +420,7 @@ class Event(models.Model):
     # Required fields
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(User, related_name='event_owner', blank=True, null=True) # Null if imported
-    updated = models.DateTimeField(auto_now=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True)
     start_date = models.DateTimeField(null=False)
     price =  models.ForeignKey(Price, related_name='event_price')
@@ -353,6 +435,8 @@ class Event(models.Model):
     comments = models.ManyToManyField(Comment, related_name='event_comments', blank=True)
     members = models.ManyToManyField(User, through='EventMember', related_name='event_members', blank=True)
     max_members = models.IntegerField(blank=True, default=settings.MAX_MEMBERS)
+    # Members with ACCEPTED status, maintained by member_helper so seats are claimed without counting
+    accepted_count = models.IntegerField(default=0, blank=True)
     image = models.ForeignKey(Resource, null=True, blank=True, on_delete=models.SET_NULL)
     canceled = models.DateTimeField(null=True, blank=True) # If and when this event was canceled
 
@@ -364,6 +448,7 @@ class Event(models.Model):
     # Mentions and hashtags pulled from the description
     mentions = models.ManyToManyField(Mention, blank=True)
     hash_tags = models.ManyToManyField(HashTag, blank=True)
+    tag_source_field = 'description'
 
     # GeoDjango
     objects = models.GeoManager()
@@ -371,10 +456,12 @@ class Event(models.Model):
     CANCEL = 'CANCEL' # Event was canceled
     UPDATE = 'UPDATE' # Event was updated
     CHECKIN = 'CHECKIN' # Event starting, remind user to check in
+    PROMOTE = 'PROMOTE' # A seat opened up for a waitlisted member
     NOTIFICATION_TYPE = (
         (CANCEL, 'Cancel'),
         (UPDATE, 'Update'),
         (CHECKIN, 'Checkin'),
+        (PROMOTE, 'Promote'),
     )
     
     def build_gcm_data(self, type): 
@@ -457,11 +544,13 @@ class EventMember(models.Model):
     INVITED = 'INVITED' # Invited by member
     ACCEPTED = 'ACCEPTED' # Confirmed
     DECLINED = 'DECLINED'
+    WAITLISTED = 'WAITLISTED' # Event was full, accepted when a seat opens
     STATUS_CHOICES = (
         (REQUESTED, 'Requested'),
         (INVITED, 'Invited'),
         (ACCEPTED, 'Accepted'),
         (DECLINED, 'Declined'),
+        (WAITLISTED, 'Waitlisted'),
     )
     status = models.CharField(choices=STATUS_CHOICES, default=REQUESTED, max_length=50)
     event = models.ForeignKey(Event)
@@ -469,6 +558,8 @@ class EventMember(models.Model):
     viewed_event = models.DateTimeField()
     checked_in = models.DateTimeField(null=True, blank=True)
     invite = models.ForeignKey(EventInvite, null=True, blank=True)
+    waitlisted = models.DateTimeField(null=True, blank=True) # When they joined the waitlist, the earliest is promoted first
+    updated = models.DateTimeField(auto_now=True, db_index=True) # Last status change, for /sync/
     
     class Meta:
         unique_together = (('event', 'user'),)
@@ -491,6 +582,7 @@ class Album(models.Model):
     name = models.CharField(max_length=50, blank=True)
     owner = models.ForeignKey(User, null=True, blank=True)
     event = models.ForeignKey(Event, related_name='album_event', null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
     cover = models.ForeignKey(Resource, related_name="album_cover", null=True, blank=True, on_delete=models.SET_NULL)
     resources = models.ManyToManyField(Resource, related_name="album_resources", blank=True)
 
@@ -503,6 +595,7 @@ class Message(models.Model):
     receiver = models.ForeignKey(User, related_name="message_receiver")
     message = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     sent = models.DateTimeField(null=True, blank=True)
     opened = models.DateTimeField(null=True, blank=True)
     sender_deleted = models.BooleanField(default=False, blank=True)
@@ -534,7 +627,7 @@ class CurrencyConversionRate(models.Model):
     rate = models.DecimalField(max_digits=19, decimal_places=10)
 
 
-class Plan(models.Model):
+class Plan(TagSourceMixin, models.Model):
     owner = models.ForeignKey(User, blank=True)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
@@ -544,6 +637,7 @@ class Plan(models.Model):
     language = models.CharField(max_length=2, default='en')
     mentions = models.ManyToManyField(Mention, blank=True)
     hash_tags = models.ManyToManyField(HashTag, blank=True)
+    tag_source_field = 'text'
 
     # GeoDjango
     objects = models.GeoManager()
@@ -570,6 +664,17 @@ class Friend(models.Model):
     close = models.BooleanField(default=False) # Whether they are a close friend
     imported = models.BooleanField(default=False) # Whether the friend was imported from device contacts
     last_met = models.ForeignKey(Event, null=True, blank=True) # Where they last met
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __init__(self, *args, **kwargs):
+        super(Friend, self).__init__(*args, **kwargs)
+        # The owner and user as loaded, only a change to them changes the owner's leaderboards
+        self._loaded_users = self.get_users()
+
+    def get_users(self):
+        # Read from __dict__ so a deferred field is not loaded
+        return self.__dict__.get('owner_id'), self.__dict__.get('user_id')
     
     # TODO notify users when they're added as a friend ???
     def build_gcm_data(self):
@@ -588,6 +693,31 @@ class Friend(models.Model):
     def __unicode__(self):
         return self.user.profile.display_name + ' (' + str(self.pk) + ')'
 
+class Tombstone(models.Model):
+    """
+    Records a deleted object so clients calling /sync/ learn to drop their copy
+    """
+    EVENT = 'event'
+    MESSAGE = 'message'
+    FRIEND = 'friend'
+    COMMENT = 'comment'
+    MODEL_CHOICES = (
+        (EVENT, 'Event'),
+        (MESSAGE, 'Message'),
+        (FRIEND, 'Friend'),
+        (COMMENT, 'Comment'),
+    )
+    model = models.CharField(choices=MODEL_CHOICES, max_length=20)
+    object_id = models.IntegerField()
+    # Not foreign keys, tombstones outlive the users and events they were for
+    user = models.IntegerField(null=True, blank=True) # Whose copy was deleted
+    event = models.IntegerField(null=True, blank=True) # For comments, the event they were on
+    deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        index_together = (('user', 'model', 'deleted'), ('event', 'model', 'deleted'))
+
+
 class FitHistory(models.Model):
     UNKNOWN = 'UNKNOWN'
     STILL = 'STILL'
@@ -628,20 +758,40 @@ class FitHistory(models.Model):
         (DISTANCE, 'Distance'),
     )
 
-    updated = models.DateTimeField(auto_now=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     owner = models.ForeignKey(User, blank=False)
     period = models.CharField(choices=PERIOD_CHOICES, default=WEEK, max_length=50)
     activity = models.CharField(choices=ACTIVITY_CHOICES, default=UNKNOWN, max_length=50)
     activity_id = models.IntegerField(default=0, blank=False)
     
     field = models.CharField(max_length=50, blank=False) 
-    value = models.CharField(max_length=50, blank=False)
+    value = models.FloatField(blank=False)
     #units = models.CharField(max_length=50)    
     
+    class Meta:
+        unique_together = (('owner', 'period', 'activity', 'field'),)
+
     def __unicode__(self):
         return self.activity + ' ' + self.period + ' (' + str(self.pk) + ')'
 
 
+class FitRanking(models.Model):
+    """
+    A user's FitHistory value ranked among the viewer's friends, precomputed for leaderboards
+    """
+    viewer = models.ForeignKey(User, related_name='fitranking_viewer')
+    user = models.ForeignKey(User, related_name='fitranking_user')
+    period = models.CharField(choices=FitHistory.PERIOD_CHOICES, max_length=50)
+    activity = models.CharField(choices=FitHistory.ACTIVITY_CHOICES, max_length=50)
+    field = models.CharField(max_length=50)
+    value = models.FloatField()
+    rank = models.IntegerField()
+
+    class Meta:
+        unique_together = (('viewer', 'user', 'period', 'activity', 'field'),)
+        index_together = (('viewer', 'period', 'activity', 'field', 'rank'),)
+
+
 # TODO Fit data for an individual event
 #class FitEventData(models.Model):
 #    event = models.ForeignKey(Event, blank=False)
@@ -0,0 +1,117 @@
+import datetime
+import logging
+
+import redis
+
+from django.conf import settings
+from django.db.models import signals
+from django.dispatch.dispatcher import receiver
+from django.utils import timezone
+
+from api.models import Profile
+from api import redis_helper
+from api import utils
+
+
+logger = logging.getLogger(__name__)
+
+# Bloom filter of every lowercased display name in redis, so lookups for unused names never touch the database.
+# It's built by the rebuild_name_filter task, names saved since are added to it by every worker as they're saved
+FILTER_KEY = 'display_names:filter'
+# Profiles saved this long before a rebuild started are added again after it, in case they committed late
+REBUILD_OVERLAP = datetime.timedelta(minutes=1)
+
+
+def get_filter():
+    """
+    Returns the shared name filter, or None if redis is not configured
+    """
+    connection = redis_helper.get_connection()
+    if connection is None:
+        return None
+    return utils.RedisBloomFilter(connection, FILTER_KEY, settings.DISPLAY_NAME_FILTER_CAPACITY,
+                                  settings.DISPLAY_NAME_FILTER_ERROR_RATE)
+
+
+@receiver(signals.post_save, sender=Profile)
+def add_display_name(sender, instance, **kwargs):
+    name_filter = get_filter()
+    if name_filter is not None and instance.display_name:
+        try:
+            name_filter.add(instance.display_name.lower())
+        except redis.RedisError as e:
+            # Name checks may miss it until the next rebuild, validators still query the index
+            logger.error(e)
+
+
+def build_filter():
+    """
+    Load every display name into a new filter and replace the shared one with it, dropping names that were changed
+    Run by the rebuild_name_filter task, never inside a request
+    """
+    name_filter = get_filter()
+    if name_filter is None:
+        return
+    started = timezone.now()
+    bloom = utils.BloomFilter(settings.DISPLAY_NAME_FILTER_CAPACITY, settings.DISPLAY_NAME_FILTER_ERROR_RATE)
+    count = 0
+    for display_name in Profile.objects.values_list('display_name', flat=True).iterator():
+        bloom.add(display_name.lower())
+        count += 1
+    name_filter.store(bloom)
+    # Names saved while it was built were added to the filter it replaced
+    for display_name in Profile.objects.filter(updated__gte=started - REBUILD_OVERLAP) \
+            .values_list('display_name', flat=True):
+        name_filter.add(display_name.lower())
+    if count > settings.DISPLAY_NAME_FILTER_CAPACITY:
+        logger.warning('%d display names in a filter sized for %d, raise DISPLAY_NAME_FILTER_CAPACITY',
+                       count, settings.DISPLAY_NAME_FILTER_CAPACITY)
+
+
+def get_possible_names(names):
+    """
+    The lowercased names the filter can't rule out, all of them when there's no filter to check
+    """
+    names = set(name.lower() for name in names)
+    name_filter = get_filter()
+    if name_filter is None or not names:
+        return names
+    try:
+        return name_filter.get_present(names)
+    except redis.RedisError as e:
+        logger.error(e)
+        return names
+
+
+def filter_by_names(names):
+    """
+    Profiles whose display name matches one of the lowercased names, using the lower(display_name) index
+    """
+    names = list(names)
+    return Profile.objects.extra(where=['lower(display_name) IN (%s)' % ', '.join(['%s'] * len(names))],
+                                 params=names)
+
+
+def is_display_name_used(name, exclude_owner=None, use_filter=True):
+    """
+    Check if a profile other than exclude_owner's has this display name (case insensitive)
+    Validators pass use_filter=False, so a name the filter missed while redis was failing can't slip through
+    """
+    name = name.lower()
+    if use_filter and not get_possible_names([name]):
+        return False
+    profiles = filter_by_names([name])
+    if exclude_owner is not None:
+        profiles = profiles.exclude(owner=exclude_owner)
+    return profiles.exists()
+
+
+def get_owners(names):
+    """
+    Returns a dict of lowercased display name to owner id, for the names that belong to a profile
+    """
+    names = get_possible_names(names)
+    if not names:
+        return {}
+    return dict((display_name.lower(), owner) for display_name, owner in
+                filter_by_names(names).values_list('display_name', 'owner'))
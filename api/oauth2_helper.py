@@ -0,0 +1,94 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+from django.dispatch.dispatcher import receiver
+from django.utils import timezone
+
+from oauth2_provider.models import AccessToken, Application
+from oauth2_provider.oauth2_validators import OAuth2Validator
+
+from api.cache import is_shared
+
+
+def get_token_key(token):
+    return 'oauth2:token:%s' % hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+
+def get_client_key(client_id):
+    return 'oauth2:client:%s' % hashlib.sha1(client_id.encode('utf-8')).hexdigest()
+
+
+@receiver(signals.post_save, sender=AccessToken)
+@receiver(signals.post_delete, sender=AccessToken)
+def invalidate_token(sender, instance, **kwargs):
+    cache.delete(get_token_key(instance.token))
+
+
+@receiver(signals.post_save, sender=Application)
+@receiver(signals.post_delete, sender=Application)
+def invalidate_application(sender, instance, **kwargs):
+    cache.delete(get_client_key(instance.client_id))
+    tokens = AccessToken.objects.filter(application=instance).values_list('token', flat=True)
+    cache.delete_many([get_token_key(token) for token in tokens])
+
+
+def get_access_token(token):
+    """
+    Returns the access token with its application and user, from the cache when possible
+    Tokens are cached until they expire, but for no longer than OAUTH2_TOKEN_CACHE_TIMEOUT
+    so changes to a user made in another process are picked up
+    """
+    # A cache only this process sees would keep accepting tokens revoked in another process
+    shared = is_shared(cache)
+    key = get_token_key(token)
+    access_token = cache.get(key) if shared else None
+    if access_token is None:
+        try:
+            access_token = AccessToken.objects.select_related('application', 'user').get(token=token)
+        except AccessToken.DoesNotExist:
+            return None
+        timeout = min(int((access_token.expires - timezone.now()).total_seconds()),
+                      settings.OAUTH2_TOKEN_CACHE_TIMEOUT)
+        if shared and timeout > 0:
+            cache.set(key, access_token, timeout)
+    return access_token
+
+
+def is_valid_client(client_id, client_secret):
+    """
+    Check for an application with this id and secret
+    """
+    shared = is_shared(cache)
+    key = get_client_key(client_id)
+    secret = cache.get(key) if shared else None
+    if secret is None:
+        secrets = list(Application.objects.filter(client_id=client_id).values_list('client_secret', flat=True)[:1])
+        if not secrets:
+            return False
+        secret = secrets[0]
+        if shared:
+            cache.set(key, secret, settings.OAUTH2_CLIENT_CACHE_TIMEOUT)
+    return secret == client_secret
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """
+    Validates bearer tokens against the cache, so authenticated requests don't load the token,
+    application and user on every call
+    """
+    def validate_bearer_token(self, token, scopes, request):
+        if not token:
+            return False
+
+        access_token = get_access_token(token)
+        if access_token is None or not access_token.is_valid(scopes):
+            return False
+        request.client = access_token.application
+        request.user = access_token.user
+        request.scopes = scopes
+
+        # this is needed by django rest framework
+        request.access_token = access_token
+        return True
@@ -0,0 +1,155 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api.cache import is_shared
+
+
+# Keep-alive connections to the places api, shared by every request in this worker
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.PLACES_POOL_SIZE))
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.PLACES_POOL_SIZE))
+
+# Lookups in progress in this worker by cache key, so identical concurrent requests wait for the first
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class PlacesError(Exception):
+    pass
+
+
+class _Lookup(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def round_location(location):
+    """
+    Snap a "lat,lng" location to the PLACES_GRID, so nearby users share cache entries
+    """
+    if not location:
+        return None
+    try:
+        lat, lng = [float(value) for value in location.split(',')]
+    except ValueError:
+        return location
+    grid = settings.PLACES_GRID
+    return '%.4f,%.4f' % (round(lat / grid) * grid, round(lng / grid) * grid)
+
+
+def normalize(input, components=None, location=None, radius=None):
+    """
+    Returns the parameters to send for a lookup, with equivalent requests mapped to the same values
+    The input is sent as it was typed, matched_substrings refer to it, only its cache key ignores case and spacing
+    """
+    params = {'input': input}
+    if components:
+        params['components'] = '|'.join(sorted(set(c.strip().lower() for c in components.split('|') if c.strip())))
+    location = round_location(location)
+    if location:
+        params['location'] = location
+        if radius:
+            params['radius'] = int(radius)
+    return params
+
+
+def get_cache_key(params):
+    params = dict(params, input=' '.join(params['input'].lower().split()))
+    key = '|'.join('%s=%s' % (name, params[name]) for name in sorted(params))
+    return 'places:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def fetch(params):
+    """
+    Ask the places api, returning a (status, predictions) tuple
+    """
+    query = dict(params, sensor='false', key=settings.GOOGLE_API_KEY)
+    try:
+        r = session.get(settings.PLACES_AUTOCOMPLETE_URL, params=query, timeout=settings.PLACES_TIMEOUT)
+        json = r.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise PlacesError(str(e))
+    if not isinstance(json, dict) or not json.get('status'):
+        # An error page rather than an answer
+        return 'UNKNOWN_ERROR', []
+    return json['status'].upper(), json.get('predictions', [])
+
+
+def wait_for_other_process(key):
+    """
+    Poll for a result another worker is fetching, giving up after PLACES_TIMEOUT
+    """
+    deadline = time.time() + settings.PLACES_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(settings.PLACES_POLL_INTERVAL)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    return None
+
+
+def lookup(params):
+    key = get_cache_key(params)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    # Other workers can only be waited for through a cache they share, otherwise autocomplete's
+    # in-process coalescing is all there is
+    lock_key = key + ':lock' if is_shared(cache) else None
+    if lock_key is not None and not cache.add(lock_key, 1, settings.PLACES_TIMEOUT):
+        result = wait_for_other_process(key)
+        if result is not None:
+            return result
+    try:
+        result = fetch(params)
+        # Only cache answers, not quota or request errors
+        if result[0] in ('OK', 'ZERO_RESULTS'):
+            cache.set(key, result, settings.PLACES_CACHE_TIMEOUT)
+        return result
+    finally:
+        if lock_key is not None:
+            cache.delete(lock_key)
+
+
+def autocomplete(input, components=None, location=None, radius=None):
+    """
+    Returns a (status, predictions) tuple for the typed input, from the cache when possible
+    Concurrent identical lookups are coalesced into one call to the places api, within this worker,
+    and across workers when the cache is shared through redis
+    """
+    params = normalize(input, components, location, radius)
+    key = get_cache_key(params)
+    with _in_flight_lock:
+        pending = _in_flight.get(key)
+        leader = pending is None
+        if leader:
+            pending = _in_flight[key] = _Lookup()
+
+    if not leader:
+        pending.done.wait(settings.PLACES_TIMEOUT)
+        if pending.error is not None:
+            raise pending.error
+        if pending.result is not None:
+            return pending.result
+        return lookup(params)
+
+    try:
+        pending.result = lookup(params)
+        return pending.result
+    except PlacesError as e:
+        pending.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        pending.done.set()
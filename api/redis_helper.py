@@ -0,0 +1,16 @@
+import redis
+
+from django.conf import settings
+
+
+_connection = None
+
+
+def get_connection():
+    """
+    Returns the shared redis connection, or None if redis is not configured
+    """
+    global _connection
+    if _connection is None and settings.REDIS_URL:
+        _connection = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _connection
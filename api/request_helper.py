@@ -0,0 +1,101 @@
+import logging
+import urlparse
+
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+
+from rest_framework import status
+from rest_framework.views import APIView
+
+from api.models import Friend
+
+
+logger = logging.getLogger(__name__)
+
+# Conditional headers belong to the batch request, not to the requests inside it
+BATCH_EXCLUDED_HEADERS = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'CONTENT_TYPE', 'CONTENT_LENGTH')
+
+
+def get_request_cache(request):
+    """
+    Dict for memoizing lookups for the rest of the request, shared with the requests inside a batch request
+    """
+    request = getattr(request, '_request', request)
+    cache = getattr(request, '_request_cache', None)
+    if cache is None:
+        cache = request._request_cache = {}
+    return cache
+
+
+def memoize(request, key, func):
+    cache = get_request_cache(request)
+    if key not in cache:
+        cache[key] = func()
+    return cache[key]
+
+
+def get_friends(request):
+    """
+    Returns {user id: close} for the current user's friends, looked up once per request
+    """
+    user = request.user
+    return memoize(request, ('friends', user.pk),
+                   lambda: dict(Friend.objects.filter(owner=user).values_list('user', 'close')))
+
+
+def is_batch(request):
+    return getattr(getattr(request, '_request', request), '_in_batch', False)
+
+
+def build_request(request, path, query):
+    """
+    A GET request for path made as the already authenticated user of request
+    """
+    parent = getattr(request, '_request', request)
+    subrequest = HttpRequest()
+    subrequest.method = 'GET'
+    subrequest.path = subrequest.path_info = path
+    subrequest.META = dict((key, value) for key, value in parent.META.iteritems() if key not in BATCH_EXCLUDED_HEADERS)
+    subrequest.META.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query})
+    subrequest.GET = QueryDict(query)
+    subrequest.COOKIES = parent.COOKIES
+    subrequest.user = request.user
+    # Picked up by rest framework's Request, so the access token isn't validated again
+    subrequest._force_auth_user = request.user
+    subrequest._force_auth_token = request.auth
+    subrequest._request_cache = get_request_cache(request)
+    subrequest._in_batch = True
+    return subrequest
+
+
+def dispatch(request, url):
+    """
+    Run a GET for url inside request, returning {'path', 'status', 'body'}
+    """
+    url = urlparse.urlsplit(url)
+    result = {'path': url.path + ('?' + url.query if url.query else '')}
+    try:
+        match = resolve(url.path)
+    except Resolver404:
+        result.update(status=status.HTTP_404_NOT_FOUND, body={'detail': 'Not found'})
+        return result
+
+    view_class = getattr(match.func, 'cls', None)
+    if view_class is None or not issubclass(view_class, APIView):
+        # Admin, oauth and password reset views need middleware state a subrequest doesn't have,
+        # and have no json body to hand back
+        result.update(status=status.HTTP_400_BAD_REQUEST, body={'detail': 'Not an api endpoint'})
+        return result
+
+    try:
+        # A savepoint, so a database error in one request doesn't break the ones after it
+        with transaction.atomic():
+            response = match.func(build_request(request, url.path, url.query), *match.args, **match.kwargs)
+    except Exception:
+        # Only this request fails, not the whole batch
+        logger.exception('Batch request for %s failed', result['path'])
+        result.update(status=status.HTTP_500_INTERNAL_SERVER_ERROR, body={'detail': 'Server error'})
+        return result
+    result.update(status=response.status_code, body=response.data)
+    return result
@@ -0,0 +1,92 @@
+from collections import defaultdict
+
+from django.db.models import Count
+
+from api.models import Event, EventImport, EventMember, Friend, Plan, Profile
+
+
+# List fields served straight from the search document when a view is asked for ?projection=source
+EVENT_SOURCE_FIELDS = ('id', 'name', 'start_date', 'end_date', 'join_policy', 'max_members', 'language',
+                       'tags', 'location', 'currency_code', 'amount')
+PLAN_SOURCE_FIELDS = ('id', 'text', 'owner_name', 'language', 'location')
+PROFILE_SOURCE_FIELDS = ('id', 'gender', 'display_name', 'interests')
+
+SOURCE = 'source'
+
+
+def project(items, fields):
+    """
+    Keep only the list fields of search documents. Documents are read from _source whole, since fields
+    requested from elasticsearch come back as arrays
+    """
+    return [dict((field, item.get(field)) for field in fields) for item in items]
+
+
+def hydrate(queryset, items):
+    """
+    Load the objects for a page of search results with one query, in the order elasticsearch ranked them
+    Hits for objects deleted since they were indexed are dropped
+    """
+    ids = [int(item._id) for item in items]
+    objs = queryset.in_bulk(ids)
+    return [objs[id] for id in ids if id in objs]
+
+
+def hydrate_events(items):
+    queryset = Event.objects.select_related('owner__profile', 'price', 'location', 'image') \
+        .prefetch_related('tags', 'mentions', 'hash_tags')
+    return hydrate(queryset, items)
+
+
+def hydrate_plans(items):
+    queryset = Plan.objects.select_related('owner__profile__portrait', 'location') \
+        .prefetch_related('mentions', 'hash_tags')
+    return hydrate(queryset, items)
+
+
+def hydrate_profiles(items):
+    queryset = Profile.objects.select_related('owner', 'portrait') \
+        .prefetch_related('mentions', 'hash_tags')
+    return hydrate(queryset, items)
+
+
+def get_event_batch(events, user):
+    """
+    Everything EventSerializer would query per event, loaded for a whole page at once
+    """
+    ids = [event.id for event in events]
+    owners = set(event.owner_id for event in events if event.owner_id is not None)
+
+    accepted = defaultdict(set)
+    for event, member in EventMember.objects.filter(event__in=ids, status=EventMember.ACCEPTED) \
+            .values_list('event', 'user'):
+        accepted[event].add(member)
+    members = set().union(*accepted.values()) if accepted else set()
+    friends = dict(Friend.objects.filter(owner=user, user__in=members).values_list('user', 'close')) if members else {}
+
+    return {
+        'friend_counts': dict((event, sum(1 for u in users if friends.get(u) is False))
+                              for event, users in accepted.items()),
+        'close_friend_counts': dict((event, sum(1 for u in users if friends.get(u) is True))
+                                    for event, users in accepted.items()),
+        'current_user_members': dict((member.event_id, member) for member in
+                                     EventMember.objects.filter(event__in=ids, user=user)),
+        'sources': dict(EventImport.objects.filter(event__in=ids).values_list('event', 'source')),
+        'close_friend_owners': set(Friend.objects.filter(owner__in=owners, user=user, close=True)
+                                   .values_list('owner', flat=True)) if owners else set(),
+    }
+
+
+def get_profile_batch(profiles, user):
+    """
+    Everything ProfileSerializer would query per profile, loaded for a whole page at once
+    """
+    owners = [profile.owner_id for profile in profiles]
+    users = Friend.objects.exclude(close=False, imported=False).filter(owner=user).values_list('user', flat=True)
+    common = Friend.objects.exclude(close=False, imported=False, user=user) \
+        .filter(owner__in=owners, user__in=users) \
+        .values('owner').annotate(count=Count('id'))
+    return {
+        'friends': set(Friend.objects.filter(owner=user, user__in=owners).values_list('user', flat=True)),
+        'mutual_friend_counts': dict((row['owner'], row['count']) for row in common),
+    }
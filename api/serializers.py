@@ -10,14 +10,18 @@ from django.template.defaultfilters import filesizeformat
 
 from drf_extra_fields.geo_fields import PointField
 from rest_framework import serializers, pagination
-from oauth2_provider.models import Application
 
 import boto
 
-from fastfriends.serializers import ExtensibleModelSerializer
+from fastfriends.serializers import ExtensibleModelSerializer, SparseFieldsMixin
 from api.models import *
 from api.indexes import EventSearchFilter, PlanSearchFilter
+from api import album_helper
+from api import event_view_helper
 from api import google_plus
+from api import name_helper
+from api import oauth2_helper
+from api import request_helper
 from api import utils
 
 logger = logging.getLogger(__name__)
@@ -25,6 +29,7 @@ logger = logging.getLogger(__name__)
 class ResourceSerializer(serializers.ModelSerializer):
     url = serializers.Field('data.url')
     thumbnail = serializers.Field('get_thumbnail')
+    thumbnails = serializers.Field('get_thumbnails')
     
     def validate(self, attrs):
         """
@@ -44,7 +49,8 @@ class ResourceSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Resource
-        fields = ('id', 'content_type', 'hash', 'file_name', 'width', 'height', 'duration', 'album', 'url', 'thumbnail', 'data', 'caption')
+        fields = ('id', 'content_type', 'hash', 'file_name', 'width', 'height', 'duration', 'album', 'url', 'thumbnail', 'thumbnails', 'data', 'caption', 'status')
+        read_only_fields = ('status',)
         write_only_fields = ('data',)
 
 
@@ -52,6 +58,35 @@ class ResourceDeleteSerializer(serializers.Serializer):
     resources = serializers.Field(source='resources')
 
 
+class ResourceUploadSerializer(serializers.Serializer):
+    album = serializers.PrimaryKeyRelatedField(queryset=Album.objects.all())
+    content_type = serializers.RegexField(r'^[\w.+-]+/[\w.+-]+$', max_length=255)
+    size = serializers.IntegerField()
+    file_name = serializers.CharField(max_length=255, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(ResourceUploadSerializer, self).__init__(*args, **kwargs)
+        # Attaching an upload can set the album's cover and its owner's portrait
+        self.fields['album'].queryset = album_helper.get_uploadable(self.context['request'].user)
+
+    def validate_content_type(self, attrs, source):
+        value = attrs[source]
+        if value.split('/')[0] not in settings.CONTENT_TYPES:
+            raise serializers.ValidationError('File type not supported')
+        return attrs
+
+    def validate_size(self, attrs, source):
+        value = attrs[source]
+        if value <= 0 or value > settings.MAX_DIRECT_UPLOAD_SIZE:
+            raise serializers.ValidationError('Please keep filesize under %s' % filesizeformat(settings.MAX_DIRECT_UPLOAD_SIZE))
+        return attrs
+
+
+class ResourceFinalizeSerializer(serializers.Serializer):
+    upload = serializers.CharField()
+    caption = serializers.CharField(max_length=100, required=False)
+
+
 class ResourceCaptionSerializer(serializers.Serializer):
     caption = serializers.CharField(required=False)
 
@@ -86,12 +121,27 @@ class AlbumResourceSerializer(serializers.ModelSerializer):
 
     
 class AlbumSerializer(serializers.ModelSerializer):
-    resources = AlbumResourceSerializer(many=True)  
-    event_owner = serializers.Field('event.owner.id')  
+    """
+    Resources aren't nested, they're paged through /albums/<id>/resources/
+    """
+    event_owner = serializers.Field('event.owner_id')
+    cover_thumbnail = serializers.Field('cover.get_thumbnail')
+    resource_count = serializers.SerializerMethodField('get_resource_count')
+    last_updated = serializers.SerializerMethodField('get_last_updated')
+
+    def get_resource_count(self, obj):
+        # Annotated by album_helper, counted here for an album that was just saved
+        count = getattr(obj, 'resource_count', None)
+        return count if count is not None else obj.resources.count()
+
+    def get_last_updated(self, obj):
+        resources_updated = getattr(obj, 'resources_updated', None)
+        return max(obj.updated, resources_updated) if resources_updated is not None else obj.updated
     
     class Meta:
         model = Album
-        fields = ('id', 'name', 'owner', 'event', 'cover', 'resources', 'event_owner')
+        fields = ('id', 'name', 'owner', 'event', 'cover', 'cover_thumbnail', 'resource_count', 'last_updated',
+                  'event_owner')
         read_only_fields = ('id', 'name', 'owner', 'event')
 
 
@@ -123,7 +173,7 @@ class PriceSerializer(serializers.ModelSerializer):
         fields = ('currency_code', 'amount', 'converted_amount')
 
 
-class EventMemberSerializer(serializers.ModelSerializer):
+class EventMemberSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user_id = serializers.Field(source='user.id')
     display_name = serializers.Field(source='user.profile.display_name')
     portrait = serializers.Field(source='user.profile.portrait.get_thumbnail')
@@ -135,14 +185,10 @@ class EventMemberSerializer(serializers.ModelSerializer):
     close = serializers.SerializerMethodField('is_close_friend')
     
     def is_friend(self, obj):
-        request = self.context['request']
-        current_user = request.user
-        return Friend.objects.filter(owner=current_user, user=obj.user).exists()      
+        return obj.user_id in request_helper.get_friends(self.context['request'])
         
     def is_close_friend(self, obj):
-        request = self.context['request']
-        current_user = request.user
-        return Friend.objects.filter(owner=current_user, user=obj.user, close=True).exists()
+        return request_helper.get_friends(self.context['request']).get(obj.user_id, False)
     
     #TODO idea: if you meet someone often but don't mark as close are they a competitor/nemesis, or are you just lazy?
     def count_mutual_friends(self, obj):
@@ -243,7 +289,7 @@ class LocationSerializer(serializers.ModelSerializer):
         fields = ('name', 'point', 'sub_thoroughfare', 'thoroughfare', 'sub_locality', 'locality', 'sub_admin_area', 'admin_area', 'postal_code', 'locale')
 
 
-class EventSerializer(serializers.ModelSerializer):
+class EventSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     tags = serializers.SlugRelatedField(many=True, slug_field='name')  
     owner_name = serializers.Field(source='owner.profile.display_name')
     price = PriceSerializer(many=False)
@@ -261,6 +307,9 @@ class EventSerializer(serializers.ModelSerializer):
     friend_of_owner = serializers.SerializerMethodField('is_friend_of_owner')
     
     def is_friend_of_owner(self, obj):
+        batch = self.context.get('event_batch')
+        if batch is not None:
+            return obj.owner_id in batch['close_friend_owners']
         request = self.context['request']
         return Friend.objects.filter(owner=obj.owner, user=request.user, close=True).count() > 0
         
@@ -322,6 +371,10 @@ class EventSerializer(serializers.ModelSerializer):
         return attrs
 
     def get_source(self, obj):
+        batch = self.context.get('event_batch')
+        if batch is not None:
+            source = batch['sources'].get(obj.id)
+            return dict(EventImport.SOURCE_CHOICES)[source] if source is not None else None
         try:
             event_import = EventImport.objects.get(event=obj.id)
             return dict(EventImport.SOURCE_CHOICES)[event_import.source]
@@ -329,15 +382,21 @@ class EventSerializer(serializers.ModelSerializer):
             return None
             
     def get_member_count(self, obj):
-        return EventMember.objects.filter(event=obj, status=EventMember.ACCEPTED).count()
+        return obj.accepted_count
 
     def get_friend_count(self, obj):
+        batch = self.context.get('event_batch')
+        if batch is not None:
+            return batch['friend_counts'].get(obj.id, 0)
         request = self.context['request']
         users = EventMember.objects.filter(event=obj, status=EventMember.ACCEPTED).values_list('user', flat=True)
         friends = Friend.objects.filter(owner=request.user, user__in=users, close=False);
         return friends.count()
 
     def get_close_friend_count(self, obj):
+        batch = self.context.get('event_batch')
+        if batch is not None:
+            return batch['close_friend_counts'].get(obj.id, 0)
         request = self.context['request']
         users = EventMember.objects.filter(event=obj, status=EventMember.ACCEPTED).values_list('user', flat=True)
         close_friends = Friend.objects.filter(owner=request.user, user__in=users, close=True);
@@ -347,14 +406,29 @@ class EventSerializer(serializers.ModelSerializer):
         """
         return current user's associated EventMember, or null if they are not a member
         """
+        batch = self.context.get('event_batch')
+        if batch is not None:
+            member = batch['current_user_members'].get(obj.id)
+            if member is None:
+                return None
+            return EventMemberSerializer(member, context=dict(self.context, sparse_fields=False)).data
         request = self.context['request']
         current_user = request.user
         try:
-            member_serializer = EventMemberSerializer(EventMember.objects.get(event=obj, user=current_user), context=self.context)
+            member_serializer = EventMemberSerializer(EventMember.objects.get(event=obj, user=current_user),
+                                                      context=dict(self.context, sparse_fields=False))
             return member_serializer.data
         except EventMember.DoesNotExist:
             return None
         
+    def save_object(self, obj, **kwargs):
+        if isinstance(obj, Event) and obj.pk is not None and not kwargs.get('force_insert'):
+            # accepted_count only changes through member_helper's F() updates, so an edit doesn't write back
+            # the count loaded with the request over seats claimed since
+            kwargs['update_fields'] = [field.name for field in Event._meta.local_fields
+                                       if not field.primary_key and field.name != 'accepted_count']
+        super(EventSerializer, self).save_object(obj, **kwargs)
+
     class Meta:
         model = Event
         fields = ('id', 'name', 'owner', 'owner_name', 'created', 'updated', 'start_date', 'end_date', 
@@ -399,14 +473,15 @@ class EventListSerializer(serializers.ModelSerializer):
         return 'Meters'
 
     def is_modified(self, obj):
-        request = self.context['request']        
-        if EventMember.objects.filter(user=request.user, event=obj).count() > 0:
-            #Current user is a member of the event
-            member = EventMember.objects.get(user=request.user, event=obj)            
-            edited = obj.updated > member.viewed_event
-            new_comments = obj.comments.filter(updated__gt=member.viewed_event).count() > 0            
-            return edited or new_comments
-        return False
+        request = self.context['request']
+        try:
+            member = EventMember.objects.get(user=request.user, event=obj)
+        except EventMember.DoesNotExist:
+            return False
+        #Current user is a member of the event, recent views may still be buffered
+        viewed_event = event_view_helper.get_viewed_event(member)
+        edited = obj.updated > viewed_event
+        return edited or obj.comments.filter(updated__gt=viewed_event).exists()
 
     class Meta:
         model = Event
@@ -418,7 +493,7 @@ class EventPromoSerializer(serializers.Serializer):
     resource = serializers.Field()
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.Field(source='owner.id')
     portrait = serializers.Field(source='portrait.data.url')
     portrait_id = serializers.Field(source='portrait.id')
@@ -453,12 +528,15 @@ class ProfileSerializer(serializers.ModelSerializer):
         return 50
 
     def is_friend(self, obj):
-        request = self.context['request']
-        current_user = request.user
-        count = Friend.objects.filter(owner=current_user, user=obj.owner).count()
-        return count > 0
+        batch = self.context.get('profile_batch')
+        if batch is not None:
+            return obj.owner_id in batch['friends']
+        return obj.owner_id in request_helper.get_friends(self.context['request'])
         
     def count_mutual_friends(self, obj):
+        batch = self.context.get('profile_batch')
+        if batch is not None:
+            return batch['mutual_friend_counts'].get(obj.owner_id, 0)
         request = self.context['request']
         current_user = request.user
         users = Friend.objects.exclude(close=False, imported=False).filter(owner=current_user).values_list('user', flat=True)
@@ -499,9 +577,7 @@ class ProfileSerializer(serializers.ModelSerializer):
         current_user = request.user
 
         value = attrs[source]
-        profiles = Profile.objects.filter(display_name__iexact=value).exclude(owner=current_user)
-        
-        if profiles.count() > 0:
+        if name_helper.is_display_name_used(value, exclude_owner=current_user, use_filter=False):
             raise serializers.ValidationError('This display name is already in use.')
         return attrs
 
@@ -556,9 +632,7 @@ class UserCreateSerializer(ExtensibleModelSerializer):
         Check there is not another user's profile with this display name (case insensitive)
         """
         value = attrs[source]
-        profiles = Profile.objects.filter(display_name__iexact=value)
-        
-        if profiles.count() > 0:
+        if name_helper.is_display_name_used(value, use_filter=False):
             raise serializers.ValidationError('This display name is already in use.')
         return attrs        
         
@@ -596,11 +670,7 @@ class UserCreateSerializer(ExtensibleModelSerializer):
         client_id = attrs['client_id']
         client_secret = attrs['client_secret']
         
-        count = Application.objects.filter(client_id=client_id) \
-            .filter(client_secret=client_secret) \
-            .count()
-
-        if count < 1:
+        if not oauth2_helper.is_valid_client(client_id, client_secret):
             raise serializers.ValidationError('Invalid client id or secret')
         
         if 'password' not in attrs:
@@ -760,6 +830,24 @@ class SocialSignInSerializer(serializers.Serializer):
         except requests.exceptions.RequestException as e:
             serializers.ValidationError(str(e))
         
+class BatchSerializer(serializers.Serializer):
+    requests = serializers.WritableField()
+
+    def validate_requests(self, attrs, source):
+        """
+        Check requests is a short list of api paths
+        """
+        value = attrs[source]
+        if not isinstance(value, list) or not value:
+            raise serializers.ValidationError('requests must be a list of paths')
+        if len(value) > settings.BATCH_MAX_REQUESTS:
+            raise serializers.ValidationError('At most %d requests per batch' % settings.BATCH_MAX_REQUESTS)
+        for url in value:
+            if not isinstance(url, basestring) or not url.startswith('/'):
+                raise serializers.ValidationError('Invalid path: %s' % url)
+        return attrs
+
+
 class UserStatusSerializer(serializers.Serializer):
     id = serializers.Field(source='id')    
     is_active = serializers.Field(source='is_active')
@@ -820,7 +908,7 @@ class PaginatedFriendSerializer(pagination.PaginationSerializer):
         object_serializer_class = FriendSerializer
 
     
-class PlanSerializer(serializers.ModelSerializer):
+class PlanSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     location = LocationSerializer(many=False)
     owner_name = serializers.Field(source='owner.profile.display_name')
     owner_portrait = serializers.Field(source='owner.profile.portrait.get_thumbnail')
@@ -928,6 +1016,7 @@ class FriendSearchSerializer(serializers.Serializer):
     page = serializers.IntegerField(required=False)
     page_size = serializers.IntegerField(required=False)
     search = serializers.CharField(required=True)
+    suggest = serializers.BooleanField(required=False)
 
     
 class PasswordSerializer(serializers.Serializer):
@@ -959,11 +1048,7 @@ class ForgotPasswordSerializer(serializers.Serializer):
         client_id = attrs['client_id']
         client_secret = attrs['client_secret']
         
-        count = Application.objects.filter(client_id=client_id) \
-            .filter(client_secret=client_secret) \
-            .count()
-
-        if count < 1:
+        if not oauth2_helper.is_valid_client(client_id, client_secret):
             raise serializers.ValidationError('Invalid client id or secret')        
         return attrs
 
@@ -1017,11 +1102,7 @@ class CheckNameSerializer(serializers.Serializer):
         client_id = attrs['client_id']
         client_secret = attrs['client_secret']
         
-        count = Application.objects.filter(client_id=client_id) \
-            .filter(client_secret=client_secret) \
-            .count()
-
-        if count < 1:
+        if not oauth2_helper.is_valid_client(client_id, client_secret):
             raise serializers.ValidationError('Invalid client id or secret')        
         return attrs
 
@@ -1034,4 +1115,12 @@ class FitHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = FitHistory
         fields = ('id', 'owner', 'period', 'activity', 'field', 'value', 'updated')
-        read_only_fields = ('id', 'owner')
\ No newline at end of file
+        read_only_fields = ('id', 'owner')
+
+
+class FitRankingSerializer(serializers.ModelSerializer):
+    display_name = serializers.Field(source='user.profile.display_name')
+
+    class Meta:
+        model = FitRanking
+        fields = ('user', 'display_name', 'period', 'activity', 'field', 'value', 'rank')
@@ -0,0 +1,2 @@
+-- Case insensitive display name lookups and uniqueness
+CREATE UNIQUE INDEX api_profile_display_name_lower ON api_profile (lower(display_name));
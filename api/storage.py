@@ -2,8 +2,11 @@ from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 
+from boto.s3.connection import OrdinaryCallingFormat
+from storages.backends.s3boto import S3BotoStorage
 
-class UniqueNameFileStorage(FileSystemStorage):
+
+class UniqueNameMixin(object):
     """
     Store file only if another of the same name does not already exist.
     Useful when naming files by hash.
@@ -16,5 +19,27 @@ class UniqueNameFileStorage(FileSystemStorage):
         # if file exists, simply return the name
         if self.exists(name):
             return name
-        return super(UniqueNameFileStorage, self)._save(name, content)
-    
\ No newline at end of file
+        return super(UniqueNameMixin, self)._save(name, content)
+
+
+class UniqueNameFileStorage(UniqueNameMixin, FileSystemStorage):
+    pass
+
+
+class S3HostMixin(object):
+    """
+    Connect to settings.AWS_S3_HOST when it's set, an S3-compatible server other than AWS
+    """
+
+    @property
+    def connection(self):
+        if self._connection is None and settings.AWS_S3_HOST:
+            # Local servers don't have per-bucket subdomains
+            self._connection = self.connection_class(
+                self.access_key, self.secret_key, host=settings.AWS_S3_HOST, port=settings.AWS_S3_PORT,
+                is_secure=settings.AWS_S3_SECURE, calling_format=OrdinaryCallingFormat())
+        return super(S3HostMixin, self).connection
+
+
+class UniqueNameS3BotoStorage(S3HostMixin, UniqueNameMixin, S3BotoStorage):
+    pass
@@ -0,0 +1,100 @@
+"""
+Bus between the api and the stream server (scripts/stream_server.py), which pushes new messages and
+event comments to connected clients as server-sent events.
+
+The bus is Postgres LISTEN/NOTIFY, so a notification is delivered when the transaction that wrote
+the row commits, and never if it rolls back. With STREAM_BUS=local notifications go straight to the
+stream server over a localhost UDP socket instead, for development without a shared Postgres.
+"""
+import json
+import socket
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+import psycopg2
+import psycopg2.extensions
+
+
+POSTGRES = 'postgres'
+LOCAL = 'local'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD = 7999
+
+MESSAGE = 'message'
+COMMENT = 'comment'
+
+_local_socket = None
+
+
+def encode(type, data, users=(), events=()):
+    """
+    Notification for the stream server. Rows too large for a notification are sent as ids for the client to fetch
+    """
+    payload = json.dumps({'type': type, 'users': list(users), 'events': list(events), 'data': data}, cls=DjangoJSONEncoder)
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps({'type': type, 'users': list(users), 'events': list(events), 'data': {type: {'id': data[type]['id']}}})
+    return payload
+
+
+def publish(payload):
+    global _local_socket
+    if settings.STREAM_BUS == LOCAL:
+        if _local_socket is None:
+            _local_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _local_socket.sendto(payload, ('127.0.0.1', settings.STREAM_LOCAL_PORT))
+    else:
+        connection.cursor().execute('SELECT pg_notify(%s, %s)', [settings.STREAM_CHANNEL, payload])
+
+
+def publish_message(message):
+    publish(encode(MESSAGE, message.build_gcm_data(), users=[message.sender_id, message.receiver_id]))
+
+
+def publish_comment(comment, event):
+    publish(encode(COMMENT, comment.build_event_gcm_data(event), events=[event.id]))
+
+
+class PostgresBus(object):
+    """
+    Non-blocking LISTEN on the stream channel, for the stream server's poll loop
+    """
+    def __init__(self):
+        db = settings.DATABASES['default']
+        self.conn = psycopg2.connect(database=db['NAME'], user=db.get('USER') or None, password=db.get('PASSWORD') or None,
+                                     host=db.get('HOST') or None, port=db.get('PORT') or None)
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn.cursor().execute('LISTEN %s' % settings.STREAM_CHANNEL)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def read(self):
+        self.conn.poll()
+        payloads = []
+        while self.conn.notifies:
+            payloads.append(self.conn.notifies.pop(0).payload)
+        return payloads
+
+
+class LocalBus(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', settings.STREAM_LOCAL_PORT))
+        self.sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        payloads = []
+        while True:
+            try:
+                payloads.append(self.sock.recv(65535))
+            except socket.error:
+                return payloads
+
+
+def get_bus():
+    return LocalBus() if settings.STREAM_BUS == LOCAL else PostgresBus()
@@ -0,0 +1,116 @@
+"""
+Changes to a user's events, messages, friends and event comments since a watermark, for /sync/
+
+Each kind of object is returned as {'created': [...], 'updated': [...], 'deleted': [ids]}.
+Created means created after the watermark, clients should upsert both created and updated objects.
+Every query is on an indexed updated or deleted column, so a sync with nothing new is cheap.
+"""
+import calendar
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import Event, EventMember, Friend, Message, Tombstone
+
+
+# Member statuses that put an event on the user's attending list, only declined and removed members are sent deletes
+ATTENDING_STATUSES = (EventMember.ACCEPTED, EventMember.REQUESTED, EventMember.INVITED, EventMember.WAITLISTED)
+
+
+def issue_token(now):
+    """
+    Watermark handed to the client for its next sync, in milliseconds since the epoch
+    """
+    return str(calendar.timegm(now.utctimetuple()) * 1000 + now.microsecond // 1000)
+
+
+def parse_token(token):
+    """
+    Returns the time the token was issued, raises ValueError if it isn't a token
+    """
+    if not token.isdigit():
+        raise ValueError('Invalid sync token: ' + token)
+    return datetime.datetime.fromtimestamp(int(token) / 1000.0, timezone.utc)
+
+
+def is_expired(since):
+    """
+    Whether tombstones from then may have been pruned, so the client has to reload everything
+    """
+    return since < timezone.now() - settings.SYNC_TOMBSTONE_TTL
+
+
+def get_cutoff(since):
+    # Rows stamped just before the token was issued may not have been committed yet, look back a little
+    return since - settings.SYNC_OVERLAP
+
+
+def split(objects, since):
+    created, updated = [], []
+    for obj in objects:
+        (created if obj.created > since else updated).append(obj)
+    return created, updated
+
+
+def get_tombstones(since, model, **filters):
+    return set(Tombstone.objects.filter(model=model, deleted__gt=get_cutoff(since), **filters)
+               .values_list('object_id', flat=True))
+
+
+def get_attending_ids(user):
+    return list(EventMember.objects.filter(user=user, status__in=ATTENDING_STATUSES).values_list('event', flat=True))
+
+
+def get_event_changes(user, since, attending_ids):
+    """
+    Events that changed, or that the user joined, since the watermark. Events the user declined, left or
+    was removed from are deleted, including events deleted with their members.
+    """
+    cutoff = get_cutoff(since)
+    memberships = list(EventMember.objects.filter(user=user, updated__gt=cutoff).values_list('event', 'status'))
+    joined = [event for event, status in memberships if status in ATTENDING_STATUSES]
+    events = list(Event.objects.filter(id__in=attending_ids).filter(Q(updated__gt=cutoff) | Q(id__in=joined))
+                  .select_related('owner__profile', 'price', 'location', 'image').prefetch_related('tags'))
+    left = set(event for event, status in memberships if status not in ATTENDING_STATUSES)
+    deleted = (left | get_tombstones(since, Tombstone.EVENT, user=user.id)) - set(attending_ids)
+    created, updated = split(events, since)
+    return created, updated, sorted(deleted)
+
+
+def get_message_changes(user, since):
+    """
+    Messages to or from the user that changed since the watermark, messages the user deleted are deleted
+    """
+    messages = Message.objects.filter(Q(sender=user) | Q(receiver=user, sent__isnull=False),
+                                      updated__gt=get_cutoff(since)).select_related('sender__profile', 'receiver__profile')
+    visible, deleted = [], get_tombstones(since, Tombstone.MESSAGE, user=user.id)
+    for message in messages:
+        if (message.sender_id == user.id and message.sender_deleted) or \
+                (message.receiver_id == user.id and message.receiver_deleted):
+            deleted.add(message.id)
+        else:
+            visible.append(message)
+    created, updated = split(visible, since)
+    return created, updated, sorted(deleted)
+
+
+def get_friend_changes(user, since):
+    friends = Friend.objects.filter(owner=user, updated__gt=get_cutoff(since)).select_related('user__profile')
+    created, updated = split(friends, since)
+    return created, updated, sorted(get_tombstones(since, Tombstone.FRIEND, user=user.id))
+
+
+def get_comment_changes(since, attending_ids):
+    """
+    Comments on the user's attending events that changed since the watermark
+    Returns created and updated as (event id, comment) pairs
+    """
+    links = Event.comments.through.objects.filter(event__in=attending_ids, comment__updated__gt=get_cutoff(since)) \
+        .select_related('comment__owner__profile')
+    created, updated = [], []
+    for link in links:
+        (created if link.comment.created > since else updated).append((link.event_id, link.comment))
+    deleted = get_tombstones(since, Tombstone.COMMENT, event__in=attending_ids) if attending_ids else set()
+    return created, updated, sorted(deleted)
@@ -0,0 +1,154 @@
+import re
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import signals
+from django.dispatch.dispatcher import receiver
+
+from api.models import HashTag, Mention
+from api import db_helper
+from api import name_helper
+from api import utils
+
+
+MENTION_PATTERN = re.compile(settings.MENTION_REGEX[1:-1], flags=re.IGNORECASE)
+HASH_TAG_PATTERN = re.compile(settings.HASH_TAG_REGEX[1:-1], flags=re.IGNORECASE)
+
+# Ids of recently used hash tags by name, and mentions by (name, user id), shared by every request in this worker
+hash_tag_cache = utils.LRUCache(settings.TAG_CACHE_SIZE)
+mention_cache = utils.LRUCache(settings.TAG_CACHE_SIZE)
+
+
+@receiver(signals.post_save, sender=HashTag)
+def update_hash_tag_cache(sender, instance, created, **kwargs):
+    if not created:
+        # Renamed, the old name is unknown
+        hash_tag_cache.clear()
+
+
+@receiver(signals.post_delete, sender=HashTag)
+def delete_hash_tag_cache(sender, instance, **kwargs):
+    hash_tag_cache.delete(instance.name)
+
+
+@receiver(signals.post_save, sender=Mention)
+def update_mention_cache(sender, instance, created, **kwargs):
+    if not created:
+        mention_cache.clear()
+
+
+@receiver(signals.post_delete, sender=Mention)
+def delete_mention_cache(sender, instance, **kwargs):
+    mention_cache.delete((instance.name, instance.user_id))
+
+
+def extract_names(pattern, text):
+    return set(name.lower() for name in pattern.findall(text))
+
+
+def create_missing(model, objs):
+    """
+    Bulk inserts objs. If another request inserted some of them first, inserts the rest one at a time.
+    """
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                # Already created by someone else
+                pass
+
+
+def get_hash_tag_ids(names):
+    """
+    Returns ids of the hash tags with these names, creating any that don't exist yet
+    """
+    if not names:
+        return set()
+    hash_tags = hash_tag_cache.get_many(names)
+    missing = names - set(hash_tags)
+    if missing:
+        found = dict(HashTag.objects.filter(name__in=missing).values_list('name', 'id'))
+        new = missing - set(found)
+        if new:
+            create_missing(HashTag, [HashTag(name=name) for name in new])
+            # bulk_create doesn't set primary keys, so read the new hash tags back
+            found.update(HashTag.objects.filter(name__in=new).values_list('name', 'id'))
+        hash_tag_cache.set_many(found)
+        hash_tags.update(found)
+    return set(hash_tags.values())
+
+
+def get_mention_ids(names):
+    """
+    Returns ids of mentions for the names that belong to a profile, creating any that don't exist yet
+    """
+    if not names:
+        return set()
+    users = name_helper.get_owners(names)
+    if not users:
+        return set()
+    mentions = mention_cache.get_many(users.items())
+    missing = set(users.items()) - set(mentions)
+    if missing:
+        missing_names = [name for name, user in missing]
+        found = dict(((name, user), id) for name, user, id in
+                     Mention.objects.filter(name__in=missing_names).values_list('name', 'user', 'id')
+                     if (name, user) in missing)
+        new = missing - set(found)
+        if new:
+            create_missing(Mention, [Mention(name=name, user_id=user) for name, user in new])
+            # bulk_create doesn't set primary keys, so read the new mentions back
+            found.update(((name, user), id) for name, user, id in
+                         Mention.objects.filter(name__in=[name for name, user in new]).values_list('name', 'user', 'id')
+                         if (name, user) in new)
+        mention_cache.set_many(found)
+        mentions.update(found)
+    return set(mentions.values())
+
+
+def sync_related(manager, ids, created):
+    """
+    Adds and removes related objects so the manager refers to exactly the objects with these ids
+    """
+    current = set() if created else set(manager.values_list('id', flat=True))
+    removed = current - ids
+    if removed:
+        manager.remove(*removed)
+    added = ids - current
+    if added:
+        manager.add(*added)
+
+
+def sync_tags(obj, text, created):
+    """
+    One attempt, in its own savepoint so a failed attempt can be retried under the caller's transaction
+    """
+    with transaction.atomic():
+        sync_related(obj.mentions, get_mention_ids(extract_names(MENTION_PATTERN, text)), created)
+        sync_related(obj.hash_tags, get_hash_tag_ids(extract_names(HASH_TAG_PATTERN, text)), created)
+        # A deleted hash tag or mention only fails the through table's foreign key at commit,
+        # which is the caller's commit inside their transaction, so check it within this savepoint
+        db_helper.check_deferred_constraints()
+
+
+def update_tags(obj, created=False):
+    """
+    Updates the mentions and hash tags of an object to match the text they're pulled from.
+    Does nothing if the text has not changed since the object was loaded.
+    """
+    text = obj.get_tag_source()
+    if not created and text == obj._tag_source:
+        return
+    try:
+        sync_tags(obj, text, created)
+    except IntegrityError:
+        # A cached hash tag or mention was deleted by another worker, look them all up again
+        hash_tag_cache.clear()
+        mention_cache.clear()
+        sync_tags(obj, text, created)
+    obj._tag_source = text
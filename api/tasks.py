@@ -1,24 +1,28 @@
 import datetime
+from contextlib import contextmanager
 from dateutil import parser
 import importlib
 import json
-import magic
 import pytz
 import requests
+import threading
 
 from django.conf import settings
 from django.contrib.gis import geos
 from django.core.files.base import ContentFile
-from django.core.files.images import ImageFile
+from django.db import IntegrityError
 from django.db.models import Q, signals
 from django.dispatch.dispatcher import receiver
 from django.utils import timezone
 
-from celery import Celery
+from boto.exception import BotoClientError, BotoServerError
+from celery import Celery, chain
 from celery.utils.log import get_task_logger
 
-from api import currency_helper, indexes
-from api.models import Event, EventMember, EventImport, Friend, Plan, Profile, Location, Resource, Album, Price
+from api import currency_helper, db_helper, event_view_helper, fit_helper, indexes, media_helper, member_helper, \
+    name_helper, stream_helper
+from api.models import Event, EventMember, EventImport, Friend, Plan, Profile, Location, Resource, Album, Price, \
+    Comment, Message, Tombstone
 
 import message_helper
 
@@ -88,50 +92,277 @@ def update_indexes():
     indexes.update_profiles()
 
 
+@app.task(name='tasks.send_gcm_batch')
+def send_gcm_batch(messages):
+    """
+    Push a batch of GCM messages, each a dict of recipient user ids in 'users' and json encoded 'data'
+    """
+    message_helper.send_gcm_batch(messages)
+
+
+def process_resource(resource_id):
+    """
+    Queue ingestion of a new upload, its status goes from PENDING to READY, or FAILED if a step fails
+    """
+    chain(analyze_resource.si(resource_id), thumbnail_resource.si(resource_id), attach_resource.si(resource_id)) \
+        .apply_async(link_error=fail_resource.si(resource_id))
+
+
+def get_resource(resource_id):
+    try:
+        return Resource.objects.select_related('album', 'blob').get(id=resource_id)
+    except Resource.DoesNotExist:
+        # Deleted while it was being processed
+        return None
+
+
+@app.task(name='tasks.analyze_resource')
+def analyze_resource(resource_id):
+    if not media_helper.set_status(resource_id, Resource.PROCESSING):
+        return
+    media_helper.analyze(get_resource(resource_id))
+
+
+@app.task(name='tasks.thumbnail_resource')
+def thumbnail_resource(resource_id):
+    resource = get_resource(resource_id)
+    if resource is not None:
+        media_helper.thumbnail(resource)
+
+
+@app.task(name='tasks.attach_resource')
+def attach_resource(resource_id):
+    resource = get_resource(resource_id)
+    if resource is not None:
+        media_helper.attach(resource)
+        media_helper.set_status(resource_id, Resource.READY)
+
+
+# Storage cleanup being collected by batch_cleanup on this thread
+_cleanup = threading.local()
+
+
+@contextmanager
+def batch_cleanup():
+    """
+    Queue the storage cleanup of every resource deleted in the block as one task, instead of one per resource
+    """
+    _cleanup.batch = batch = {'hashes': [], 'names': []}
+    try:
+        yield
+    finally:
+        del _cleanup.batch
+        queue_cleanup(batch['hashes'], batch['names'])
+
+
+def queue_cleanup(hashes=(), names=()):
+    batch = getattr(_cleanup, 'batch', None)
+    if batch is not None:
+        batch['hashes'].extend(hashes)
+        batch['names'].extend(names)
+        return
+    if hashes:
+        delete_blobs.delay(list(hashes))
+    if names:
+        delete_files.delay(list(names))
+
+
+@receiver(signals.post_delete, sender=Resource)
+def release_resource(sender, instance, **kw):
+    if instance.blob_id is not None:
+        hash = media_helper.release_blob(instance.blob_id)
+        if hash is not None:
+            queue_cleanup(hashes=[hash])
+    elif instance.data and instance.data.name != media_helper.get_blob_name(instance.hash):
+        # Deleted before the pipeline moved its upload
+        queue_cleanup(names=[instance.data.name])
+
+
+@app.task(name='tasks.delete_blobs', bind=True, max_retries=settings.STORAGE_DELETE_RETRIES)
+def delete_blobs(self, hashes):
+    """
+    Delete released blobs' files and thumbnails, retrying any that fail with backoff
+    Each attempt checks again which blobs are unused, so bytes uploaded again in the meantime are kept
+    """
+    countdown = 60 * 2 ** self.request.retries
+    try:
+        hashes = media_helper.delete_blobs(hashes)
+    except (BotoClientError, BotoServerError, IOError) as e:
+        raise self.retry(exc=e, countdown=countdown)
+    if hashes:
+        logger.warning('Retrying delete of %d blobs' % len(hashes))
+        raise self.retry(args=[hashes], countdown=countdown)
+
+
+@app.task(name='tasks.delete_files', bind=True, max_retries=settings.STORAGE_DELETE_RETRIES)
+def delete_files(self, names):
+    """
+    Delete stored uploads with s3 multi-object deletes, retrying any that fail with backoff
+    """
+    countdown = 60 * 2 ** self.request.retries
+    try:
+        names = media_helper.delete_files(media_helper.protected_storage, names)
+    except (BotoClientError, BotoServerError, IOError) as e:
+        raise self.retry(exc=e, countdown=countdown)
+    if names:
+        logger.warning('Retrying delete of %d files' % len(names))
+        raise self.retry(args=[names], countdown=countdown)
+
+
+@app.task(name='tasks.reconcile_storage')
+def reconcile_storage():
+    """
+    Delete stored files no resource references, that cleanup missed or from direct uploads never finalized
+    """
+    hashes, uploads = media_helper.find_orphans(settings.STORAGE_ORPHAN_AGE)
+    for i in range(0, len(hashes), media_helper.S3_DELETE_MAX):
+        delete_blobs.delay(hashes[i:i + media_helper.S3_DELETE_MAX])
+    for i in range(0, len(uploads), media_helper.S3_DELETE_MAX):
+        delete_files.delay(uploads[i:i + media_helper.S3_DELETE_MAX])
+    logger.info('Reconciled storage, %d orphaned blobs and %d uploads' % (len(hashes), len(uploads)))
+
+
+@app.task(name='tasks.fail_resource')
+def fail_resource(resource_id):
+    logger.error('Processing failed for resource ' + str(resource_id))
+    media_helper.set_status(resource_id, Resource.FAILED)
+
+
 @app.task(name='tasks.notify_event_start')
 def notify_event_start():
     """
     Check for events starting in the next 30mins for which notifications
     have not yet been sent. Notify attendees and remind them to check in.
+    Due events are claimed with a single UPDATE, so an overrunning run can't notify them twice,
+    and all their notifications go to send_gcm_batch as one job.
     """
     logger.info("Start task: notify_event_start")
     now = timezone.now()
     checkin_start = now + datetime.timedelta(minutes=30)
+    event_ids = db_helper.update_returning(Event.objects.filter(notified_start=False, start_date__lt=checkin_start),
+                                           notified_start=True, updated=now)
+    members = {}
+    for event_id, user_id in EventMember.objects.filter(event__in=event_ids).values_list('event', 'user'):
+        members.setdefault(event_id, []).append(user_id)
     # Order by ascending start date so events starting first are notified first
-    events = Event.objects.filter(notified_start=False, start_date__lt=checkin_start).order_by('start_date')
-    for event in events:
-        # Notify each member of the event
-        users = event.members.all()
-        data = event.build_gcm_data(Event.CHECKIN)
-        message_helper.send_gcm(users, data)
-        # Mark that notification was sent
-        event.notified_start = True
-        event.save()
-    logger.info("End task: notify_event_start")
+    events = Event.objects.filter(id__in=members.keys()).select_related('owner__profile', 'location') \
+        .order_by('start_date')
+    messages = [{'users': members[event.id], 'data': message_helper.encode_gcm_data(event.build_gcm_data(Event.CHECKIN))}
+                for event in events]
+    if messages:
+        send_gcm_batch.delay(messages)
+    logger.info("End task: notify_event_start, notified " + str(len(messages)) + " events")
     
     
+@app.task(name='tasks.flush_event_views')
+def flush_event_views():
+    """
+    Write buffered event views to EventMember.viewed_event
+    """
+    count = event_view_helper.flush_views()
+    logger.info("Flushed event views for " + str(count) + " members")
+
+
+@app.task(name='tasks.rebuild_name_filter')
+def rebuild_name_filter():
+    name_helper.build_filter()
+
+
+@receiver(signals.post_save, sender=Friend)
+def update_friend_rankings(sender, instance, created, **kw):
+    # Toggling close or imported, or where they last met, leaves the leaderboards as they are
+    loaded, users = instance._loaded_users, instance.get_users()
+    if created or loaded != users:
+        viewer_ids = set([users[0], loaded[0]]) - set([None])
+        refresh_fit_rankings.delay(list(viewer_ids))
+    instance._loaded_users = users
+
+
+@receiver(signals.post_delete, sender=Friend)
+def delete_friend_rankings(sender, instance, **kw):
+    refresh_fit_rankings.delay([instance.owner_id])
+
+
+@app.task(name='tasks.refresh_fit_rankings')
+def refresh_fit_rankings(viewer_ids):
+    """
+    Recompute the fitness leaderboards seen by these users
+    """
+    for viewer_id in set(viewer_ids):
+        fit_helper.refresh_rankings(viewer_id)
+
+
+@receiver(signals.post_delete, sender=EventMember)
+def tombstone_member(sender, instance, **kw):
+    # Also sent for each member when an event is deleted
+    Tombstone.objects.create(model=Tombstone.EVENT, object_id=instance.event_id, user=instance.user_id)
+
+
+@receiver(signals.post_delete, sender=Message)
+def tombstone_message(sender, instance, **kw):
+    Tombstone.objects.bulk_create([Tombstone(model=Tombstone.MESSAGE, object_id=instance.id, user=user_id)
+                                   for user_id in set([instance.sender_id, instance.receiver_id])])
+
+
+@receiver(signals.post_delete, sender=Friend)
+def tombstone_friend(sender, instance, **kw):
+    Tombstone.objects.create(model=Tombstone.FRIEND, object_id=instance.id, user=instance.owner_id)
+
+
+@receiver(signals.pre_delete, sender=Comment)
+def tombstone_comment(sender, instance, **kw):
+    # pre_delete, the links to the comment's events are gone by post_delete
+    Tombstone.objects.bulk_create([Tombstone(model=Tombstone.COMMENT, object_id=instance.id, event=event_id)
+                                   for event_id in instance.event_comments.values_list('id', flat=True)])
+
+
+@receiver(signals.post_save, sender=Message)
+def stream_message(sender, instance, created, **kw):
+    if created and instance.sent is not None:
+        stream_helper.publish_message(instance)
+
+
+@receiver(signals.m2m_changed, sender=Event.comments.through)
+def stream_comments(sender, instance, action, reverse, pk_set, **kw):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        for event in Event.objects.filter(id__in=pk_set):
+            stream_helper.publish_comment(instance, event)
+    else:
+        for comment in Comment.objects.filter(id__in=pk_set).select_related('owner__profile'):
+            stream_helper.publish_comment(comment, instance)
+
+
+@app.task(name='tasks.prune_tombstones')
+def prune_tombstones():
+    """
+    Forget deletes older than any sync token still accepted
+    """
+    Tombstone.objects.filter(deleted__lt=timezone.now() - settings.SYNC_TOMBSTONE_TTL).delete()
+
+
 @app.task(name='tasks.update_friends')
 def update_friends():
     """
     Check for recently ended events. Attendees who've checked in 
-    are added to each others friend lists
+    are added to each others friend lists, an event at a time with set-based queries, see member_helper.add_met_friends
     """
     logger.info("Start task: update_friends")
     event_start = timezone.now() - settings.CHECKIN_PERIOD
-    # Order by descending start date so most recent event gets assigned to last_met field
     events = Event.objects.filter(Q(end_date__isnull=True, start_date__lt=event_start) | Q(end_date__lt=timezone.now())).exclude(added_friends=True).order_by('-start_date')    
     for event in events:
-        # Get members of event that've checked in and add them as acquaintances
-        members = event.eventmember_set.exclude(checked_in=None)                     
-        for member in members:
-            other_members = member.event.members.exclude(id=member.user.id)
-            for other in other_members:
-                if member.user.userattributeset.friend_members:
-                    Friend.objects.get_or_create(owner=member.user, user=other.user, last_met=member.event)        
-        # Mark that friends were added for this event
-        event.added_friends = True
-        event.save()
-        logger.info("Added friends for event: " + str(event))
+        try:
+            owner_ids = member_helper.add_met_friends(event)
+        except IntegrityError as e:
+            # Raced another event's run adding the same friends, it's retried next time
+            logger.error("Adding friends failed for event: " + str(event) + ", " + str(e))
+            continue
+        if owner_ids:
+            # The friends were inserted without post_save, so refresh their rankings here
+            refresh_fit_rankings.delay(list(owner_ids))
+        if owner_ids is not None:
+            logger.info("Added friends for event: " + str(event))
     logger.info("End task: update_friends")
       
       
@@ -208,15 +439,10 @@ def import_event(item):
             #print 'Retrieving image: ' + str(image_url)
             file_name = image_url.rsplit('/', 1)[1]
 
-            # Load image data
+            # Load image data, stored like an upload and shared, measured and thumbnailed by the pipeline
             image_response = requests.get(image_url)
-            content = image_response.content
-            file = ImageFile(ContentFile(content))
-            
-            content_type = magic.from_buffer(content, mime=True)
-            resource = Resource(file_name=file_name, content_type=content_type, album=album, width=file.width, height=file.height)        
-            resource.hash = resource.build_hash(file)
-            resource.data.save(resource.hash, file)
+            resource = Resource(file_name=file_name, album=album, status=Resource.PENDING)
+            resource.data.save(media_helper.get_upload_name(), ContentFile(image_response.content))
 
         # Associate image with album and save
         if resource:
@@ -226,6 +452,7 @@ def import_event(item):
             album.save()
             event.image = resource
             event.save()
+            process_resource(resource.id)
         print 'Imported Event: ' + str(event.name)
         return True
     except Exception, e:
@@ -0,0 +1,17 @@
+import datetime
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from api.album_helper import issue_cursor, parse_cursor
+from api.models import Resource
+
+
+class CursorTest(SimpleTestCase):
+    def test_round_trip_keeps_microseconds(self):
+        created = datetime.datetime(2014, 6, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        self.assertEqual(parse_cursor(issue_cursor(Resource(id=42, created=created))), (created, 42))
+
+    def test_rejects_garbage(self):
+        self.assertRaises(ValueError, parse_cursor, '12_abc')
+        self.assertRaises(ValueError, parse_cursor, '1234')
@@ -0,0 +1,68 @@
+from django.conf.urls import patterns, url
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api import request_helper
+
+
+class EventsView(APIView):
+    permission_classes = ()
+
+    def get(self, request):
+        return Response({'events': []})
+
+
+class FailingView(APIView):
+    permission_classes = ()
+
+    def get(self, request):
+        raise ValueError('Failed')
+
+
+def admin_view(request):
+    raise AssertionError('Only api views are run in a batch')
+
+
+urlpatterns = patterns('',
+    url(r'^events/$', EventsView.as_view()),
+    url(r'^failing/$', FailingView.as_view()),
+    url(r'^admin/$', admin_view),
+)
+
+
+class BatchRequestTest(SimpleTestCase):
+    def setUp(self):
+        request = RequestFactory().post('/batch/', HTTP_IF_NONE_MATCH='"abc"')
+        request._force_auth_user = User(id=1)
+        request._force_auth_token = 'token'
+        self.request = Request(request)
+
+    def test_subrequest_reuses_authentication(self):
+        subrequest = Request(request_helper.build_request(self.request, '/events/', 'category=ATTENDING'))
+        self.assertEqual(subrequest.user, self.request.user)
+        self.assertEqual(subrequest.auth, 'token')
+        self.assertEqual(subrequest.QUERY_PARAMS['category'], 'ATTENDING')
+        self.assertNotIn('HTTP_IF_NONE_MATCH', subrequest.META)
+        self.assertTrue(request_helper.is_batch(subrequest))
+
+    def test_subrequests_share_cache(self):
+        subrequest = request_helper.build_request(self.request, '/friends/', '')
+        request_helper.memoize(subrequest, 'key', lambda: 1)
+        self.assertEqual(request_helper.memoize(self.request, 'key', lambda: 2), 1)
+
+    @override_settings(ROOT_URLCONF='api.tests.test_batch')
+    def test_dispatch_runs_api_views_only(self):
+        self.assertEqual(request_helper.dispatch(self.request, '/admin/')['status'], 400)
+
+    @override_settings(ROOT_URLCONF='api.tests.test_batch')
+    def test_failed_request_fails_alone(self):
+        failed = request_helper.dispatch(self.request, '/failing/')
+        self.assertEqual(failed['status'], 500)
+        events = request_helper.dispatch(self.request, '/events/?page=2')
+        self.assertEqual(events, {'path': '/events/?page=2', 'status': 200, 'body': {'events': []}})
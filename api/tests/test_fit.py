@@ -0,0 +1,11 @@
+from django.test import SimpleTestCase
+
+from api.fit_helper import rank
+
+
+class RankTest(SimpleTestCase):
+    def test_highest_value_ranks_first(self):
+        self.assertEqual(list(rank([1.5, 9.0, 3.0])), [3, 1, 2])
+
+    def test_ties_share_a_rank(self):
+        self.assertEqual(list(rank([5, 9, 5, 1])), [2, 1, 2, 4])
@@ -0,0 +1,71 @@
+import datetime
+
+from django.conf import settings
+from django.test import TestCase
+
+from api import media_helper
+from api.models import Blob, Resource
+
+
+OLD = '2014-01-01T00:00:00.000Z'
+
+
+class FakeKey(object):
+    def __init__(self, name, last_modified=None):
+        self.name = name
+        if last_modified is not None:
+            self.last_modified = last_modified
+
+
+class FakeBucket(object):
+    """
+    Lists names like boto, with a delimiter a subdirectory is one prefix without last_modified
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def list(self, prefix='', delimiter=''):
+        prefixes = set()
+        for name, last_modified in sorted(self.names.iteritems()):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+            else:
+                yield FakeKey(name, last_modified)
+        for name in sorted(prefixes):
+            yield FakeKey(name)
+
+
+class FakeStorage(object):
+    def __init__(self, names):
+        self.bucket = FakeBucket(names)
+
+
+class FindOrphansTest(TestCase):
+    def setUp(self):
+        self.storage = media_helper.protected_storage
+
+    def tearDown(self):
+        media_helper.protected_storage = self.storage
+
+    def test_finds_unused_blobs_and_uploads(self):
+        root = settings.MEDIA_ROOT
+        recent = (datetime.datetime.utcnow() - datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        used_blob, unused_blob = 'a' * 40, 'b' * 40
+        used_upload, unused_upload = root + 'uploads/' + 'c' * 32, root + 'uploads/' + 'd' * 32
+        media_helper.protected_storage = FakeStorage({
+            root + used_blob: OLD, root + unused_blob: OLD, root + 'f' * 40: recent,
+            used_upload: OLD, unused_upload: OLD, root + 'uploads/' + '0' * 32: recent,
+            root + 'thumbs/' + 'b' * 40 + '.jpg': OLD})
+        Blob.objects.create(hash=used_blob, reference_count=1)
+        Resource.objects.create(data=used_upload)
+
+        hashes, uploads = media_helper.find_orphans(datetime.timedelta(days=2))
+        self.assertEqual(hashes, [unused_blob])
+        self.assertEqual(uploads, [unused_upload])
+
+    def test_uploads_keep_their_directory(self):
+        name = media_helper.get_upload_name()
+        self.assertEqual(Resource._meta.get_field('data').generate_filename(None, name), settings.MEDIA_ROOT + name)
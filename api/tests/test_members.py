@@ -0,0 +1,29 @@
+from django.test import TestCase
+from django.utils import timezone
+
+from api import member_helper
+from api.models import Event, EventMember, Location, Price, User
+
+
+class DeclineMemberTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner@example.com')
+        price = Price.objects.create(currency_code='USD', amount=0, converted_amount=0)
+        self.event = Event.objects.create(name='Run', owner=owner, start_date=timezone.now(), max_members=2,
+                                          price=price, location=Location.objects.create())
+        member_helper.add_member(self.event, owner)
+        self.accepted = member_helper.add_member(self.event, User.objects.create_user('accepted@example.com'))
+        self.waiting = member_helper.add_member(self.event, User.objects.create_user('waiting@example.com'))
+
+    def test_decline_gives_seat_to_waitlist(self):
+        self.assertEqual(self.waiting.status, EventMember.WAITLISTED)
+        promoted = member_helper.decline_member(self.accepted)
+        self.assertEqual(promoted.id, self.waiting.id)
+        self.assertEqual(EventMember.objects.get(id=self.accepted.id).status, EventMember.DECLINED)
+        self.assertEqual(EventMember.objects.get(id=self.waiting.id).status, EventMember.ACCEPTED)
+        self.assertEqual(Event.objects.get(id=self.event.id).accepted_count, 2)
+
+    def test_decline_without_seat_keeps_count(self):
+        self.assertIsNone(member_helper.decline_member(self.waiting))
+        self.assertEqual(EventMember.objects.get(id=self.waiting.id).status, EventMember.DECLINED)
+        self.assertEqual(Event.objects.get(id=self.event.id).accepted_count, 2)
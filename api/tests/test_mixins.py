@@ -0,0 +1,74 @@
+import datetime
+
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+from django.utils.http import http_date
+
+from fastfriends.mixins import ConditionalGetMixin
+
+
+UPDATED = datetime.datetime(2014, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeQuerySet(object):
+    def __init__(self, values):
+        self.values = values
+
+    def order_by(self, *fields):
+        return self
+
+    def aggregate(self, **aggregates):
+        return self.values
+
+
+class FakeUser(object):
+    pk = 1
+
+
+class ExampleView(ConditionalGetMixin):
+    def __init__(self, state=()):
+        self.state = state
+
+    def get_validator_state(self, queryset):
+        return self.state
+
+
+def make_view(state=(), **headers):
+    view = ExampleView(state)
+    view.request = RequestFactory().get('/events/', **headers)
+    view.request.user = FakeUser()
+    return view
+
+
+def get_etag(state=()):
+    view = make_view(state)
+    view.check_not_modified(FakeQuerySet({'last_modified': UPDATED, 'count': 2}))
+    return view._validators[0]
+
+
+class ConditionalGetTest(SimpleTestCase):
+    def setUp(self):
+        self.queryset = FakeQuerySet({'last_modified': UPDATED, 'count': 2})
+
+    def test_matching_etag_is_not_modified(self):
+        response = make_view(HTTP_IF_NONE_MATCH=get_etag()).check_not_modified(self.queryset)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], get_etag())
+
+    def test_other_etag_is_modified(self):
+        view = make_view(HTTP_IF_NONE_MATCH='"stale"')
+        self.assertIsNone(view.check_not_modified(self.queryset))
+        self.assertEqual(view._validators[0], get_etag())
+
+    def test_viewer_state_changes_etag(self):
+        view = make_view(state=('friends', 3), HTTP_IF_NONE_MATCH=get_etag())
+        self.assertIsNone(view.check_not_modified(self.queryset))
+
+    def test_modified_since_without_state(self):
+        response = make_view(HTTP_IF_MODIFIED_SINCE=http_date(1401624000)).check_not_modified(self.queryset)
+        self.assertEqual(response.status_code, 304)
+
+    def test_modified_since_ignored_with_state(self):
+        view = make_view(state=('friends', 3), HTTP_IF_MODIFIED_SINCE=http_date(1401624000))
+        self.assertIsNone(view.check_not_modified(self.queryset))
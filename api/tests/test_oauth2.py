@@ -0,0 +1,67 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+from django.utils import timezone
+
+from oauth2_provider.models import AccessToken, Application
+
+from api import oauth2_helper
+from api.cache import RedisCache
+
+
+class FakeRedis(object):
+    """
+    The commands RedisCache uses, on a dict that clients of the same server share
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def make_cache(data):
+    cache = RedisCache('redis://localhost:6379/0', {})
+    cache._client = FakeRedis(data)
+    return cache
+
+
+class SharedTokenCacheTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='user')
+        application = Application.objects.create(user=user, client_type=Application.CLIENT_CONFIDENTIAL,
+                                                 authorization_grant_type=Application.GRANT_PASSWORD)
+        self.access_token = AccessToken.objects.create(user=user, application=application, token='token', scope='read',
+                                                       expires=timezone.now() + datetime.timedelta(hours=1))
+        self.cache = oauth2_helper.cache
+
+    def tearDown(self):
+        oauth2_helper.cache = self.cache
+
+    def test_revoked_in_another_process(self):
+        server = {}
+        process_a, process_b = make_cache(server), make_cache(server)
+        oauth2_helper.cache = process_a
+        self.assertEqual(oauth2_helper.get_access_token('token'), self.access_token)
+        self.assertIsNotNone(process_a.get(oauth2_helper.get_token_key('token')))
+        oauth2_helper.cache = process_b
+        self.access_token.delete()
+        oauth2_helper.cache = process_a
+        self.assertIsNone(oauth2_helper.get_access_token('token'))
+
+    def test_per_process_cache_is_not_used(self):
+        oauth2_helper.cache = LocMemCache('oauth2', {})
+        oauth2_helper.get_access_token('token')
+        self.assertIsNone(oauth2_helper.cache.get(oauth2_helper.get_token_key('token')))
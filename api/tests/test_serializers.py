@@ -0,0 +1,33 @@
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+
+from rest_framework import serializers
+from rest_framework.request import Request
+
+from fastfriends.serializers import SparseFieldsMixin
+
+
+class ExampleSerializer(SparseFieldsMixin, serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    count = serializers.SerializerMethodField('get_count')
+
+    def get_count(self, obj):
+        raise AssertionError('count should not be computed')
+
+
+class SparseFieldsTest(SimpleTestCase):
+    def serialize(self, query, **context):
+        request = Request(RequestFactory().get('/', query))
+        context['request'] = request
+        return ExampleSerializer({'id': 1, 'name': 'a'}, context=context)
+
+    def test_fields_keeps_only_listed_and_id(self):
+        self.assertEqual(self.serialize({'fields': 'name'}).data, {'id': 1, 'name': 'a'})
+
+    def test_exclude_skips_method_field(self):
+        self.assertEqual(self.serialize({'exclude': 'count'}).data, {'id': 1, 'name': 'a'})
+
+    def test_nested_serializers_can_opt_out(self):
+        serializer = self.serialize({'fields': 'name'}, sparse_fields=False)
+        self.assertEqual(set(serializer.fields.keys()), set(['id', 'name', 'count']))
@@ -0,0 +1,16 @@
+from django.test import SimpleTestCase
+
+from api.thumbnail_helper import get_draft_size
+
+
+class DraftSizeTest(SimpleTestCase):
+    def test_covers_largest_thumbnail(self):
+        options = [{'size': (256, 256), 'crop': True}, {'size': (1280, 1280)}]
+        self.assertEqual(get_draft_size((3264, 2448), options), (1280, 960))
+
+    def test_crop_fills_box(self):
+        self.assertEqual(get_draft_size((4000, 2000), [{'size': (400, 400), 'crop': True}]), (800, 400))
+
+    def test_upscaled_decodes_full_size(self):
+        options = [{'size': (256, 256), 'crop': True, 'upscale': True}]
+        self.assertEqual(get_draft_size((200, 100), options), (200, 100))
@@ -0,0 +1,46 @@
+from django.test import SimpleTestCase
+
+from api.utils import BloomFilter, LRUCache
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_get_many_returns_cached_keys_only(self):
+        cache = LRUCache(10)
+        cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(cache.get_many(['a', 'c']), {'a': 1})
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(10)
+        cache.set_many({'a': 1, 'b': 2})
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class BloomFilterTest(SimpleTestCase):
+    def test_added_items_are_present(self):
+        bloom = BloomFilter(100)
+        names = [u'name%d' % i for i in range(100)]
+        for name in names:
+            bloom.add(name)
+        for name in names:
+            self.assertIn(name, bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('added%d' % i)
+        false_positives = sum(1 for i in range(10000) if 'missing%d' % i in bloom)
+        self.assertLess(false_positives, 300)
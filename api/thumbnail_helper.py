@@ -0,0 +1,207 @@
+"""
+Renders every thumbnail alias of an image from a single decode, instead of easy_thumbnails decoding the
+whole source again for each alias the first time it's requested.
+JPEGs are decoded with Image.draft at the smallest scale that still covers the largest thumbnail.
+"""
+import itertools
+import math
+import multiprocessing
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from PIL import Image
+from easy_thumbnails import engine, utils
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import get_thumbnailer
+from easy_thumbnails.models import Thumbnail
+
+try:
+    from cStringIO import StringIO as BytesIO
+except ImportError:
+    from io import BytesIO
+
+
+# EXIF orientations that turn the image on its side
+ROTATED = (5, 6, 7, 8)
+
+
+def get_jobs(thumbnailer):
+    """
+    Options for every alias, with the thumbnail's name for an opaque and for a transparent result
+    """
+    jobs = []
+    for alias, options in sorted(aliases.all().iteritems()):
+        options = thumbnailer.get_options(options)
+        jobs.append((dict(options), thumbnailer.get_thumbnail_name(options),
+                     thumbnailer.get_thumbnail_name(options, transparent=True)))
+    return jobs
+
+
+def get_url(thumbnailer, alias):
+    """
+    Url of an opaque thumbnail rendered here, from its name without looking it up in easy_thumbnails' cache
+    """
+    options = thumbnailer.get_options(aliases.get(alias))
+    return thumbnailer.thumbnail_storage.url(thumbnailer.get_thumbnail_name(options))
+
+
+def get_orientation(image):
+    try:
+        exif = image._getexif()
+    except (AttributeError, IndexError, KeyError, IOError, OverflowError):
+        exif = None
+    return exif.get(0x0112) if exif else None
+
+
+def get_draft_size(size, options_list):
+    """
+    Smallest size an image of this size can be decoded at and still be scaled down to every thumbnail
+    """
+    width, height = size
+    draft_width, draft_height = 1, 1
+    for options in options_list:
+        scales = [float(target) / source for target, source in zip(options['size'], size) if target]
+        # Cropping fills the box, otherwise the image fits inside it
+        scale = max(scales) if options.get('crop') else min(scales)
+        if scale >= 1:
+            return size
+        draft_width = max(draft_width, int(math.ceil(width * scale)))
+        draft_height = max(draft_height, int(math.ceil(height * scale)))
+    return draft_width, draft_height
+
+
+def decode(data, options_list):
+    """
+    Open an image and load its pixels, JPEGs at a reduced scale, rotated to its EXIF orientation
+    """
+    image = Image.open(BytesIO(data))
+    if image.format == 'JPEG':
+        if get_orientation(image) in ROTATED:
+            width, height = get_draft_size(image.size[::-1], options_list)
+            image.draft('RGB', (height, width))
+        else:
+            image.draft('RGB', get_draft_size(image.size, options_list))
+    try:
+        image.load()
+    except IOError:
+        # Truncated files are still mostly usable, same as easy_thumbnails' pil_image
+        pass
+    image.load()
+    return utils.exif_orientation(image)
+
+
+def render(data, jobs):
+    """
+    Decode an image once and render each job's thumbnail from it
+    Only needs the bytes and the jobs, so it can run in a pool process without storage or the database
+    Returns a list of (name, bytes) for each job
+    """
+    image = decode(data, [options for options, name, transparent_name in jobs])
+    thumbnails = []
+    for options, name, transparent_name in jobs:
+        thumbnail = engine.process_image(image, options)
+        if utils.is_transparent(thumbnail):
+            name = transparent_name
+        saved = engine.save_image(thumbnail, filename=name, quality=options['quality'],
+                                  subsampling=options['subsampling'])
+        thumbnails.append((name, saved.read()))
+    return thumbnails
+
+
+def render_job(job):
+    """
+    render for Pool.imap, returns None for an image that can't be decoded so one bad file doesn't stop the rest
+    """
+    try:
+        return render(*job)
+    except (IOError, SyntaxError, ValueError):
+        return None
+
+
+def read(storage, name):
+    source = storage.open(name, 'rb')
+    try:
+        return source.read()
+    finally:
+        source.close()
+
+
+def store(thumbnailer, thumbnails):
+    """
+    Save rendered thumbnails to the thumbnail storage, returns their names
+    """
+    storage = thumbnailer.thumbnail_storage
+    for name, data in thumbnails:
+        if not getattr(storage, 'file_overwrite', False):
+            # It would save under a new name rather than replace an older thumbnail
+            storage.delete(name)
+        storage.save(name, ContentFile(data))
+    return [name for name, data in thumbnails]
+
+
+def record(stored):
+    """
+    Add stored thumbnails to easy_thumbnails' cache in bulk, so alias lookups find them instead of rendering them
+    stored is a list of (thumbnailer, names), the thumbnailers sharing one thumbnail storage
+    """
+    if not stored:
+        return
+    sources = [(thumbnailer.get_source_cache(create=True, update=True), names) for thumbnailer, names in stored]
+    # A cached thumbnail is only used while it's newer than its source
+    now = timezone.now()
+    storage_hash = utils.get_storage_hash(stored[0][0].thumbnail_storage)
+    wanted = set((source.id, name) for source, names in sources for name in names)
+    existing = Thumbnail.objects.filter(storage_hash=storage_hash, source__in=[source.id for source, names in sources],
+                                        name__in=[name for source_id, name in wanted])
+    found = set(existing.values_list('source', 'name'))
+    existing.update(modified=now)
+    missing = [Thumbnail(storage_hash=storage_hash, source_id=source_id, name=name, modified=now)
+               for source_id, name in wanted - found]
+    try:
+        with transaction.atomic():
+            Thumbnail.objects.bulk_create(missing)
+    except IntegrityError:
+        # Another worker cached some of them first
+        for thumbnail in missing:
+            Thumbnail.objects.get_or_create(storage_hash=storage_hash, source_id=thumbnail.source_id,
+                                            name=thumbnail.name, defaults={'modified': now})
+
+
+def create_thumbnails(storage, name):
+    """
+    Render, store and cache every alias of an image in this process, for the upload pipeline
+    """
+    thumbnailer = get_thumbnailer(storage, relative_name=name)
+    thumbnails = render(read(storage, name), get_jobs(thumbnailer))
+    record([(thumbnailer, store(thumbnailer, thumbnails))])
+
+
+def generate(storage, names, processes=None):
+    """
+    Render every alias of each named image on a pool of processes, one per core by default
+    This process reads the sources and stores the thumbnails while the pool decodes, and caches them in batches
+    Returns the names that were thumbnailed, images that can't be decoded are left out
+    """
+    thumbnailers = [get_thumbnailer(storage, relative_name=name) for name in names]
+    jobs = ((read(storage, thumbnailer.name), get_jobs(thumbnailer)) for thumbnailer in thumbnailers)
+    pool = multiprocessing.Pool(processes or settings.THUMBNAIL_PROCESSES or multiprocessing.cpu_count())
+    done = []
+    batch = []
+    try:
+        for thumbnailer, thumbnails in itertools.izip(thumbnailers, pool.imap(render_job, jobs)):
+            if thumbnails is None:
+                continue
+            batch.append((thumbnailer, store(thumbnailer, thumbnails)))
+            if len(batch) >= settings.THUMBNAIL_BATCH_SIZE:
+                record(batch)
+                done.extend(thumbnailer.name for thumbnailer, stored in batch)
+                batch = []
+        record(batch)
+        done.extend(thumbnailer.name for thumbnailer, stored in batch)
+    finally:
+        pool.terminate()
+        pool.join()
+    return done
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 import hashlib
+import math
+import struct
+import threading
 
 from django.conf import settings
 
@@ -12,6 +16,142 @@ def datetime_to_ms_since_epoch(dt):
 def fields_to_dict(x):
     return dict((key, value) for key, value in x.__dict__.iteritems() if not callable(value) and not key.startswith('_'))
 
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache holding at most max_size entries, evicting the least recently used first
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the keys that are cached and their values
+        """
+        result = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    result[key] = self._data.pop(key)
+                except KeyError:
+                    continue
+                self._data[key] = result[key]
+        return result
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        with self._lock:
+            for key, value in items.iteritems():
+                self._data.pop(key, None)
+                self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class BloomFilter(object):
+    """
+    Compact probabilistic set. An item that was added is always reported as present,
+    an item that was not added is wrongly reported as present at roughly error_rate.
+    Bits are numbered from the high bit of each byte, like redis bitmaps, so they can be stored in redis.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self._set_shape(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _set_shape(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+
+    def _positions(self, item):
+        if not isinstance(item, bytes):
+            item = item.encode('utf-8')
+        # Double hashing, derive every position from two halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 0x80 >> (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (0x80 >> (position & 7)) for position in self._positions(item))
+
+
+class RedisBloomFilter(BloomFilter):
+    """
+    BloomFilter whose bits are a redis string, so every process sees an item as soon as one adds it.
+    Until the key has been stored every item is reported as present, so callers fall back to an exact check.
+    """
+    # Only set bits in a filter that has been stored, a partial one would report its missing items as absent
+    ADD_SCRIPT = """
+        if redis.call('exists', KEYS[1]) == 1 then
+            for i, position in ipairs(ARGV) do
+                redis.call('setbit', KEYS[1], position, 1)
+            end
+        end
+    """
+
+    def __init__(self, connection, key, capacity, error_rate=0.01):
+        self._set_shape(capacity, error_rate)
+        self.connection = connection
+        self.key = key
+
+    def add(self, item):
+        self.connection.eval(self.ADD_SCRIPT, 1, self.key, *self._positions(item))
+
+    def get_present(self, items):
+        """
+        The items that may have been added, checked with one round trip
+        """
+        items = list(items)
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.exists(self.key)
+        for item in items:
+            for position in self._positions(item):
+                pipeline.getbit(self.key, position)
+        results = pipeline.execute()
+        if not results[0]:
+            return set(items)
+        bits = results[1:]
+        return set(item for i, item in enumerate(items)
+                   if all(bits[i * self.hash_count:(i + 1) * self.hash_count]))
+
+    def __contains__(self, item):
+        return item in self.get_present([item])
+
+    def store(self, bloom):
+        """
+        Replace the stored bits with a local BloomFilter's of the same shape, atomically
+        """
+        new_key = self.key + ':new'
+        self.connection.pipeline().set(new_key, bytes(bloom.bits)).rename(new_key, self.key).execute()
+
+
 #ISO 639-1
 languages = [
     ('aa', 'Afar'),
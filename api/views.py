@@ -1,7 +1,6 @@
 import datetime
 import logging
 import re
-import requests
 
 from itertools import chain
 
@@ -11,13 +10,14 @@ from django.utils import timezone
 from django.contrib.gis import geos
 from django.contrib.gis.measure import D
 from django.core.paginator import Paginator
-from django.db.models import Count, Q
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Q
 from django.utils.datastructures import MultiValueDict
 
 import elasticutils
 
 import rest_framework
-from rest_framework import exceptions, mixins, viewsets, permissions, generics, filters
+from rest_framework import exceptions, mixins, viewsets, permissions, generics, filters, pagination
 from rest_framework.decorators import action, link
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
@@ -29,42 +29,47 @@ from rest_framework_bulk import ListBulkCreateAPIView
 from oauth2_provider.ext.rest_framework import TokenHasReadWriteScope, TokenHasScope
 from oauth2_provider.views import TokenView
 
-from api.indexes import EventMapping, PlanMapping, ProfileMapping, get_search
+from fastfriends.mixins import ConditionalGetMixin
+
+from api.indexes import EventMapping, PlanMapping, ProfileMapping, get_search, suggest_profiles
 from api.models import *
 from api.permissions import IsOwnerOrReadOnly, UserPermissions, IsEventOwner, IsEventMember, IsUser
 from api.serializers import *
 from api.filters import *
 
+import album_helper
+import event_view_helper
+import fit_helper
+import media_helper
+import member_helper
 import message_helper
+import name_helper
+import places_helper
+import request_helper
+import search_helper
+import sync_helper
+import tag_helper
+import tasks
 
 logger = logging.getLogger(__name__)
 
-def build_mentions(obj, field):
-    obj.mentions.clear()
-    
-    names = re.findall(settings.MENTION_REGEX[1:-1], field, flags=re.IGNORECASE)
-    print list(names)
-    for name in names:
-        try:
-            profile = Profile.objects.get(display_name__iexact=name)
-            mention, created = Mention.objects.get_or_create(name=name.lower(), user=profile.owner)
-            print str(mention)
-            obj.mentions.add(mention)
-        except Profile.DoesNotExist:
-            pass
-             
-                           
-def build_hash_tags(obj, field):
-    obj.hash_tags.clear()
-    
-    names = re.findall(settings.HASH_TAG_REGEX[1:-1], field, flags=re.IGNORECASE)
-    print list(names)
-    for name in names:
-        hash_tag, created = HashTag.objects.get_or_create(name=name.lower())
-        print hash_tag
-        obj.hash_tags.add(hash_tag)
-            
-            
+def get_friend_state(user):
+    """
+    Changes whenever the user adds, removes or recategorizes a friend, for responses that depend on who their friends are
+    """
+    return list(Friend.objects.filter(owner=user).order_by('close').values_list('close').annotate(Count('id'), Max('id')))
+
+
+def notify_promoted(members):
+    """
+    Tell waitlisted members they got a seat
+    """
+    messages = [{'users': [member.user_id], 'data': message_helper.encode_gcm_data(member.event.build_gcm_data(Event.PROMOTE))}
+                for member in members]
+    if messages:
+        tasks.send_gcm_batch.delay(messages)
+
+
 class ResourceViewSet(mixins.CreateModelMixin,
                       mixins.ListModelMixin,
                       mixins.RetrieveModelMixin,
@@ -82,49 +87,51 @@ class ResourceViewSet(mixins.CreateModelMixin,
             caption = serializer.data.get('caption', '')
             resource.caption = caption
             resource.save()
+            tag_helper.update_tags(resource)
             return Response(ResourceSerializer(resource).data)
         else:
             return Response(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
          
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.DATA, files=request.FILES)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        self.pre_save(serializer.object)
+        self.object = self.save_resource(serializer)
+        self.post_save(self.object, created=True)
+        # Poll the resource until its status is READY
+        tasks.process_resource(self.object.id)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=self.get_success_headers(serializer.data))
+
     def pre_save(self, obj):
         if not Resource.objects.filter(pk=obj.pk).exists():
-            # Creating new resource
+            # Creating new resource, only the raw bytes are stored here, see tasks.process_resource
             if not obj.data:
                 # File uploaded directly to s3
-                obj.data.name = settings.MEDIA_ROOT + obj.hash            
+                obj.data.name = settings.MEDIA_ROOT + obj.hash
             obj.file_name = obj.data.name
-            obj.data.open()
-            obj.content_type = magic.from_buffer(obj.data.read(1024), mime=True)
-            if obj.content_type.startswith('image'):
-                obj.set_dimensions()
-            obj.hash = obj.build_hash(obj.data)
-            obj.data.name = obj.hash
+            obj.status = Resource.PENDING
+
+    def save_resource(self, serializer):
+        """
+        Insert a new resource, sharing the blob of an upload whose bytes are already stored
+        The blob is claimed in the insert's transaction, so a failed save doesn't keep the reference,
+        and a new upload is stored before the insert, so no transaction is open during the transfer to s3
+        """
+        obj = serializer.object
+        if not obj.data._committed:
+            if media_helper.find_blob(obj.hash, obj.data):
+                with transaction.atomic():
+                    obj.blob = media_helper.share_blob(obj.hash)
+                    if obj.blob is not None:
+                        obj.data = media_helper.get_blob_name(obj.hash)
+                        return serializer.save(force_insert=True)
+            obj.data.save(media_helper.get_upload_name(), obj.data.file, save=False)
+        return serializer.save(force_insert=True)
 
     def post_save(self, obj, created):
-        build_mentions(obj, obj.caption)
-        build_hash_tags(obj, obj.caption)
-        
-        if created:            
-            album = obj.album
-            album.resources.add(obj)
-            if obj.content_type.startswith('image'):
-                # if album has no cover, make this the cover
-                if album.cover is None:
-                    album.cover = obj
-                    album.save()
-                owner = obj.album.owner
-                # if profile album, and profile has no portrait, make this the portrait              
-                if owner is not None:
-                    profile = Profile.objects.get(owner=owner)
-                    if profile.portrait is None:
-                        profile.portrait = obj
-                        profile.save()
-                
-                obj.create_thumbnail()
-                # Add thumbnail creation to redis queue
-                #q = Queue(connection=conn)
-                #q.enqueue(obj.create_thumbnail)            
+        tag_helper.update_tags(obj, created)
 
 
 class ResourceDeleteView(APIView):
@@ -134,7 +141,9 @@ class ResourceDeleteView(APIView):
         resources = self.get_queryset()
         serializer = ResourceDeleteSerializer(data=request.DATA)
         if serializer.is_valid():
-            resources.delete()
+            # Their files are deleted afterwards, in bulk
+            with tasks.batch_cleanup():
+                resources.delete()
             return Response({'status': 'resources deleted'})
         else:
             return Response(serializer.errors,
@@ -152,18 +161,64 @@ class ResourceDeleteView(APIView):
         return Resource.objects.filter(id__in=resource_ids)
  
             
+class ResourceUploadView(APIView):
+    """
+    Presigned POST for uploading a file straight to s3, so it doesn't tie up a web dyno
+    POST the file to url with fields, then finalize it with upload at /resources/finalize/
+    """
+    permission_classes = (TokenHasReadWriteScope,)
+
+    def post(self, request):
+        serializer = ResourceUploadSerializer(data=request.DATA, context={'request': request})
+        if serializer.is_valid():
+            upload = serializer.object
+            return Response(media_helper.create_upload(request.user, upload['album'], upload['content_type'],
+                                                       upload['size'], upload.get('file_name') or ''))
+        else:
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+
+class ResourceFinalizeView(APIView):
+    """
+    Record a resource for a finished upload to s3 and start processing it, poll it until its status is READY
+    """
+    permission_classes = (TokenHasReadWriteScope,)
+
+    def post(self, request):
+        serializer = ResourceFinalizeSerializer(data=request.DATA)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            resource, created = media_helper.finalize_upload(request.user, serializer.object['upload'],
+                                                             serializer.object.get('caption') or '')
+        except media_helper.MediaError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if created:
+            tag_helper.update_tags(resource, created)
+            tasks.process_resource(resource.id)
+        return Response(ResourceSerializer(resource).data,
+                        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
 class TagViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     paginate_by = None
 
 
-class AlbumViewSet(viewsets.ModelViewSet):
+class AlbumViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = (TokenHasReadWriteScope,)
     queryset = Album.objects.all()
     serializer_class = AlbumSerializer
 
-    def get_queryset(self):
+    def get_validator_aggregates(self):
+        aggregates = super(AlbumViewSet, self).get_validator_aggregates()
+        aggregates['resources_updated'] = Max('resources__updated')
+        aggregates['resource_count'] = Count('resources', distinct=True)
+        return aggregates
+
+    def get_albums(self):
         """
         Optionally restricts the returned albums to a given user or event,
         by filtering against query parameters in the URL.
@@ -176,11 +231,34 @@ class AlbumViewSet(viewsets.ModelViewSet):
             return Album.objects.filter(owner=owner_id)
         return Album.objects.all()
 
+    def get_queryset(self):
+        return album_helper.annotate(self.get_albums())
+
+    def get_validator_queryset(self):
+        return self.filter_queryset(self.get_albums())
+
+    @link()
+    def resources(self, request, pk=None):
+        """
+        The album's resources newest first, a page at a time, pass next as before to get the following page
+        """
+        album = self.get_object()
+        try:
+            before = request.QUERY_PARAMS.get('before', None)
+            cursor = album_helper.parse_cursor(before) if before else None
+            page_size = int(request.QUERY_PARAMS.get('page_size', settings.REST_FRAMEWORK['PAGINATE_BY']))
+        except ValueError:
+            return Response({'detail': 'Invalid before or page_size'}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = max(1, min(page_size, settings.REST_FRAMEWORK['MAX_PAGINATE_BY']))
+        resources, next_cursor = album_helper.get_resources(album, cursor, page_size)
+        return Response({'results': AlbumResourceSerializer(resources, many=True).data, 'next': next_cursor})
+
     def pre_save(self, obj):
         obj.owner = self.request.user
 
 
-class CommentViewSet(mixins.ListModelMixin,
+class CommentViewSet(ConditionalGetMixin,
+                     mixins.ListModelMixin,
                      mixins.RetrieveModelMixin,
                      mixins.UpdateModelMixin,
                      mixins.DestroyModelMixin,
@@ -189,6 +267,11 @@ class CommentViewSet(mixins.ListModelMixin,
     model = Comment
     serializer_class = CommentSerializer
 
+    def get_validator_aggregates(self):
+        aggregates = super(CommentViewSet, self).get_validator_aggregates()
+        aggregates['owner_updated'] = Max('owner__profile__updated')
+        return aggregates
+
     def get_queryset(self):
         """
         Optionally restricts the returned comments to a given event,
@@ -209,8 +292,7 @@ class CommentViewSet(mixins.ListModelMixin,
         obj.owner = self.request.user
 
     def post_save(self, obj, created):
-        build_mentions(obj, obj.message)
-        build_hash_tags(obj, obj.message)
+        tag_helper.update_tags(obj, created)
         
         try:
             event = Event.objects.get(comments__id=obj.id)
@@ -234,7 +316,7 @@ class CommentViewSet(mixins.ListModelMixin,
                 message_helper.send_gcm(users, data)
 
     
-class EventViewSet(viewsets.ModelViewSet):
+class EventViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     # Sort filters
     ATTENDING = 'ATTENDING' # All upcoming events the user is signed up for
     FRIENDS = 'FRIENDS' # Friends and their friends only
@@ -254,15 +336,30 @@ class EventViewSet(viewsets.ModelViewSet):
     #search_fields = ('name', 'location__name', 'tags__name')
 
     def retrieve(self, request, *args, **kwargs):
-        self.object = self.get_object()
-        serializer = EventSerializer(instance=self.object, context={'request': request})
-        response = Response(serializer.data)
-        # if current user is a member of the event update the time they last viewed the event        
-        if EventMember.objects.filter(user=request.user, event=self.object).count() > 0:
-            member = EventMember.objects.get(user=request.user, event=self.object)            
-            member.viewed_event = timezone.now()
-            member.save()
+        response = super(EventViewSet, self).retrieve(request, *args, **kwargs)
+        # if current user is a member of the event update the time they last viewed the event, even if it was unchanged
+        event_view_helper.record_view(self.object.id, request.user.id)
         return response
+
+    def get_validator_aggregates(self):
+        aggregates = super(EventViewSet, self).get_validator_aggregates()
+        aggregates['owner_updated'] = Max('owner__profile__updated')
+        if self.action == 'list':
+            # Comments mark events as modified in the list
+            aggregates['comments_updated'] = Max('comments__updated')
+        else:
+            aggregates['accepted_count'] = Max('accepted_count')
+        return aggregates
+
+    def get_validator_state(self, queryset):
+        user = self.request.user
+        members = EventMember.objects.filter(user=user, event__in=queryset.values('pk')).order_by('status')
+        if self.action == 'list':
+            # Views decide which events are marked as modified
+            membership = list(members.values_list('status').annotate(Count('id'), Max('checked_in'), Max('viewed_event')))
+            return (membership, get_friend_state(user), event_view_helper.get_last_view(user.id))
+        membership = list(members.values_list('status').annotate(Count('id'), Max('checked_in')))
+        return (membership, get_friend_state(user))
         
     def get_serializer_class(self):
         if self.action == 'list':
@@ -278,7 +375,8 @@ class EventViewSet(viewsets.ModelViewSet):
             accepted = query.filter(status=EventMember.ACCEPTED)
             requested = query.filter(status=EventMember.REQUESTED)
             invited = query.filter(status=EventMember.INVITED)
-            members = list(chain(accepted, requested, invited) )
+            waitlisted = query.filter(status=EventMember.WAITLISTED).order_by('waitlisted', 'id')
+            members = list(chain(accepted, requested, invited, waitlisted))
         else:
             friends = Friend.objects.filter(owner=request.user)
             all_friend_list = friends.values_list('user', flat=True)
@@ -320,8 +418,8 @@ class EventViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_200_OK)
         else:
             # Mark the event as canceled
-            event.cancelled = timezone.now()
-            event.save()
+            event.canceled = timezone.now()
+            event.save(update_fields=['canceled', 'updated'])
             #Notify each member
             data = event.build_gcm_data(Event.CANCEL)
             users = event.members.exclude(id=event.owner.id)
@@ -337,7 +435,7 @@ class EventViewSet(viewsets.ModelViewSet):
             resource_id = request.DATA['resource']
             resource = Resource.objects.get(id=resource_id)
             event.image = resource
-            event.save()
+            event.save(update_fields=['image', 'updated'])
             return Response(EventSerializer(event).data)
         else:
             return Response(serializer.errors,
@@ -359,31 +457,33 @@ class EventViewSet(viewsets.ModelViewSet):
     @action(methods=['PUT'], permission_classes=[TokenHasReadWriteScope,])    
     def join(self, request, pk=None):
         event = self.get_object()
-        count = EventMember.objects.filter(event=event, user=request.user).count()
-        if count != 0:
-            return Response({'status': 'Already a member'}, status=status.HTTP_400_BAD_REQUEST)
-        # Current user is not a member, try adding them
         if event.join_policy == Event.OPEN:
-            member = EventMember.objects.create(event=event, user=request.user, viewed_event=timezone.now(), status=EventMember.ACCEPTED)
+            member_status = EventMember.ACCEPTED
         elif event.join_policy == Event.FRIENDS_ONLY:
-            friend_count = Friend.objects.filter(owner=event.owner, user=request.user, close=True).count()
-            if friend_count <= 0:
+            if not Friend.objects.filter(owner=event.owner, user=request.user, close=True).exists():
                 return Response({'status': "Only the owner's friends can join"}, status=status.HTTP_400_BAD_REQUEST)
-            member = EventMember.objects.create(event=event, user=request.user, viewed_event=timezone.now(), status=EventMember.ACCEPTED)
+            member_status = EventMember.ACCEPTED
         # TODO:  Above reliability threshold only
         else:
             # Request to join
-            member = EventMember.objects.create(event=event, user=request.user, viewed_event=timezone.now())                
+            member_status = EventMember.REQUESTED
+        try:
+            # Takes a seat if one is left, otherwise joins the waitlist
+            member = member_helper.add_member(event, request.user, member_status)
+        except IntegrityError:
+            return Response({'status': 'Already a member'}, status=status.HTTP_400_BAD_REQUEST)
         return Response(EventMemberSerializer(member, context={'request': request}).data)
 
     @action(methods=['PUT'], permission_classes=[TokenHasReadWriteScope,])    
     def leave(self, request, pk=None):
         event = self.get_object()
-        count = EventMember.objects.filter(event=event, user=request.user).count()
-        if count == 0:
+        try:
+            member = EventMember.objects.get(event=event, user=request.user)
+        except EventMember.DoesNotExist:
             return Response({'status': 'Not a member'}, status=status.HTTP_400_BAD_REQUEST)
-        member = EventMember.objects.get(event=event, user=request.user) 
-        member.delete()
+        promoted = member_helper.remove_member(member)
+        if promoted is not None:
+            notify_promoted([promoted])
         return Response({'status': 'Left event'}, status=status.HTTP_200_OK)
                 
     @action(methods=['PUT'], permission_classes=[IsEventMember, TokenHasReadWriteScope,])    
@@ -396,29 +496,54 @@ class EventViewSet(viewsets.ModelViewSet):
                 # Event is not open invite, and current user is not event owner
                 return Response({'status': 'No permission to invite'}, status=status.HTTP_401_UNAUTHORIZED)            
             param = self.request.DATA.get('users', '')
-            invitees = param.split(',')
-
-            count = 0
-            for user_id in invitees:
-                try:
-                    user = User.objects.get(id=user_id)
-                    member, created = EventMember.objects.get_or_create(event=event, user=user, defaults={'viewed_event': timezone.now(), 'status': EventMember.INVITED})
-                    if created:
-                        count += 1
-                        invite = EventInvite.objects.create(event=event, sender=current_user, receiver=user, sent=timezone.now())                        
-                        member.invite = invite
-                        member.save()
-                        
-                        #Send notification
-                        data = invite.build_gcm_data()
-                        message_helper.send_gcm(user, data)
-                except User.DoesNotExist:
-                    pass                
-            return Response({'status': 'Invited ' + str(count) + ' friends.'})
+            invitee_ids = set(long(x) for x in param.split(',') if x.strip().isdigit())
+
+            invites = self.create_invites(event, current_user, invitee_ids)
+
+            if invites:
+                # All invites share the sender and event, so only the invite id differs between notifications
+                data = message_helper.encode_gcm_data(invites[0].build_gcm_data())
+                messages = []
+                for invite in invites:
+                    invite_data = {'event_invite': dict(data['event_invite'], id=invite.id)}
+                    messages.append({'users': [invite.receiver_id], 'data': invite_data})
+                tasks.send_gcm_batch.delay(messages)
+            return Response({'status': 'Invited ' + str(len(invites)) + ' friends.'})
         else:
             return Response(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
 
+    def create_invites(self, event, sender, user_ids):
+        """
+        Creates an EventInvite and invited EventMember for each of the users that is not already a member
+        """
+        now = timezone.now()
+        for attempt in range(settings.INVITE_ATTEMPTS):
+            new_ids = list(User.objects.filter(id__in=user_ids).exclude(eventmember__event=event).values_list('id', flat=True))
+            if not new_ids:
+                return []
+            try:
+                # Its own transaction, so a conflict only undoes this attempt
+                with transaction.atomic():
+                    EventInvite.objects.bulk_create([EventInvite(event=event, sender=sender, receiver_id=user_id, sent=now) for user_id in new_ids])
+                    # bulk_create doesn't set primary keys, so read the invites back by (event, receiver) to link them to their members.
+                    # Older invites to these users have lower ids, and a concurrent batch inviting any of them fails below
+                    latest = {}
+                    for invite in EventInvite.objects.filter(event=event, receiver__in=new_ids).order_by('id'):
+                        latest[invite.receiver_id] = invite
+                    invites = latest.values()
+                    EventMember.objects.bulk_create([EventMember(event=event, user_id=invite.receiver_id, invite=invite, viewed_event=now, status=EventMember.INVITED)
+                                                     for invite in invites])
+                break
+            except IntegrityError:
+                # Someone was invited or joined concurrently, try again without them
+                if attempt == settings.INVITE_ATTEMPTS - 1:
+                    raise
+        for invite in invites:
+            invite.sender = sender
+            invite.event = event
+        return invites
+
 
     @action(methods=['PUT'], permission_classes=[TokenHasReadWriteScope,])
     def checkin(self, request, pk=None):
@@ -446,8 +571,7 @@ class EventViewSet(viewsets.ModelViewSet):
         obj.owner = self.request.user
 
     def post_comment(self, obj):
-        build_mentions(obj, obj.message)
-        build_hash_tags(obj, obj.message)
+        tag_helper.update_tags(obj, created=True)
         
         # obj is a comment
         event = Event.objects.get(comments__id=obj.id)
@@ -459,15 +583,16 @@ class EventViewSet(viewsets.ModelViewSet):
         obj.owner = self.request.user
         
     def post_save(self, obj, created):
-        build_mentions(obj, obj.description)
-        build_hash_tags(obj, obj.description)
+        tag_helper.update_tags(obj, created)
         
         if created:
             # Create owner EventMember
-            event_member = EventMember.objects.create(event=obj, user=obj.owner, viewed_event=timezone.now(), status=EventMember.ACCEPTED)
+            event_member = member_helper.add_member(obj, obj.owner)
             # Create associated Album
             Album.objects.create(event=obj)
         else:
+            # max_members may have been raised, seat the waitlist
+            notify_promoted(member_helper.promote_all(obj.id))
             # Notify each member
             data = obj.build_gcm_data(Event.UPDATE)
             users = obj.members.exclude(id=obj.owner.id)
@@ -500,7 +625,8 @@ class EventViewSet(viewsets.ModelViewSet):
         if category == self.ATTENDING:
             return available_query.filter(Q(eventmember__user=current_user, eventmember__status=EventMember.ACCEPTED) |
                                           Q(eventmember__user=current_user, eventmember__status=EventMember.REQUESTED) |
-                                          Q(eventmember__user=current_user, eventmember__status=EventMember.INVITED))
+                                          Q(eventmember__user=current_user, eventmember__status=EventMember.INVITED) |
+                                          Q(eventmember__user=current_user, eventmember__status=EventMember.WAITLISTED))
         if category == self.FRIENDS:
             friends = Friend.objects.filter(close=True, owner=current_user).values_list('user', flat=True)
             second_friends = Friend.objects.filter(close=True, owner__in=friends).distinct('user').values_list('user', flat=True)
@@ -537,16 +663,19 @@ class EventMemberViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
 
             accept = serializer.data.get('accept', None)            
             if accept:
-                member.status = EventMember.ACCEPTED
-                member.save()
+                member_status = member_helper.accept_member(member)
                 invite.accepted = True
                 invite.save()
+                if member_status == EventMember.WAITLISTED:
+                    return Response({'status': 'Member accepted invitation, event is full so member was waitlisted'})
                 return Response({'status': 'Member accepted invitation'})
             else:
-                member.status = EventMember.DECLINED
-                member.save()
+                # Releases their seat if they had accepted, and seats the waitlist
+                promoted = member_helper.decline_member(member)
                 invite.accepted = False
-                invite.save()                
+                invite.save()
+                if promoted is not None:
+                    notify_promoted([promoted])
                 return Response({'status': 'Member declined invitation'})
         return Response(serializer.errors,
                 status=status.HTTP_400_BAD_REQUEST)
@@ -564,21 +693,28 @@ class EventMemberViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
 
             accept = serializer.data.get('accept', None)            
             if accept:
-                member.status = EventMember.ACCEPTED
-                member.save()
+                if member_helper.accept_member(member) == EventMember.WAITLISTED:
+                    return Response({'status': 'Event is full, member was waitlisted'})
                 return Response({'status': 'Member accepted'})
             else:
-                member.delete()
+                promoted = member_helper.remove_member(member)
+                if promoted is not None:
+                    notify_promoted([promoted])
                 return Response({'status': 'Member declined'})
         return Response(serializer.errors,
                         status=status.HTTP_400_BAD_REQUEST)
 
 
-class ProfileViewSet(mixins.UpdateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+class ProfileViewSet(ConditionalGetMixin, mixins.UpdateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     permission_classes = (IsOwnerOrReadOnly, TokenHasReadWriteScope,)
     queryset = Profile.objects.all()
     serializer_class = ProfileSerializer
 
+    def get_validator_state(self, queryset):
+        # Whether they are the viewer's friend, and how many friends they have in common
+        owners_friends = Friend.objects.filter(owner__in=queryset.values('owner')).aggregate(Count('id'), Max('id'))
+        return (get_friend_state(self.request.user), sorted(owners_friends.items()))
+
     @link()
     def friends(self, request, pk=None):
         """
@@ -617,14 +753,13 @@ class ProfileViewSet(mixins.UpdateModelMixin, mixins.ListModelMixin, mixins.Retr
         obj.owner = self.request.user
 
     def post_save(self, obj, created):
-        build_mentions(obj, obj.about)
-        build_hash_tags(obj, obj.about)
+        tag_helper.update_tags(obj, created)
 
     def get_queryset(self):
         name = self.request.QUERY_PARAMS.get('name', None)
         if name is None:
             return Profile.objects.all()
-        return Profile.objects.filter(display_name=name.lower())
+        return name_helper.filter_by_names([name.lower()])
             
     
 class CurrentUserView(APIView):
@@ -765,8 +900,26 @@ class UserStatusView(APIView):
     def get(self, request):
         serializer = UserStatusSerializer(request.user)
         return Response(serializer.data)
-    
-    
+
+
+class BatchView(APIView):
+    """
+    Run several GET requests in one round trip, e.g. everything the app loads on launch
+    POST {"requests": ["/users/status/", "/events/?category=ATTENDING", ...]}
+    The token is validated once, and lookups cached for one request are reused by the rest
+    """
+    permission_classes = (TokenHasReadWriteScope,)
+
+    def post(self, request):
+        if request_helper.is_batch(request):
+            return Response({'detail': 'Batch requests can not be nested'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = BatchSerializer(data=request.DATA)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        responses = [request_helper.dispatch(request, url) for url in serializer.object['requests']]
+        return Response({'responses': responses})
+
+
 class ConversationDeleteView(APIView):
     permission_classes = (TokenHasReadWriteScope,)
 
@@ -802,7 +955,8 @@ class ConversationOpenView(APIView):
         messages = self.get_queryset()
         serializer = ConversationOpenSerializer(data=request.DATA)
         if serializer.is_valid():
-            messages.update(opened=timezone.now());
+            now = timezone.now()
+            messages.update(opened=now, updated=now)
             return Response({'status': 'conversation opened'})
         else:
             return Response(serializer.errors,
@@ -851,19 +1005,17 @@ class PlaceAutoCompleteView(APIView):
     def get(self, request):
         serializer = PlaceAutoCompleteSerializer(data=request.QUERY_PARAMS)
         if serializer.is_valid():            
-            params = {'sensor': 'false', 'key': settings.GOOGLE_API_KEY, 'input': request.QUERY_PARAMS.get('input'),
-                      'components': request.QUERY_PARAMS.get('components'), 'location': request.QUERY_PARAMS.get('location'), 
-                      'radius': request.QUERY_PARAMS.get('radius')}
             try:
-                r = requests.get('https://maps.googleapis.com/maps/api/place/autocomplete/json', params=params)
-                json = r.json()
-                request_status = json['status'].upper()
+                request_status, predictions = places_helper.autocomplete(request.QUERY_PARAMS.get('input'),
+                                                                         request.QUERY_PARAMS.get('components'),
+                                                                         request.QUERY_PARAMS.get('location'),
+                                                                         request.QUERY_PARAMS.get('radius'))
                 if request_status == 'OK':
-                    return Response(json['predictions'])
+                    return Response(predictions)
                 else:
                     return Response({'status': request_status})
-            except requests.exceptions.RequestException as e:
-                return Response({'status': e})
+            except places_helper.PlacesError as e:
+                return Response({'status': str(e)})
 
         else:
             return Response(serializer.errors,
@@ -962,7 +1114,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
         obj.owner = self.request.user
 
 
-class PlanViewSet(viewsets.ModelViewSet):
+class PlanViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     # Sort filters
     FRIENDS = 'FRIENDS' # Friends and their friends only
     NEWEST = 'NEWEST' # All close to the user
@@ -983,6 +1135,11 @@ class PlanViewSet(viewsets.ModelViewSet):
         if self.action == 'list':
             return PlanListSerializer
         return PlanSerializer    
+
+    def get_validator_aggregates(self):
+        aggregates = super(PlanViewSet, self).get_validator_aggregates()
+        aggregates['owner_updated'] = Max('owner__profile__updated')
+        return aggregates
     
     @action(methods=['POST'], permission_classes=[TokenHasReadWriteScope])    
     def comment(self, request, pk=None):
@@ -999,8 +1156,7 @@ class PlanViewSet(viewsets.ModelViewSet):
         obj.owner = self.request.user
 
     def post_comment(self, obj):
-        build_hash_tags(obj, obj.message)
-        build_mentions(obj, obj.message)
+        tag_helper.update_tags(obj, created=True)
         
         # obj is a comment
         plan = Plan.objects.get(comments__id=obj.id)
@@ -1016,8 +1172,7 @@ class PlanViewSet(viewsets.ModelViewSet):
         obj.owner = self.request.user        
 
     def post_save(self, obj, created):
-        build_hash_tags(obj, obj.text)
-        build_mentions(obj, obj.text)
+        tag_helper.update_tags(obj, created)
         # TODO index object        
         if not created:
             # Notify participants (commenters) plan has been updated
@@ -1071,10 +1226,16 @@ class PlanSearchView(APIView):
         if serializer.is_valid():
             search_filter = serializer.object
             
-            paginator = Paginator(search_filter.build_search(), search_filter.page_size)
+            search = search_filter.build_search()
+            if request.QUERY_PARAMS.get('projection') == search_helper.SOURCE:
+                paginator = Paginator(search.values_dict(), search_filter.page_size)
+                page = paginator.page(search_filter.page)
+                page.object_list = search_helper.project(page.object_list, search_helper.PLAN_SOURCE_FIELDS)
+                return Response(pagination.PaginationSerializer(page, context={'request': request}).data)
+
+            paginator = Paginator(search, search_filter.page_size)
             page = paginator.page(search_filter.page)
-            plans = [item.get_object() for item in page.object_list]
-            page.object_list = plans
+            page.object_list = search_helper.hydrate_plans(page.object_list)
             
             serializer_context = {'request': request}
             result_serializer = PaginatedPlanSerializer(page, context=serializer_context)
@@ -1091,12 +1252,20 @@ class EventSearchView(APIView):
         if serializer.is_valid():
             search_filter = serializer.object
             
-            paginator = Paginator(search_filter.build_search(), search_filter.page_size)
+            search = search_filter.build_search()
+            if request.QUERY_PARAMS.get('projection') == search_helper.SOURCE:
+                paginator = Paginator(search.values_dict(), search_filter.page_size)
+                page = paginator.page(search_filter.page)
+                page.object_list = search_helper.project(page.object_list, search_helper.EVENT_SOURCE_FIELDS)
+                return Response(pagination.PaginationSerializer(page, context={'request': request}).data)
+
+            paginator = Paginator(search, search_filter.page_size)
             page = paginator.page(search_filter.page)
-            events = [item.get_object() for item in page.object_list]
+            events = search_helper.hydrate_events(page.object_list)
             page.object_list = events
             
-            serializer_context = {'request': request, 'latitude': search_filter.latitude, 'longitude': search_filter.longitude}
+            serializer_context = {'request': request, 'latitude': search_filter.latitude, 'longitude': search_filter.longitude,
+                                  'event_batch': search_helper.get_event_batch(events, request.user)}
             result_serializer = PaginatedEventSerializer(page, context=serializer_context)
         
             return Response(result_serializer.data)
@@ -1110,9 +1279,15 @@ class FriendSearchView(APIView):
         serializer = FriendSearchSerializer(data=request.QUERY_PARAMS)
         if serializer.is_valid():
             search = request.QUERY_PARAMS.get('search', None)
+
+            if serializer.object.get('suggest'):
+                friends = Friend.objects.filter(owner=request.user).values_list('user', flat=True)
+                page_size = int(request.QUERY_PARAMS.get('page_size', settings.SUGGEST_SIZE))
+                page_size = max(1, min(page_size, settings.REST_FRAMEWORK['MAX_PAGINATE_BY']))
+                return Response(suggest_profiles(search, friends, page_size))
     
             q = elasticutils.Q()            
-            q += elasticutils.Q(display_name__prefix=search, should=True)
+            q += elasticutils.Q(autocomplete__match=search, should=True)
             q += elasticutils.Q(interests=search, should=True)
             #q += elasticutils.Q(about__sqs=search, should=True)
             s = get_search(ProfileMapping).query(q)
@@ -1120,12 +1295,18 @@ class FriendSearchView(APIView):
             page = request.QUERY_PARAMS.get('page', 1)
             page_size = request.QUERY_PARAMS.get('page_size', settings.REST_FRAMEWORK['PAGINATE_BY'])
 
+            if request.QUERY_PARAMS.get('projection') == search_helper.SOURCE:
+                paginator = Paginator(s.values_dict(), int(page_size))
+                page = paginator.page(int(page))
+                page.object_list = search_helper.project(page.object_list, search_helper.PROFILE_SOURCE_FIELDS)
+                return Response(pagination.PaginationSerializer(page, context={'request': request}).data)
+
             paginator = Paginator(s, int(page_size))
             current_page = paginator.page(int(page))
-            profiles = [item.get_object() for item in current_page.object_list]
+            profiles = search_helper.hydrate_profiles(current_page.object_list)
             current_page.object_list = profiles
             
-            serializer_context = {'request': request}            
+            serializer_context = {'request': request, 'profile_batch': search_helper.get_profile_batch(profiles, request.user)}
             result_serializer = PaginatedProfileSerializer(current_page, context=serializer_context)
             
             return Response(result_serializer.data)    
@@ -1259,11 +1440,8 @@ class CheckNameView(APIView):
     def get(self, request):
         serializer = CheckNameSerializer(data=request.QUERY_PARAMS)
         if serializer.is_valid():
-            name = self.request.QUERY_PARAMS.get['name']
-            if Profile.objects.filter(display_name=name.lower()).count() > 0:
-                return Response({'used': True})
-            else:
-                return Response({'used': False})                            
+            name = serializer.object['name']
+            return Response({'used': name_helper.is_display_name_used(name)})
         return Response(serializer.errors,
                         status=status.HTTP_400_BAD_REQUEST)
     
@@ -1279,12 +1457,33 @@ class FitHistoryView(ListBulkCreateAPIView):
         obj.owner = self.request.user
         
     def create(self, request, *args, **kwargs):
-        # Delete existing FitHistory for the user before inserting new ones
+        # Replace the user's FitHistory with the posted set, writing only what changed
+        data = request.DATA if isinstance(request.DATA, list) else [request.DATA]
+        serializer = self.get_serializer(data=data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            changed = fit_helper.sync_history(request.user, serializer.object)
+        except IntegrityError:
+            # A concurrent first sync inserted the same rows, match against them instead
+            changed = fit_helper.sync_history(request.user, serializer.object)
+        if changed:
+            tasks.refresh_fit_rankings.delay(fit_helper.get_viewers(request.user.id))
         histories = FitHistory.objects.filter(owner=request.user)
-        histories.delete()
-        return super(FitHistoryView, self).create(request, *args, **kwargs)
+        return Response(self.get_serializer(histories, many=True).data, status=status.HTTP_201_CREATED)
     
     def get_queryset(self):
+        histories = self.get_histories()
+        since = self.request.QUERY_PARAMS.get('since', None)
+        if since is not None:
+            if not since.isdecimal():
+                return FitHistory.objects.none()
+            # Only rows changed after this time in milliSecs, served from the index on updated
+            cutoff = datetime.datetime.fromtimestamp(int(since)/1000.0, timezone.utc)
+            histories = histories.filter(updated__gt=cutoff)
+        return histories
+
+    def get_histories(self):
         user_id = self.request.QUERY_PARAMS.get('user', None)
         period = self.request.QUERY_PARAMS.get('period', None)
         start_date = self.request.QUERY_PARAMS.get('start_date', None)
@@ -1301,3 +1500,63 @@ class FitHistoryView(ListBulkCreateAPIView):
             cutoff = datetime.datetime.fromtimestamp(int(start_date)/1000.0)
             return FitHistory.objects.filter(period=period, updated__gt=cutoff)
         return FitHistory.objects.all()
+
+
+class SyncView(APIView):
+    """
+    What changed in the user's attending events, messages, friends and event comments since their last sync
+    GET /sync/?since=<token from the last sync>, without since it only issues a token to start from
+    """
+    permission_classes = (TokenHasReadWriteScope,)
+
+    def serialize_changes(self, serializer_class, changes):
+        created, updated, deleted = changes
+        context = {'request': self.request}
+        return {'created': serializer_class(created, many=True, context=context).data,
+                'updated': serializer_class(updated, many=True, context=context).data,
+                'deleted': deleted}
+
+    def serialize_comments(self, changes):
+        created, updated, deleted = changes
+        return {'created': [dict(CommentSerializer(comment).data, event=event) for event, comment in created],
+                'updated': [dict(CommentSerializer(comment).data, event=event) for event, comment in updated],
+                'deleted': deleted}
+
+    def get(self, request):
+        token = sync_helper.issue_token(timezone.now())
+        since = request.QUERY_PARAMS.get('since', None)
+        if since is None:
+            return Response({'since': token})
+        try:
+            since = sync_helper.parse_token(since)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if sync_helper.is_expired(since):
+            return Response({'detail': 'Sync token expired, reload everything', 'since': token}, status=status.HTTP_410_GONE)
+
+        user = request.user
+        attending_ids = sync_helper.get_attending_ids(user)
+        return Response({
+            'since': token,
+            'events': self.serialize_changes(EventListSerializer, sync_helper.get_event_changes(user, since, attending_ids)),
+            'messages': self.serialize_changes(MessageSerializer, sync_helper.get_message_changes(user, since)),
+            'friends': self.serialize_changes(FriendSerializer, sync_helper.get_friend_changes(user, since)),
+            'comments': self.serialize_comments(sync_helper.get_comment_changes(since, attending_ids)),
+        })
+
+
+class FitLeaderboardView(generics.ListAPIView):
+    """
+    The current user and their friends ranked by one period, activity and field of their fit history
+    """
+    permission_classes = (TokenHasReadWriteScope,)
+    serializer_class = FitRankingSerializer
+
+    def get_queryset(self):
+        period = self.request.QUERY_PARAMS.get('period', FitHistory.WEEK)
+        activity = self.request.QUERY_PARAMS.get('activity', None)
+        field = self.request.QUERY_PARAMS.get('field', None)
+        if activity is None or field is None:
+            return FitRanking.objects.none()
+        return FitRanking.objects.filter(viewer=self.request.user, period=period, activity=activity, field=field) \
+            .select_related('user__profile').order_by('rank')
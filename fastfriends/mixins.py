@@ -0,0 +1,89 @@
+import calendar
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin(object):
+    """
+    Adds ETag and Last-Modified validators to list and retrieve, and answers with 304 Not Modified
+    when the client's copy is still current, without running the serializer.
+
+    Validators come from aggregates over the objects being returned, max(updated) by default,
+    plus the viewer, the query string and any viewer specific state the response depends on.
+    """
+    last_modified_field = 'updated'
+
+    def get_validator_aggregates(self):
+        """
+        Aggregates over the listed or retrieved objects that the response depends on
+        """
+        return {'last_modified': Max(self.last_modified_field), 'count': Count('pk', distinct=True)}
+
+    def get_validator_queryset(self):
+        """
+        The listed objects, without any annotations the listing adds, which validator aggregates can't be mixed with
+        """
+        return self.filter_queryset(self.get_queryset())
+
+    def get_validator_state(self, queryset):
+        """
+        Anything else the response depends on, such as the viewer's own relationship to the objects
+        """
+        return ()
+
+    def check_not_modified(self, queryset):
+        """
+        Returns a 304 response if the client's copy of these objects is current, otherwise None
+        The validators are kept for add_validators to put on the full response
+        """
+        values = queryset.order_by().aggregate(**self.get_validator_aggregates())
+        state = self.get_validator_state(queryset)
+        etag = quote_etag(hashlib.md5(repr((self.request.user.pk, self.request.get_full_path(),
+                                            sorted(values.items()), state))).hexdigest())
+        last_modified = values['last_modified']
+        if last_modified is not None:
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+        self._validators = (etag, last_modified)
+
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = [value.strip() for value in if_none_match.split(',')]
+            etags = [value[2:] if value.startswith('W/') else value for value in etags]
+            not_modified = etag in etags or ('*' in etags and values['count'] > 0)
+        else:
+            # Last-Modified can't see changes to viewer specific state, so only the ETag validates those responses
+            if_modified_since = parse_http_date_safe(self.request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            not_modified = (not state and last_modified is not None and if_modified_since is not None and
+                            last_modified <= if_modified_since)
+        if not_modified:
+            return self.add_validators(Response(status=status.HTTP_304_NOT_MODIFIED))
+        return None
+
+    def add_validators(self, response):
+        validators = getattr(self, '_validators', None)
+        if validators is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            etag, last_modified = validators
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        not_modified = self.check_not_modified(self.get_validator_queryset())
+        if not_modified is not None:
+            return not_modified
+        return self.add_validators(super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        # Load the object first so a missing object is still a 404 and permissions are still checked
+        self.object = self.get_object()
+        not_modified = self.check_not_modified(type(self.object)._default_manager.filter(pk=self.object.pk))
+        if not_modified is not None:
+            return not_modified
+        serializer = self.get_serializer(self.object)
+        return self.add_validators(Response(serializer.data))
@@ -47,4 +47,30 @@ class ExtensibleModelSerializer(serializers.ModelSerializer):
             value = field.field_to_native(obj, field_name)
             ret[key] = value
             ret.fields[key] = field
-        return ret
\ No newline at end of file
+        return ret
+
+class SparseFieldsMixin(object):
+    """
+    Serializer mixin honouring comma separated ?fields= and ?exclude= query parameters when serializing.
+    Left out fields are dropped before serializing, so their method fields and queries never run.
+    id is always kept. Serializers nested by hand should be given a context with sparse_fields set to False.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get('request', None)
+        # Never drop fields from serializers validating input
+        if request is None or self.init_data is not None or not self.context.get('sparse_fields', True):
+            return
+        params = getattr(request, 'QUERY_PARAMS', request.GET)
+        fields = params.get('fields', None)
+        if fields:
+            keep = set(name.strip() for name in fields.split(','))
+            keep.add('id')
+            for name in list(self.fields.keys()):
+                if name not in keep:
+                    self.fields.pop(name)
+        exclude = params.get('exclude', None)
+        if exclude:
+            for name in exclude.split(','):
+                if name.strip() != 'id':
+                    self.fields.pop(name.strip(), None)
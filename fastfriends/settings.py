@@ -126,6 +126,10 @@ STATICFILES_DIRS = (
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
+# Point resource storage at an S3-compatible server instead of AWS, e.g. a local one for development and tests
+AWS_S3_HOST = os.environ.get('AWS_S3_HOST')
+AWS_S3_PORT = int(os.environ.get('AWS_S3_PORT', 0)) or None
+AWS_S3_SECURE = os.environ.get('AWS_S3_SECURE', '1') == '1'
 
 #DEFAULT_FILE_STORAGE = 'storages.backends.s3boto.S3BotoStorage'
 #STATICFILES_STORAGE = 'storages.backends.s3boto.S3BotoStorage'
@@ -164,8 +168,32 @@ REST_FRAMEWORK = {
 
 OAUTH2_PROVIDER = {
     # this is the list of available scopes
-    'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'}
+    'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'},
+    'OAUTH2_VALIDATOR_CLASS': 'api.oauth2_helper.CachedOAuth2Validator',
 }
+# Seconds to cache validated access tokens (capped by token expiry) and application secrets, with a shared cache only
+OAUTH2_TOKEN_CACHE_TIMEOUT = 60
+OAUTH2_CLIENT_CACHE_TIMEOUT = 300
+
+# Number of profiles returned by friend search suggestions, and how strongly the viewer's friends are ranked first
+SUGGEST_SIZE = 10
+SUGGEST_FRIEND_BOOST = 10
+
+# Most GET requests the app can bundle into one call to /batch/
+BATCH_MAX_REQUESTS = 10
+
+# Server-sent event stream of new messages and comments, see scripts/stream_server.py,
+# served by a separate app running the Procfile with STREAM_SERVER=1
+# STREAM_BUS is 'postgres' (LISTEN/NOTIFY) or 'local' (a localhost UDP socket, for development)
+STREAM_BUS = os.environ.get('STREAM_BUS', 'postgres')
+STREAM_CHANNEL = 'fastfriends_stream'
+STREAM_PORT = 8090
+STREAM_LOCAL_PORT = 8091
+# Seconds between heartbeats on idle streams, and bytes buffered for a slow client before dropping it
+STREAM_HEARTBEAT = 25
+STREAM_MAX_BUFFER = 65536
+# Threads validating new connections' tokens, so database lookups don't stall the stream server's poll loop
+STREAM_AUTH_THREADS = 4
 
 # easy_thumbnails
 THUMBNAIL_DEFAULT_STORAGE = 'storages.backends.s3boto.S3BotoStorage'
@@ -178,8 +206,21 @@ THUMBNAIL_ALIASES = {
                     'crop': True,
                     'upscale': True,
          },
+         'list': {
+                    'size': (480, 480),
+                    'quality': 80,
+                    'crop': True,
+         },
+         'detail': {
+                    'size': (1280, 1280),
+                    'quality': 85,
+         },
     },
 }
+# Processes rendering thumbnails in scripts/generate_thumbnails.py, 0 for one per core
+THUMBNAIL_PROCESSES = int(os.environ.get('THUMBNAIL_PROCESSES', 0))
+# Thumbnails recorded in easy_thumbnails' cache per bulk write
+THUMBNAIL_BATCH_SIZE = 100
 
 SOCIAL_HASH_SECRET = os.environ['SOCIAL_HASH_SECRET']
 
@@ -205,6 +246,13 @@ HASH_TAG_REGEX = '^#([a-z][a-z0-9_]{0,126}[a-z0-9]?)$'
 MENTION_LEN_MIN = 2
 MENTION_LEN_MAX = 65
 MENTION_REGEX = '^@([a-z][a-z0-9_-]{0,62}[a-z0-9]?)$'
+# Number of hash tag and mention ids each worker keeps in memory
+TAG_CACHE_SIZE = 10000
+
+# Bloom filter of display names in redis used to answer name checks for unused names without a query,
+# rebuilt hourly by the rebuild-name-filter task
+DISPLAY_NAME_FILTER_CAPACITY = 100000
+DISPLAY_NAME_FILTER_ERROR_RATE = 0.01
 
 # Total messages a basic user can store 
 MAX_MESSAGES = 500
@@ -215,6 +263,10 @@ PREMIUM_MAX_MESSAGES = 10000
 MIN_MEMBERS = 2
 
 MAX_MEMBERS = 2147483647 # Max value for Postgres 32bit "Integer" type
+# Times to retry handing a freed seat to the next waitlisted member when they change concurrently
+PROMOTE_ATTEMPTS = 3
+# Times to retry inviting friends when some of them are invited or join concurrently
+INVITE_ATTEMPTS = 3
 CONTENT_TYPES = ['image']
 # 2.5MB - 2621440
 # 5MB - 5242880
@@ -225,13 +277,38 @@ CONTENT_TYPES = ['image']
 # 250MB - 214958080
 # 500MB - 429916160
 MAX_UPLOAD_SIZE = 10485760
+# Uploads bigger than this are spooled to disk while the ingestion pipeline reads them
+RESOURCE_SPOOL_SIZE = 5242880
+# Uploads straight to s3 don't pass through the web dynos, so they can be bigger
+MAX_DIRECT_UPLOAD_SIZE = 104857600
+# Seconds a presigned upload can be started in, and finalized in
+UPLOAD_EXPIRES = 3600
+UPLOAD_FINALIZE_TIMEOUT = 86400
+# Attempts at deleting a released resource's files from s3, and how old unreferenced files are before they're deleted
+# as orphans, longer than UPLOAD_FINALIZE_TIMEOUT so unfinalized uploads can still be finalized
+STORAGE_DELETE_RETRIES = 5
+STORAGE_ORPHAN_AGE = timedelta(days=2)
 CHECKIN_PERIOD = timedelta(hours=4)
+
+# How far back /sync/ looks before its watermark, for rows stamped before the watermark but committed after it
+SYNC_OVERLAP = timedelta(seconds=5)
+# How long deletes are remembered, older sync tokens get a 410 and the client reloads everything
+SYNC_TOMBSTONE_TTL = timedelta(days=30)
 CHECKIN_DISTANCE = 200
 #------------
 
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
 CURRENCY_API_KEY = os.environ.get('CURRENCY_API_KEY')
 
+# Place autocomplete proxy, the url can point at scripts/places_stub.py for benchmarking
+PLACES_AUTOCOMPLETE_URL = os.environ.get('PLACES_AUTOCOMPLETE_URL', 'https://maps.googleapis.com/maps/api/place/autocomplete/json')
+PLACES_TIMEOUT = 3
+PLACES_POLL_INTERVAL = 0.05
+PLACES_POOL_SIZE = 10
+PLACES_CACHE_TIMEOUT = 3600
+# Degrees locations are rounded to, about 1km
+PLACES_GRID = 0.01
+
 # Logging for heroku
 LOGGING = {
     'version': 1,
@@ -272,6 +349,21 @@ ES_URLS = [os.environ['BONSAI_URL']]
 ES_INDEXES = {'default': os.environ['DEFAULT_ES_INDEX']}
 ES_TIMEOUT = 5 #seconds
 
+# Redis, buffers frequent writes such as event views
+REDIS_URL = os.environ.get('REDISTOGO_URL')
+# The cache is shared by every process through redis, so a key deleted by one is gone for the others.
+# Without redis each process gets its own, and caches that have to see other processes' deletes aren't used
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'api.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'cache',
+        }
+    }
+# Seconds to remember each user's latest event view, long after it has been flushed to the database
+LAST_VIEW_TIMEOUT = 86400
+
 # Celery
 #BROKER_URL = os.environ['REDISTOGO_URL']
 BROKER_URL = os.environ['CLOUDAMQP_URL']
@@ -294,6 +386,18 @@ CELERYBEAT_SCHEDULE = {
         'args': ()
     },
 
+    'flush-event-views': {
+        'task': 'tasks.flush_event_views',
+        'schedule': timedelta(minutes=1),
+        'args': ()
+    },
+
+    'rebuild-name-filter': {
+        'task': 'tasks.rebuild_name_filter',
+        'schedule': timedelta(hours=1),
+        'args': ()
+    },
+
     'update-friends': {
         'task': 'tasks.update_friends',
         'schedule': timedelta(hours=1),
@@ -312,6 +416,18 @@ CELERYBEAT_SCHEDULE = {
         'args': ()
     },
 
+    'prune-tombstones': {
+        'task': 'tasks.prune_tombstones',
+        'schedule': timedelta(days=1),
+        'args': ()
+    },
+
+    'reconcile-storage': {
+        'task': 'tasks.reconcile_storage',
+        'schedule': timedelta(days=1),
+        'args': ()
+    },
+
 #    'update-exchange-rates': {
 #        'task': 'tasks.update_exchange_rates',
 #        'schedule': crontab(minute="0", hour="20", day_of_week="*"),
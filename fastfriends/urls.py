@@ -39,10 +39,13 @@ urlpatterns = patterns('',
     url(r'^users/current/', views.CurrentUserView.as_view()),
     url(r'^users/current/password/', views.CurrentUserPasswordView.as_view()),
     url(r'^users/status/', views.UserStatusView.as_view()),
+    url(r'^batch/', views.BatchView.as_view()),
     url(r'^conversations/open/', views.ConversationOpenView.as_view()),
     url(r'^conversations/delete/', views.ConversationDeleteView.as_view()),
     url(r'^drafts/', views.DraftView.as_view()),
     url(r'^resources/delete/', views.ResourceDeleteView.as_view()),
+    url(r'^resources/upload/', views.ResourceUploadView.as_view()),
+    url(r'^resources/finalize/', views.ResourceFinalizeView.as_view()),
     url(r'^place/autocomplete/', views.PlaceAutoCompleteView.as_view()),
     url(r'^social_sign_in/', views.SocialSignInView.as_view()),
     url(r'^plans/search/', views.PlanSearchView.as_view()),
@@ -51,7 +54,9 @@ urlpatterns = patterns('',
     url(r'^contacts/find/', views.FindContactsView.as_view()),
     url(r'^contacts/import/', views.ImportContactsView.as_view()),
     url(r'^history/', views.UserHistoryView.as_view()),
+    url(r'^sync/', views.SyncView.as_view()),
     url(r'^check_name/', views.CheckNameView.as_view()),
+    url(r'^fit_history/leaderboard/', views.FitLeaderboardView.as_view()),
     url(r'fit_history', views.FitHistoryView.as_view()),    
     url(r'^', include(router.urls)),
     
@@ -0,0 +1,41 @@
+"""
+Render every thumbnail alias of stored images on a pool of processes
+
+usage: python scripts/generate_thumbnails.py [processes] [--all]
+
+Renders the images whose blob isn't thumbnailed yet, or with --all every image, e.g. after adding an alias.
+Uses api.thumbnail_helper.generate, one process per core unless THUMBNAIL_PROCESSES or processes is set.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fastfriends.settings')
+
+from api import media_helper, thumbnail_helper
+from api.models import Blob, protected_storage
+
+
+# Blobs rendered per pool
+CHUNK_SIZE = 1000
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    processes = int(args[0]) if args else None
+    blobs = Blob.objects.filter(content_type__startswith='image').order_by('id')
+    if '--all' not in sys.argv:
+        blobs = blobs.filter(thumbnailed=False)
+    hashes = list(blobs.values_list('hash', flat=True))
+
+    start = time.time()
+    done = 0
+    for i in range(0, len(hashes), CHUNK_SIZE):
+        names = dict((media_helper.get_blob_name(hash), hash) for hash in hashes[i:i + CHUNK_SIZE])
+        thumbnailed = [names[name] for name in thumbnail_helper.generate(protected_storage, names.keys(), processes)]
+        Blob.objects.filter(hash__in=thumbnailed).update(thumbnailed=True)
+        done += len(thumbnailed)
+        print 'thumbnailed %d of %d images' % (done, len(hashes))
+
+    print 'images: %d thumbnailed, %d failed in %.2fs' % (done, len(hashes) - done, time.time() - start)
@@ -0,0 +1,83 @@
+"""
+Replay typed-ahead place lookups against places_helper and report cache hit rate and latency
+
+usage: PLACES_AUTOCOMPLETE_URL=http://localhost:8089/autocomplete/json \\
+       python scripts/places_benchmark.py [users] [threads]
+
+Each simulated user types a few place names one character at a time from a location near one of a few cities.
+Run scripts/places_stub.py first; the number of requests it served is read back from its /stats endpoint.
+"""
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fastfriends.settings')
+
+import requests
+
+from django.conf import settings
+
+from api import places_helper
+
+
+CITIES = [(37.7749, -122.4194), (40.7128, -74.0060), (47.6062, -122.3321)]
+PLACES = ['starbucks', 'golden gate park', 'central library', 'pier 39', 'city hall', 'union square']
+
+
+def build_lookups(users):
+    lookups = []
+    for i in range(users):
+        lat, lng = random.choice(CITIES)
+        location = '%f,%f' % (lat + random.uniform(-0.01, 0.01), lng + random.uniform(-0.01, 0.01))
+        for place in random.sample(PLACES, 2):
+            for end in range(1, len(place) + 1):
+                lookups.append((place[:end], location))
+    return lookups
+
+
+def run(lookups, threads):
+    latencies = []
+    lock = threading.Lock()
+    queue = list(lookups)
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                input, location = queue.pop()
+            start = time.time()
+            places_helper.autocomplete(input, 'country:us', location, 5000)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sorted(latencies)
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    url = urlparse.urlparse(settings.PLACES_AUTOCOMPLETE_URL)
+    stats_url = '%s://%s/stats' % (url.scheme, url.netloc)
+    requests.post(stats_url)
+
+    lookups = build_lookups(users)
+    start = time.time()
+    latencies = run(lookups, threads)
+    total = time.time() - start
+    upstream = requests.get(stats_url).json()['count']
+
+    print 'lookups: %d in %.2fs' % (len(lookups), total)
+    print 'upstream requests: %d, hit rate: %.1f%%' % (upstream, 100.0 * (len(lookups) - upstream) / len(lookups))
+    for p in (50, 90, 99):
+        print 'p%d: %.1fms' % (p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000)
@@ -0,0 +1,66 @@
+"""
+Local stand-in for the Google Places autocomplete api, for benchmarking PlaceAutoCompleteView
+
+usage: python scripts/places_stub.py [port] [latency in ms]
+
+Point the app at it with PLACES_AUTOCOMPLETE_URL=http://localhost:<port>/autocomplete/json
+GET /stats returns the number of autocomplete requests served, POST /stats resets it
+"""
+import BaseHTTPServer
+import json
+import sys
+import threading
+import time
+import urlparse
+from SocketServer import ThreadingMixIn
+
+
+class Stats(object):
+    lock = threading.Lock()
+    count = 0
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.1
+
+    def send_json(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_json({'count': Stats.count})
+
+        with Stats.lock:
+            Stats.count += 1
+        time.sleep(self.latency)
+        query = urlparse.parse_qs(url.query)
+        input = query.get('input', [''])[0]
+        predictions = [{'description': '%s %d' % (input, i), 'place_id': '%s-%d' % (input, i)} for i in range(5)]
+        self.send_json({'status': 'OK', 'predictions': predictions})
+
+    def do_POST(self):
+        with Stats.lock:
+            Stats.count = 0
+        self.send_json({'count': 0})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8089
+    if len(sys.argv) > 2:
+        StubHandler.latency = int(sys.argv[2]) / 1000.0
+    print 'Places stub listening on port %d' % port
+    ThreadedHTTPServer(('', port), StubHandler).serve_forever()
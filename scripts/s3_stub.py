@@ -0,0 +1,160 @@
+"""
+Local stand-in for the parts of S3 resource storage uses, for trying out direct uploads without AWS
+
+usage: python scripts/s3_stub.py [port]
+
+Point the app at it with AWS_S3_HOST=localhost AWS_S3_PORT=<port> AWS_S3_SECURE=0
+Supports browser-based POST uploads, checking the policy's key, content type, size and expiration but not
+its signature, GET, HEAD, PUT (including copies) and DELETE of objects, multi-object deletes and bucket listings
+with a prefix and delimiter, in one page. Objects are kept in memory.
+"""
+import base64
+import BaseHTTPServer
+import cgi
+import datetime
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape, unescape
+
+
+def get_etag(data):
+    # boto checks uploads against it
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+class Store(object):
+    lock = threading.Lock()
+    objects = {}
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def get_path(self):
+        return urllib.unquote(self.path.split('?', 1)[0]).lstrip('/')
+
+    def get_query(self):
+        return urlparse.parse_qs(urlparse.urlsplit(self.path).query, keep_blank_values=True)
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def check_policy(self, form, size):
+        """
+        Returns an error if the upload breaks its policy
+        """
+        policy = json.loads(base64.b64decode(form.getfirst('policy', '')) or '{}')
+        if datetime.datetime.strptime(policy['expiration'], '%Y-%m-%dT%H:%M:%SZ') < datetime.datetime.utcnow():
+            return 'Policy expired'
+        for condition in policy['conditions']:
+            if isinstance(condition, dict):
+                for name, value in condition.items():
+                    if name != 'bucket' and form.getfirst(name) != value:
+                        return 'Policy condition failed: ' + name
+            elif condition[0] == 'content-length-range' and not condition[1] <= size <= condition[2]:
+                return 'EntityTooLarge'
+        return None
+
+    def do_POST(self):
+        bucket = self.get_path().rstrip('/')
+        if 'delete' in self.get_query():
+            return self.delete_objects(bucket)
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={
+            'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+        data = form['file'].value
+        error = self.check_policy(form, len(data))
+        if error:
+            return self.respond(403, error)
+        with Store.lock:
+            Store.objects[bucket + '/' + form.getfirst('key')] = (form.getfirst('Content-Type', ''), data, time.time())
+        self.respond(204)
+
+    def do_PUT(self):
+        path = self.get_path()
+        copy_source = self.headers.get('x-amz-copy-source')
+        with Store.lock:
+            if copy_source:
+                source = Store.objects.get(urllib.unquote(copy_source).lstrip('/'))
+                if source is None:
+                    return self.respond(404)
+                Store.objects[path] = source[:2] + (time.time(),)
+                return self.respond(200, '<CopyObjectResult></CopyObjectResult>')
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            Store.objects[path] = (self.headers.get('Content-Type', ''), data, time.time())
+        self.respond(200, headers={'ETag': get_etag(data)})
+
+    def delete_objects(self, bucket):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        keys = [unescape(key) for key in re.findall(r'<Key>(.*?)</Key>', body)]
+        with Store.lock:
+            for key in keys:
+                Store.objects.pop(bucket + '/' + key, None)
+        self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><DeleteResult></DeleteResult>')
+
+    def list_objects(self, bucket):
+        query = self.get_query()
+        prefix = query.get('prefix', [''])[0]
+        delimiter = query.get('delimiter', [''])[0]
+        contents, prefixes = [], set()
+        with Store.lock:
+            for path, (content_type, data, modified) in sorted(Store.objects.items()):
+                if not path.startswith(bucket + '/' + prefix):
+                    continue
+                key = path[len(bucket) + 1:]
+                if delimiter and delimiter in key[len(prefix):]:
+                    prefixes.add(key[:key.index(delimiter, len(prefix)) + 1])
+                    continue
+                contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag>'
+                                '<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' % (
+                                    escape(key), time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(modified)), get_etag(data),
+                                    len(data)))
+        body = ('<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>%s</Name><Prefix>%s</Prefix>'
+                '<IsTruncated>false</IsTruncated>%s%s</ListBucketResult>' % (
+                    escape(bucket), escape(prefix), ''.join(contents),
+                    ''.join('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(p) for p in sorted(prefixes))))
+        self.respond(200, body, {'Content-Type': 'application/xml'})
+
+    def do_GET(self):
+        path = self.get_path()
+        if '/' not in path.rstrip('/'):
+            return self.list_objects(path.rstrip('/'))
+        with Store.lock:
+            stored = Store.objects.get(path)
+        if stored is None:
+            return self.respond(404)
+        content_type, data, modified = stored
+        self.respond(200, data, {'Content-Type': content_type, 'ETag': get_etag(data),
+                                 'Last-Modified': self.date_time_string(modified)})
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        with Store.lock:
+            Store.objects.pop(self.get_path(), None)
+        self.respond(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9000
+    print 'S3 stub listening on port %d' % port
+    ThreadedHTTPServer(('', port), StubHandler).serve_forever()
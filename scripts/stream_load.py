@@ -0,0 +1,110 @@
+"""
+Hold thousands of idle connections open on scripts/stream_server.py and measure how fast notifications reach them
+
+usage: STREAM_BUS=local python scripts/stream_load.py [connections] [notifications] [idle seconds] [port]
+
+Start the server on the same machine first:
+    DJANGO_DEBUG=1 STREAM_BUS=local python scripts/stream_server.py 8090 --no-auth
+
+Connection i streams as user i and follows one of EVENTS events. After the connections have sat idle,
+messages to random users and comments on random events are published over the local bus, and the script
+reports how many deliveries arrived and how long they took.
+"""
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fastfriends.settings')
+
+from django.conf import settings
+
+from api import stream_helper
+from stream_server import Poller, READ
+
+
+EVENTS = 100
+
+
+def raise_file_limit(connections):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def connect(port, connections):
+    socks = {}
+    for i in range(connections):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall('GET /stream/?user=%d&events=%d HTTP/1.1\r\nHost: localhost\r\n\r\n' % (i, i % EVENTS))
+        sock.setblocking(0)
+        socks[sock.fileno()] = sock
+    return socks
+
+
+def read(poller, socks, timeout, on_frame):
+    """
+    Read for up to timeout seconds, or until nothing arrives for a second, calling on_frame with each data line
+    """
+    buffers = dict((fd, '') for fd in socks)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        ready = poller.poll(min(1, max(0, deadline - time.time())))
+        if not ready:
+            return
+        for fd, mask in ready:
+            try:
+                data = socks[fd].recv(65536)
+            except socket.error:
+                continue
+            frames = (buffers[fd] + data).split('\n\n')
+            buffers[fd] = frames.pop()
+            for frame in frames:
+                for line in frame.split('\n'):
+                    if line.startswith('data: '):
+                        on_frame(line[len('data: '):])
+
+
+if __name__ == '__main__':
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    notifications = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    idle = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    port = int(sys.argv[4]) if len(sys.argv) > 4 else settings.STREAM_PORT
+    if settings.STREAM_BUS != stream_helper.LOCAL:
+        sys.exit('Run with STREAM_BUS=local')
+
+    raise_file_limit(connections)
+    start = time.time()
+    socks = connect(port, connections)
+    poller = Poller()
+    for fd in socks:
+        poller.register(fd, READ)
+    print 'connections: %d opened in %.2fs' % (len(socks), time.time() - start)
+    # Response headers, then whatever heartbeats arrive while the connections are idle
+    read(poller, socks, 10, lambda data: None)
+    time.sleep(idle)
+    read(poller, socks, 10, lambda data: None)
+
+    expected = 0
+    for i in range(notifications):
+        if i % 2:
+            event = random.randrange(EVENTS)
+            expected += len(range(event, connections, EVENTS))
+            payload = stream_helper.encode(stream_helper.COMMENT, {'sent': time.time()}, events=[event])
+        else:
+            expected += 1
+            payload = stream_helper.encode(stream_helper.MESSAGE, {'sent': time.time()}, users=[random.randrange(connections)])
+        stream_helper.publish(payload)
+
+    latencies = []
+    read(poller, socks, 10, lambda data: latencies.append(time.time() - json.loads(data)['sent']))
+    latencies.sort()
+    print 'deliveries: %d of %d' % (len(latencies), expected)
+    for p in (50, 90, 99):
+        if latencies:
+            print 'p%d: %.1fms' % (p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000)
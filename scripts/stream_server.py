@@ -0,0 +1,357 @@
+"""
+Pushes new messages and event comments to connected clients as server-sent events
+
+usage: python scripts/stream_server.py [port] [--no-auth]
+
+Clients connect with
+
+    GET /stream/?events=12,15 HTTP/1.1
+    Authorization: Bearer <access token>
+
+and are sent every message they send or receive, and every new comment on the listed events they are members of,
+with the same data as the GCM push:
+
+    event: message
+    data: {"message": {...}}
+
+A comment line goes out every STREAM_HEARTBEAT seconds so idle connections stay open through proxies.
+
+A single thread serves every connection from one poll loop, so an idle client costs a socket and a few buffers.
+Notifications arrive on api.stream_helper's bus, Postgres LISTEN, or a localhost socket with STREAM_BUS=local.
+Only a new connection's token and event membership are looked up in the database, by STREAM_AUTH_THREADS threads
+next to the loop, so a slow query holds up that connection and not every other one.
+--no-auth takes the user from ?user= and trusts the events, for scripts/stream_load.py only. It's refused
+unless DJANGO_DEBUG is set and STREAM_BUS=local, which can't carry notifications between dynos anyway.
+
+Deploying: Heroku only routes HTTP to the web process, so the stream server runs as the web process of its own
+app, deployed from this repo with the api app's config (DATABASE_URL and the rest) and STREAM_SERVER=1 set,
+and only its web process scaled up. The Procfile starts this script instead of gunicorn there, listening on $PORT,
+and clients connect to https://<stream app>.herokuapp.com/stream/ rather than to the api's host.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import urlparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fastfriends.settings')
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from api import oauth2_helper, stream_helper
+from api.models import EventMember
+
+
+logger = logging.getLogger(__name__)
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+CLOSED = select.POLLERR | select.POLLHUP
+MAX_REQUEST = 8192
+
+STREAM_HEADERS = ('HTTP/1.1 200 OK\r\n'
+                  'Content-Type: text/event-stream\r\n'
+                  'Cache-Control: no-cache\r\n'
+                  'Connection: keep-alive\r\n'
+                  'X-Accel-Buffering: no\r\n'
+                  '\r\n'
+                  'retry: 5000\n\n')
+
+
+class Poller(object):
+    """
+    epoll where there is one, poll elsewhere, select can't watch more than 1024 sockets
+    The event masks have the same values for both
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller, self.scale = select.epoll(), 1
+        else:
+            self.poller, self.scale = select.poll(), 1000
+
+    def register(self, fd, mask):
+        self.poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        # Whether the request has been read, it's being authenticated or streaming after that
+        self.started = False
+        self.request = ''
+        self.pending = ''
+        self.user_id = None
+        self.events = set()
+
+
+class StreamServer(object):
+    def __init__(self, port, check_auth=True):
+        if not check_auth and not (settings.DEBUG and settings.STREAM_BUS == stream_helper.LOCAL):
+            raise ValueError('--no-auth is only for load tests, with DJANGO_DEBUG set and STREAM_BUS=local')
+        self.check_auth = check_auth
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(1024)
+        self.listener.setblocking(0)
+        self.bus = stream_helper.get_bus()
+
+        self.poller = Poller()
+        self.poller.register(self.listener.fileno(), READ)
+        self.poller.register(self.bus.fileno(), READ)
+        self.clients = {}
+        self.users = defaultdict(set)
+        self.events = defaultdict(set)
+
+        # Requests go to the auth threads, their results come back with a byte on the wakeup pipe to end the poll
+        self.auth_requests = Queue.Queue()
+        self.auth_results = Queue.Queue()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_read, READ)
+        if check_auth:
+            for i in range(settings.STREAM_AUTH_THREADS):
+                thread = threading.Thread(target=self.authenticate_forever)
+                thread.daemon = True
+                thread.start()
+
+    def serve_forever(self):
+        next_heartbeat = time.time() + settings.STREAM_HEARTBEAT
+        while True:
+            for fd, mask in self.poller.poll(max(0, next_heartbeat - time.time())):
+                if fd == self.listener.fileno():
+                    self.accept()
+                elif fd == self.bus.fileno():
+                    for payload in self.bus.read():
+                        self.dispatch(payload)
+                elif fd == self.wakeup_read:
+                    self.finish_authentication()
+                elif fd in self.clients:
+                    client = self.clients[fd]
+                    if mask & READ:
+                        self.receive(client)
+                    if mask & WRITE and fd in self.clients:
+                        self.flush(client)
+                    if mask & CLOSED and fd in self.clients:
+                        self.close(client)
+            if time.time() >= next_heartbeat:
+                for client in self.clients.values():
+                    if client.user_id is not None:
+                        self.send(client, ': ping\n\n')
+                next_heartbeat = time.time() + settings.STREAM_HEARTBEAT
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            self.clients[sock.fileno()] = Client(sock)
+            self.poller.register(sock.fileno(), READ)
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            return self.close(client)
+        if client.started:
+            # Authenticating or streaming, nothing more is expected from the client
+            return
+        client.request += data
+        if '\r\n\r\n' in client.request:
+            self.start(client)
+        elif len(client.request) > MAX_REQUEST:
+            self.reject(client, '431 Request Header Fields Too Large')
+
+    def start(self, client):
+        """
+        Check the client's request and subscribe them to their own and their events' notifications
+        """
+        lines = client.request.split('\r\n\r\n', 1)[0].split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ')
+        except ValueError:
+            return self.reject(client, '400 Bad Request')
+        url = urlparse.urlsplit(path)
+        if method != 'GET' or url.path.rstrip('/') != '/stream':
+            return self.reject(client, '404 Not Found')
+        headers = dict((name.strip().lower(), value.strip()) for name, sep, value in
+                       (line.partition(':') for line in lines[1:]))
+        query = urlparse.parse_qs(url.query)
+        events = set(int(event) for event in ','.join(query.get('events', [])).split(',') if event.isdigit())
+
+        client.started = True
+        if self.check_auth:
+            # Finished by finish_authentication when a thread has looked the token up
+            self.auth_requests.put((client, headers, query, events))
+        else:
+            user = query.get('user', [''])[0]
+            self.subscribe(client, int(user) if user.isdigit() else None, events)
+
+    def subscribe(self, client, user_id, events):
+        if user_id is None:
+            return self.reject(client, '401 Unauthorized')
+        client.user_id, client.events = user_id, events
+        self.users[user_id].add(client)
+        for event in events:
+            self.events[event].add(client)
+        self.send(client, STREAM_HEADERS)
+
+    def authenticate_forever(self):
+        """
+        Auth thread, looks up tokens and memberships in the database so the poll loop never waits on it
+        """
+        while True:
+            client, headers, query, events = self.auth_requests.get()
+            try:
+                user_id, events = self.authenticate(headers, query, events)
+            except Exception:
+                logger.exception('Stream authentication failed')
+                user_id, events = None, set()
+            self.auth_results.put((client, user_id, events))
+            try:
+                os.write(self.wakeup_write, 'x')
+            except OSError as e:
+                # The pipe is full, so the loop is already waking up
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def finish_authentication(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while True:
+            try:
+                client, user_id, events = self.auth_results.get_nowait()
+            except Queue.Empty:
+                return
+            # It may have disconnected while it was authenticated, and its fd gone to a new client
+            if self.clients.get(client.fd) is client:
+                self.subscribe(client, user_id, events)
+
+    def authenticate(self, headers, query, events):
+        """
+        Returns the token's user and the events they're a member of, or None for a bad token
+        """
+        authorization = headers.get('authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        else:
+            token = query.get('access_token', [''])[0]
+        try:
+            access_token = oauth2_helper.get_access_token(token) if token else None
+            if access_token is None or not access_token.is_valid(['read']):
+                return None, set()
+            if events:
+                events = set(EventMember.objects.filter(user=access_token.user_id, event__in=events)
+                             .exclude(status=EventMember.DECLINED).values_list('event', flat=True))
+            return access_token.user_id, events
+        finally:
+            close_old_connections()
+
+    def reject(self, client, status):
+        self.send(client, 'HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status)
+        self.close(client)
+
+    def dispatch(self, payload):
+        try:
+            notification = json.loads(payload)
+        except ValueError:
+            return
+        clients = set()
+        for user_id in notification.get('users', []):
+            clients.update(self.users.get(user_id, ()))
+        for event in notification.get('events', []):
+            clients.update(self.events.get(event, ()))
+        frame = 'event: %s\ndata: %s\n\n' % (notification['type'], json.dumps(notification['data']))
+        for client in clients:
+            self.send(client, frame)
+
+    def send(self, client, data):
+        if client.pending:
+            client.pending += data
+            if len(client.pending) > settings.STREAM_MAX_BUFFER:
+                # Too slow to keep up, it will reconnect and catch up through /sync/
+                self.close(client)
+            return
+        try:
+            sent = client.sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return self.close(client)
+            sent = 0
+        if sent < len(data):
+            client.pending = data[sent:]
+            self.poller.modify(client.sock.fileno(), READ | WRITE)
+
+    def flush(self, client):
+        data, client.pending = client.pending, ''
+        self.poller.modify(client.sock.fileno(), READ)
+        if data:
+            self.send(client, data)
+
+    def close(self, client):
+        fd = client.fd
+        if self.clients.get(fd) is not client:
+            return
+        del self.clients[fd]
+        self.poller.unregister(fd)
+        client.sock.close()
+        if client.user_id is not None:
+            self.discard(self.users, client.user_id, client)
+        for event in client.events:
+            self.discard(self.events, event, client)
+
+    def discard(self, subscriptions, key, client):
+        subscribers = subscriptions.get(key)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del subscriptions[key]
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    port = int(args[0]) if args else int(os.environ.get('PORT', settings.STREAM_PORT))
+    try:
+        server = StreamServer(port, check_auth='--no-auth' not in sys.argv)
+    except ValueError as e:
+        sys.exit(str(e))
+    print 'Stream server listening on port %d, bus: %s' % (port, settings.STREAM_BUS)
+    server.serve_forever()
@@ -0,0 +1,86 @@
+"""
+Compare thumbnail rendering throughput of easy_thumbnails' per-alias path with api.thumbnail_helper
+
+usage: python scripts/thumbnail_benchmark.py [images] [processes]
+
+Every alias is rendered for synthetic camera sized JPEGs, in memory, so storage and the database aren't measured:
+    per alias: what a request does when a thumbnail is missing, a full decode for each alias
+    single decode: thumbnail_helper.render, one draft decode per image for all aliases, in this process
+    pool: thumbnail_helper.render on a pool of processes, one per core by default
+"""
+import multiprocessing
+from io import BytesIO
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fastfriends.settings')
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from PIL import Image, ImageDraw
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import Thumbnailer
+
+from api import thumbnail_helper
+
+
+SIZES = [(3264, 2448), (2448, 3264), (4032, 3024), (1920, 1080)]
+
+
+def make_image(size):
+    image = Image.new('RGB', size, tuple(random.randrange(256) for i in range(3)))
+    draw = ImageDraw.Draw(image)
+    for i in range(200):
+        x, y = random.randrange(size[0]), random.randrange(size[1])
+        draw.ellipse((x, y, x + random.randrange(50, 500), y + random.randrange(50, 500)),
+                     fill=tuple(random.randrange(256) for i in range(3)))
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def per_alias(images):
+    for i, data in enumerate(images):
+        thumbnailer = Thumbnailer(ContentFile(data), name='benchmark/%d.jpg' % i)
+        for alias, options in aliases.all().iteritems():
+            thumbnailer.generate_thumbnail(options).read()
+
+
+def single_decode(images):
+    for i, data in enumerate(images):
+        thumbnail_helper.render(data, get_jobs(i))
+
+
+def pool(images, processes):
+    workers = multiprocessing.Pool(processes)
+    try:
+        for thumbnails in workers.imap(thumbnail_helper.render_job, ((data, get_jobs(i)) for i, data in enumerate(images))):
+            pass
+    finally:
+        workers.terminate()
+        workers.join()
+
+
+def get_jobs(i):
+    return thumbnail_helper.get_jobs(Thumbnailer(name='benchmark/%d.jpg' % i))
+
+
+def report(name, images, elapsed):
+    print '%s: %.2fs, %.1f images/s' % (name, elapsed, len(images) / elapsed)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else settings.THUMBNAIL_PROCESSES or multiprocessing.cpu_count()
+    images = [make_image(SIZES[i % len(SIZES)]) for i in range(count)]
+    print 'images: %d, aliases: %s, processes: %d' % (count, ', '.join(sorted(aliases.all())), processes)
+
+    for name, run in (('per alias', per_alias), ('single decode', single_decode),
+                      ('pool', lambda images: pool(images, processes))):
+        start = time.time()
+        run(images)
+        report(name, images, time.time() - start)